@@ -0,0 +1,62 @@
+"""
+Import-time benchmark of the mpoints modules.
+
+Each import is timed in a fresh interpreter, since Python caches imported modules. The script also checks
+that the heavy optional dependencies are not imported as a side effect of importing the core module.
+
+Usage::
+
+    python benchmarks/import_time.py [--repeat 10]
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+'Modules whose import time is measured'
+MODULES = ['mpoints', 'mpoints.hybrid_hawkes_exp', 'mpoints.diagnostics', 'mpoints.plot_tools']
+
+'Modules that must not be imported by `import mpoints.hybrid_hawkes_exp`'
+HEAVY_MODULES = ['scipy.optimize', 'scipy.linalg', 'scipy.sparse', 'scipy.stats', 'matplotlib', 'seaborn',
+                 'statsmodels']
+
+TIMING_CODE = """
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+"""
+
+CHECK_CODE = """
+import sys
+import mpoints.hybrid_hawkes_exp
+print(','.join(m for m in {heavy_modules!r} if m in sys.modules))
+"""
+
+
+def run(code):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    environment = dict(os.environ)
+    environment['PYTHONPATH'] = root + os.pathsep + environment.get('PYTHONPATH', '')
+    output = subprocess.run([sys.executable, '-c', code], env=environment, check=True, stdout=subprocess.PIPE,
+                            universal_newlines=True)
+    return output.stdout.strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--repeat', type=int, default=10, help='number of fresh interpreters per module')
+    arguments = parser.parse_args()
+    print('{:<30}{:>12}{:>12}'.format('module', 'median (ms)', 'min (ms)'))
+    for module in MODULES:
+        durations = sorted(float(run(TIMING_CODE.format(module=module))) for _ in range(arguments.repeat))
+        print('{:<30}{:>12.1f}{:>12.1f}'.format(module, 1000 * durations[len(durations) // 2], 1000 * durations[0]))
+    imported = run(CHECK_CODE.format(heavy_modules=HEAVY_MODULES))
+    if imported:
+        print('FAILED: importing mpoints.hybrid_hawkes_exp also imports ' + imported)
+        sys.exit(1)
+    print('OK: importing mpoints.hybrid_hawkes_exp does not import ' + ', '.join(HEAVY_MODULES))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,366 @@
+"""
+Benchmarks of the estimation, simulation and diagnostics hot paths of :py:mod:`mpoints.hybrid_hawkes_exp`.
+
+For every combination of number of event types, number of states and number of events of the grid, a random model
+is drawn and a sample path is simulated with the package's own simulator (both are seeded, so that two versions of
+the package are timed on the same data). The script then times the main methods and checks that the different
+code paths agree numerically:
+
+- the partial log-likelihoods sum to the log-likelihood,
+- the gradient matches central finite differences of the log-likelihood,
+- the partial gradients match the corresponding entries of the gradient,
+- the Hessian matches central finite differences of the gradient,
+- the intensities and compensators recorded by `simulate` match `intensities_of_events_at_times` and the
+  events residuals,
+- the blocked and event-by-event evaluations of the exponential decays agree,
+- the kernels give the same results on read-only int8 event types and states,
+- the tick mode matches the float mode on times rounded to ticks,
+- the chunked residuals match the residuals computed in one pass,
+- the bounded 'trust-constr' estimation does at least as well as 'L-BFGS-B' from the same initial guesses,
+- the sparse and dense estimates of the transition probabilities coincide.
+
+Usage::
+
+    python benchmarks/run_benchmarks.py [--quick] [--repeat 3] [--output results.json]
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from mpoints.hybrid_hawkes_exp import HybridHawkesExp
+from mpoints.parameter_structure import ParameterStructure
+
+'Duration of a tick and epoch of the tick times'
+TIME_SCALE = 1e-6
+EPOCH = 1600000000 * 10**6
+
+'Grid of (number of event types, number of states, number of events)'
+GRID = list(itertools.product([2, 4], [3, 10], [1000, 10000]))
+QUICK_GRID = [(2, 3, 1000)]
+
+'Tolerances of the numerical checks (relative errors)'
+TOLERANCES = {'partial likelihoods': 1e-10, 'gradient vs finite differences': 1e-4, 'partial gradients': 1e-10,
+              'hessian vs finite differences': 1e-4, 'shared decays': 1e-10, 'sparse kernels': 1e-10,
+              'tick times': 1e-10, 'compact marks': 1e-12, 'bounded trust-constr': 1e-6,
+              'blocked decays': 1e-12,
+              'recorded intensities': 1e-8, 'recorded compensators': 1e-8, 'chunked residuals': 1e-10,
+              'sparse transition probabilities': 1e-12}
+
+
+def make_model(number_of_event_types, number_of_states, seed, branching_ratio=0.6):
+    'Random model whose branching ratio is `branching_ratio`'
+    rng = np.random.RandomState(seed)
+    model = HybridHawkesExp(number_of_event_types, number_of_states,
+                            ['e' + str(e) for e in range(number_of_event_types)],
+                            ['x' + str(x) for x in range(number_of_states)])
+    phi = rng.uniform(0.1, 1, (number_of_states, number_of_event_types, number_of_states))
+    phi /= np.sum(phi, axis=2, keepdims=True)
+    model.set_transition_probabilities(phi)
+    base_rates = rng.uniform(0.5, 1, number_of_event_types)
+    decay_coefficients = rng.uniform(1, 10, (number_of_event_types, number_of_states, number_of_event_types))
+    impact_coefficients = decay_coefficients * rng.uniform(0.2, 1, decay_coefficients.shape)
+    model.set_hawkes_parameters(base_rates, impact_coefficients, decay_coefficients)
+    # rescale the impact coefficients to reach the target branching ratio
+    impact_coefficients *= branching_ratio / model.branching_ratio
+    model.set_hawkes_parameters(base_rates, impact_coefficients, decay_coefficients)
+    return model
+
+
+def simulate(model, number_of_events, seed):
+    'Sample path with exactly `number_of_events` events'
+    np.random.seed(seed)
+    time_end = 100 * number_of_events / np.sum(model.base_rates)
+    times, events, states = model.simulate(0, time_end, max_number_of_events=number_of_events)
+    return times, events, states, times[-1]
+
+
+def sparse_impact_mask(number_of_event_types, number_of_states, seed, density=0.25):
+    'Random impact mask in which a proportion `density` of the kernels are active'
+    rng = np.random.RandomState(seed)
+    return rng.uniform(size=(number_of_event_types, number_of_states, number_of_event_types)) < density
+
+
+def to_ticks(times):
+    'Integer numbers of ticks since EPOCH'
+    return EPOCH + np.round(np.asarray(times) / TIME_SCALE).astype(np.int64)
+
+
+def best_time(function, repeat):
+    'Best wall-clock time over `repeat` runs, in seconds'
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return min(durations)
+
+
+def relative_error(x, y):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    return float(np.max(np.abs(x - y)) / max(np.max(np.abs(y)), 1e-300))
+
+
+def run_checks(model, times, events, states, time_end, seed):
+    'Returns the relative errors of the numerical checks'
+    rng = np.random.RandomState(seed)
+    d_e = model.number_of_event_types
+    d_x = model.number_of_states
+    parameters = model.parameters_to_array(model.base_rates, model.impact_coefficients, model.decay_coefficients)
+    errors = {}
+    'Partial log-likelihoods and partial gradients'
+    log_likelihood = model.log_likelihood_of_events(parameters, times, events, states, 0, time_end)
+    gradient = model.gradient(parameters, times, events, states, 0, time_end)
+    g_base_rates, g_impact, g_decay = model.array_to_parameters(gradient, d_e, d_x)
+    partial_log_likelihoods = 0
+    partial_errors = []
+    for e in range(d_e):
+        partial_parameters = model.parameters_to_array(model.base_rates[e:e + 1],
+                                                       model.impact_coefficients[:, :, e:e + 1],
+                                                       model.decay_coefficients[:, :, e:e + 1])
+        partial_log_likelihoods += model.log_likelihood_of_events_partial(e, partial_parameters, times, events,
+                                                                          states, 0, time_end)
+        partial_gradient = model.gradient_partial(e, partial_parameters, times, events, states, 0, time_end)
+        expected = model.parameters_to_array(g_base_rates[e:e + 1], g_impact[:, :, e:e + 1], g_decay[:, :, e:e + 1])
+        partial_errors.append(relative_error(partial_gradient, expected))
+    errors['partial likelihoods'] = relative_error(partial_log_likelihoods, log_likelihood)
+    errors['partial gradients'] = max(partial_errors)
+    'Gradient against central finite differences, on a few random coordinates'
+    finite_differences = []
+    analytical = []
+    for i in rng.choice(len(parameters), size=min(5, len(parameters)), replace=False):
+        step = 1e-6 * max(abs(parameters[i]), 1)
+        shift = np.zeros(len(parameters))
+        shift[i] = step
+        finite_differences.append((model.log_likelihood_of_events(parameters + shift, times, events, states, 0,
+                                                                  time_end)
+                                   - model.log_likelihood_of_events(parameters - shift, times, events, states, 0,
+                                                                    time_end)) / (2 * step))
+        analytical.append(gradient[i])
+    errors['gradient vs finite differences'] = relative_error(analytical, finite_differences)
+    'Hessian against central finite differences of the gradient, on a few random columns'
+    hessian = model.hessian(parameters, times, events, states, 0, time_end)
+    finite_differences = []
+    analytical = []
+    for i in rng.choice(len(parameters), size=min(3, len(parameters)), replace=False):
+        step = 1e-6 * max(abs(parameters[i]), 1)
+        shift = np.zeros(len(parameters))
+        shift[i] = step
+        finite_differences.append((model.gradient(parameters + shift, times, events, states, 0, time_end)
+                                   - model.gradient(parameters - shift, times, events, states, 0, time_end))
+                                  / (2 * step))
+        analytical.append(hessian[:, i])
+    errors['hessian vs finite differences'] = relative_error(analytical, finite_differences)
+    'Decays shared across states: the structured kernel against the full one with tied decay coefficients'
+    structure = ParameterStructure(d_e, d_x, 'shared_across_states')
+    free_parameters = structure.full_to_free(parameters)
+    errors['shared decays'] = relative_error(
+        model.log_likelihood_of_events(free_parameters, times, events, states, 0, time_end, structure),
+        model.log_likelihood_of_events(structure.free_to_full(free_parameters), times, events, states, 0, time_end))
+    'Sparse kernels: only the kernels of the free impact coefficients are visited, the others are zero'
+    structure = ParameterStructure(d_e, d_x, impact_mask=sparse_impact_mask(d_e, d_x, seed))
+    free_parameters = structure.full_to_free(parameters)
+    full_parameters = structure.free_to_full(free_parameters)
+    errors['sparse kernels'] = max(
+        relative_error(model.log_likelihood_of_events(free_parameters, times, events, states, 0, time_end, structure),
+                       model.log_likelihood_of_events(full_parameters, times, events, states, 0, time_end)),
+        relative_error(model.gradient(free_parameters, times, events, states, 0, time_end, structure),
+                       structure.gradient_to_free(model.gradient(full_parameters, times, events, states, 0,
+                                                                 time_end))))
+    'Blocked decays: the decay factors computed by blocks of events against the ones computed event by event'
+    errors['blocked decays'] = max(
+        relative_error(model.log_likelihood_of_events(parameters, times, events, states, 0, time_end, block_size=64),
+                       model.log_likelihood_of_events(parameters, times, events, states, 0, time_end, block_size=0)),
+        relative_error(model.gradient(parameters, times, events, states, 0, time_end, block_size=64),
+                       model.gradient(parameters, times, events, states, 0, time_end, block_size=0)),
+        relative_error(model.compute_total_residuals(times, events, states, 0, compact=True, block_size=64)[0],
+                       model.compute_total_residuals(times, events, states, 0, compact=True, block_size=0)[0]))
+    'Compact marks: the event types and states are read as int8 without being converted, from read-only arrays'
+    compact_events = events.astype(np.int8)
+    compact_states = states.astype(np.int8)
+    read_only_times = times.copy()
+    for array in [compact_events, compact_states, read_only_times]:
+        array.setflags(write=False)
+    em_arguments = dict(initial_guess=parameters, maximum_number_of_iterations=1)
+    errors['compact marks'] = max(
+        relative_error(model.log_likelihood_of_events(parameters, read_only_times, compact_events, compact_states, 0,
+                                                      time_end),
+                       model.log_likelihood_of_events(parameters, times, events, states, 0, time_end)),
+        relative_error(model.gradient(parameters, read_only_times, compact_events, compact_states, 0, time_end),
+                       model.gradient(parameters, times, events, states, 0, time_end)),
+        relative_error(model.compute_total_residuals(read_only_times, compact_events, compact_states, 0,
+                                                     compact=True)[0],
+                       model.compute_total_residuals(times, events, states, 0, compact=True)[0]),
+        relative_error(model.estimate_hawkes_parameters_em(read_only_times, compact_events, compact_states, 0,
+                                                           time_end, **em_arguments).x,
+                       model.estimate_hawkes_parameters_em(times, events, states, 0, time_end, **em_arguments).x))
+    'Tick times: the same path with its times rounded to ticks, shifted to the epoch in tick mode'
+    ticks = to_ticks(times)
+    tick_end = to_ticks(time_end) + 1
+    float_times = (ticks - EPOCH) * TIME_SCALE
+    float_end = (tick_end - EPOCH) * TIME_SCALE
+    errors['tick times'] = max(
+        relative_error(model.log_likelihood_of_events(parameters, ticks, events, states, EPOCH, tick_end,
+                                                      time_scale=TIME_SCALE),
+                       model.log_likelihood_of_events(parameters, float_times, events, states, 0, float_end)),
+        relative_error(model.gradient(parameters, ticks, events, states, EPOCH, tick_end, time_scale=TIME_SCALE),
+                       model.gradient(parameters, float_times, events, states, 0, float_end)))
+    'Intensities and compensators recorded during the simulation'
+    np.random.seed(seed)
+    sim_times, sim_events, sim_states, intensities, compensators = \
+        model.simulate(0, time_end, max_number_of_events=len(times), record_intensities=True)
+    aggregated_times, aggregated_intensities = \
+        model.intensities_of_events_at_times(np.array([0., time_end]), sim_times, sim_events, sim_states)
+    before_events = np.searchsorted(np.array(aggregated_times), sim_times, side='left')  # first copy: before the jump
+    errors['recorded intensities'] = relative_error(intensities, aggregated_intensities[:, before_events])
+    residuals = model.compute_events_residuals(sim_times, sim_events, sim_states, 0)
+    compensator_errors = []
+    for e in range(d_e):
+        compensators_at_events = compensators[e, sim_events == e]
+        compensator_errors.append(relative_error(np.diff(compensators_at_events, prepend=0), residuals[e]))
+    errors['recorded compensators'] = max(compensator_errors)
+    'Chunked residuals'
+    values, offsets = model.compute_total_residuals(times, events, states, 0, compact=True)
+    chunks = list(model.iterate_total_residuals(times, events, states, 0, chunk_size=max(len(times) // 7, 1)))
+    chunk_errors = []
+    for mark in range(d_e * d_x):
+        chunked = np.concatenate([v[o[mark]:o[mark + 1]] for v, o in chunks])
+        if len(chunked) > 0:
+            chunk_errors.append(relative_error(chunked, values[offsets[mark]:offsets[mark + 1]]))
+    errors['chunked residuals'] = max(chunk_errors)
+    'Sparse and dense transition probabilities'
+    dense = model.estimate_transition_probabilities(events, states)
+    sparse = model.estimate_transition_probabilities(events, states, sparse=True)
+    errors['sparse transition probabilities'] = relative_error(sparse.toarray().reshape(dense.shape), dense)
+    return errors
+
+
+def run_estimation_checks(seed):
+    '''Returns the relative errors of the estimation checks, run once on a small model whose maximum likelihood
+    estimate is well inside the bounds'''
+    model = make_model(2, 3, seed)
+    times, events, states, time_end = simulate(model, 2000, seed)
+    d_e = model.number_of_event_types
+    d_x = model.number_of_states
+    np.random.seed(seed)
+    average_intensities = np.bincount(events, minlength=d_e) / time_end
+    errors = {}
+    '''Bounded second-order method: from the same random guesses, 'trust-constr' with the bounds converges every
+    time and its best optimum is at least as good as that of 'L-BFGS-B' (the likelihood can have several local
+    maxima, which are not errors)'''
+    optima = {'L-BFGS-B': [], 'trust-constr': []}
+    for _ in range(3):
+        guess = model.random_guess(average_intensities, np.ones((d_e, d_x, d_e)), 10 * np.ones((d_e, d_x, d_e)))
+        for method in optima:
+            o = model.estimate_hawkes_parameters(times, events, states, 0, time_end, method=method,
+                                                 given_guesses=[guess], number_of_random_guesses=0,
+                                                 maximum_number_of_iterations=2000)[0]
+            optima[method].append(o.fun if o.success else np.inf)
+    best_trust_constr = np.inf if np.inf in optima['trust-constr'] else min(optima['trust-constr'])
+    errors['bounded trust-constr'] = relative_error(best_trust_constr,
+                                                    min(optima['L-BFGS-B'] + optima['trust-constr']))
+    return errors
+
+
+def run_timings(model, times, events, states, time_end, repeat, seed):
+    'Returns the best time of each benchmarked method'
+    d_e = model.number_of_event_types
+    d_x = model.number_of_states
+    parameters = model.parameters_to_array(model.base_rates, model.impact_coefficients, model.decay_coefficients)
+    partial_parameters = model.parameters_to_array(model.base_rates[0:1], model.impact_coefficients[:, :, 0:1],
+                                                   model.decay_coefficients[:, :, 0:1])
+    structure = ParameterStructure(d_e, d_x, 'shared_across_states')
+    free_parameters = structure.full_to_free(parameters)
+    sparse_structure = ParameterStructure(d_e, d_x, impact_mask=sparse_impact_mask(d_e, d_x, seed))
+    sparse_parameters = sparse_structure.full_to_free(parameters)
+    ticks = to_ticks(times)
+    tick_end = to_ticks(time_end) + 1
+    benchmarks = [
+        ('log_likelihood_of_events',
+         lambda: model.log_likelihood_of_events(parameters, times, events, states, 0, time_end)),
+        ('gradient', lambda: model.gradient(parameters, times, events, states, 0, time_end)),
+        ('gradient (event by event decays)',
+         lambda: model.gradient(parameters, times, events, states, 0, time_end, block_size=0)),
+        ('log_likelihood_of_events (shared decays)',
+         lambda: model.log_likelihood_of_events(free_parameters, times, events, states, 0, time_end, structure)),
+        ('gradient (sparse kernels)',
+         lambda: model.gradient(sparse_parameters, times, events, states, 0, time_end, sparse_structure)),
+        ('gradient (tick times)',
+         lambda: model.gradient(parameters, ticks, events, states, EPOCH, tick_end, time_scale=TIME_SCALE)),
+        ('log_likelihood_of_events_partial',
+         lambda: model.log_likelihood_of_events_partial(0, partial_parameters, times, events, states, 0, time_end)),
+        ('gradient_partial',
+         lambda: model.gradient_partial(0, partial_parameters, times, events, states, 0, time_end)),
+        ('hessian_partial',
+         lambda: model.hessian_partial(0, partial_parameters, times, events, states, 0, time_end)),
+        ('simulate', lambda: model.simulate(0, 10 * time_end, max_number_of_events=len(times))),
+        ('compute_events_residuals', lambda: model.compute_events_residuals(times, events, states, 0)),
+        ('compute_total_residuals', lambda: model.compute_total_residuals(times, events, states, 0)),
+        ('intensities_of_events_at_times',
+         lambda: model.intensities_of_events_at_times(np.linspace(0, time_end, 1000), times, events, states)),
+        ('estimate_transition_probabilities', lambda: model.estimate_transition_probabilities(events, states)),
+    ]
+    timings = {}
+    np.random.seed(seed)
+    for name, function in benchmarks:
+        timings[name] = best_time(function, repeat)
+    # a full estimation is expensive, it is run once with a single random guess
+    np.random.seed(seed)
+    timings['estimate_hawkes_parameters'] = best_time(
+        lambda: model.estimate_hawkes_parameters(times, events, states, 0, time_end, number_of_random_guesses=1,
+                                                 maximum_number_of_iterations=100), 1)
+    np.random.seed(seed)
+    timings['estimate_hawkes_parameters_em'] = best_time(
+        lambda: model.estimate_hawkes_parameters_em(times, events, states, 0, time_end,
+                                                    maximum_number_of_iterations=100), 1)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--quick', action='store_true', help='run only the smallest configuration')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs per timing, the best is kept')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the models and sample paths')
+    parser.add_argument('--output', default=None, help='optional JSON file where the results are written')
+    arguments = parser.parse_args()
+    grid = QUICK_GRID if arguments.quick else GRID
+    results = []
+    failures = []
+    print('estimation d_e=2 d_x=3 N=2000')
+    for name, error in run_estimation_checks(arguments.seed).items():
+        status = 'ok' if error <= TOLERANCES[name] else 'FAILED'
+        if status == 'FAILED':
+            failures.append('estimation: ' + name)
+        print('    check {:<34}{:>12.1e} {}'.format(name, error, status))
+    for d_e, d_x, number_of_events in grid:
+        model = make_model(d_e, d_x, arguments.seed)
+        times, events, states, time_end = simulate(model, number_of_events, arguments.seed)
+        configuration = 'd_e={} d_x={} N={}'.format(d_e, d_x, len(times))
+        print(configuration)
+        timings = run_timings(model, times, events, states, time_end, arguments.repeat, arguments.seed)
+        for name, duration in timings.items():
+            print('    {:<40}{:>12.2f} ms'.format(name, 1000 * duration))
+        errors = run_checks(model, times, events, states, time_end, arguments.seed)
+        for name, error in errors.items():
+            status = 'ok' if error <= TOLERANCES[name] else 'FAILED'
+            if status == 'FAILED':
+                failures.append(configuration + ': ' + name)
+            print('    check {:<34}{:>12.1e} {}'.format(name, error, status))
+        results.append({'number_of_event_types': d_e, 'number_of_states': d_x, 'number_of_events': len(times),
+                        'timings': timings, 'errors': errors})
+    if arguments.output is not None:
+        with open(arguments.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if failures:
+        print('Failed checks:\n' + '\n'.join(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
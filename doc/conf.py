@@ -23,9 +23,9 @@ class Mock(MagicMock):
     def __getattr__(cls, name):
         return MagicMock()
 
-MOCK_MODULES = ['numpy', 'scipy', 'scipy.optimize', 'mpoints.hybrid_hawkes_exp_cython',
-                'matplotlib', 'matplotlib.pyplot', 'seaborn', 'statsmodels', 'statsmodels.tsa',
-                'statsmodels.tsa.stattools', 'matplotlib.colors']
+MOCK_MODULES = ['numpy', 'scipy', 'scipy.optimize', 'scipy.linalg', 'scipy.sparse', 'scipy.stats',
+                'mpoints.hybrid_hawkes_exp_cython', 'matplotlib', 'matplotlib.pyplot', 'seaborn',
+                'matplotlib.colors']
 sys.modules.update((mod_name, Mock()) for mod_name in MOCK_MODULES)
 
 # -- Project information -----------------------------------------------------
@@ -1 +1,11 @@
-name = "mpoints"
\ No newline at end of file
+name = "mpoints"
+
+_submodules = ['hybrid_hawkes_exp', 'plot_tools', 'diagnostics', 'instrumentation', 'parameter_structure']
+
+
+def __getattr__(attribute):
+    # submodules are imported on first access (e.g. mpoints.plot_tools) so that `import mpoints` stays cheap
+    if attribute in _submodules:
+        import importlib
+        return importlib.import_module('.' + attribute, __name__)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, attribute))
@@ -0,0 +1,361 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+def residuals_to_compact(residuals):
+    """
+    Converts residuals to the compact format `(values, offsets)` where the residuals of the `m` th mark are
+    `values[offsets[m]:offsets[m+1]]`.
+
+    :type residuals: list of 1D numpy arrays, or tuple of two 1D numpy arrays
+    :param residuals: one array of residuals per mark, as returned by
+                      :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.compute_events_residuals`
+                      or :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.compute_total_residuals`.
+                      A tuple is understood as residuals that are already in the compact format.
+    :rtype: tuple of two 1D numpy arrays
+    :return: the residuals in the compact format.
+    """
+    if isinstance(residuals, tuple):
+        values, offsets = residuals
+        return np.asarray(values, dtype=float), np.asarray(offsets, dtype=int)
+    lengths = [len(r) for r in residuals]
+    offsets = np.zeros(len(residuals) + 1, dtype=int)
+    offsets[1:] = np.cumsum(lengths)
+    if offsets[-1] == 0:
+        return np.zeros(0), offsets
+    values = np.concatenate([np.asarray(r, dtype=float) for r in residuals])
+    return values, offsets
+
+def autocorrelation(x, number_of_lags):
+    r"""
+    Computes the sample autocorrelation function of a series with a fast Fourier transform.
+
+    :type x: 1D numpy array
+    :param x: the series.
+    :type number_of_lags: int
+    :param number_of_lags: the largest lag :math:`h`.
+    :rtype: 1D numpy array
+    :return: the autocorrelations at lags :math:`0, 1, \dots, h` (NaN for the lags not smaller than the length
+             of the series).
+    """
+    x = np.asarray(x, dtype=float)
+    n = len(x)
+    result = np.full(number_of_lags + 1, np.nan)
+    if n < 2:
+        return result
+    y = x - np.mean(x)
+    size = 1 << int(np.ceil(np.log2(2 * n - 1)))  # zero-padding avoids circular correlations
+    transform = np.fft.rfft(y, size)
+    autocovariances = np.fft.irfft(transform * np.conj(transform), size)[:min(number_of_lags + 1, n)]
+    if autocovariances[0] > 0:
+        result[:len(autocovariances)] = autocovariances / autocovariances[0]
+    return result
+
+def goodness_of_fit(residuals, number_of_lags=20):
+    r"""
+    Computes, for each mark, statistics that test whether the residuals are i.i.d. standard exponential.
+    The Kolmogorov-Smirnov distance, the mean and the variance are vectorised across marks.
+
+    - Kolmogorov-Smirnov: distance between the empirical distribution and the standard exponential distribution,
+      with its exact p-value.
+    - Ljung-Box: :math:`Q = n(n+2)\sum_{k=1}^h \hat\rho_k^2/(n-k)`, compared to a chi-squared distribution
+      with :math:`h` degrees of freedom.
+    - Mean and variance: compared to 1 via the z-scores :math:`\sqrt{n}(\hat\mu - 1)` and
+      :math:`\sqrt{n/8}(\hat\sigma^2 - 1)` (the asymptotic variance of the sample variance of a standard
+      exponential distribution is 8/n).
+
+    :type residuals: list of 1D numpy arrays, or tuple of two 1D numpy arrays
+    :param residuals: one array of residuals per mark, or the compact format `(values, offsets)`,
+                      see :py:func:`~mpoints.diagnostics.residuals_to_compact`.
+    :type number_of_lags: int
+    :param number_of_lags: the number of lags :math:`h` used in the Ljung-Box test.
+    :rtype: dict
+    :return: a dictionary of 1D numpy arrays with one entry per mark, with keys 'number_of_residuals',
+             'mean', 'variance', 'mean_z_score', 'mean_p_value', 'variance_z_score', 'variance_p_value',
+             'ks_distance', 'ks_p_value', 'ljung_box' and 'ljung_box_p_value'. The statistics are NaN
+             for the marks that have too few residuals.
+    """
+    import scipy.stats
+    values, offsets = residuals_to_compact(residuals)
+    number_of_marks = len(offsets) - 1
+    counts = np.diff(offsets)
+    marks = np.repeat(np.arange(number_of_marks), counts)
+    n = counts.astype(float)
+    n[counts == 0] = np.nan
+    'Mean and variance'
+    mean = np.bincount(marks, weights=values, minlength=number_of_marks) / n
+    variance = np.bincount(marks, weights=(values - mean[marks])**2, minlength=number_of_marks) / (n - 1)
+    variance[counts < 2] = np.nan
+    mean_z_score = np.sqrt(n) * (mean - 1)
+    variance_z_score = np.sqrt(n / 8) * (variance - 1)
+    'Kolmogorov-Smirnov distance, the residuals are sorted within each mark'
+    order = np.lexsort((values, marks))
+    sorted_values = values[order]
+    ranks = np.arange(len(values)) - offsets[marks]
+    cdf = -np.expm1(-sorted_values)  # distribution function of the standard exponential distribution
+    deviations = np.maximum((ranks + 1) / n[marks] - cdf, cdf - ranks / n[marks])
+    ks_distance = np.zeros(number_of_marks)
+    np.maximum.at(ks_distance, marks, deviations)
+    ks_distance[counts == 0] = np.nan
+    ks_p_value = np.full(number_of_marks, np.nan)
+    valid = counts > 0
+    ks_p_value[valid] = scipy.stats.kstwo.sf(ks_distance[valid], counts[valid])
+    'Ljung-Box statistic'
+    ljung_box = np.full(number_of_marks, np.nan)
+    ljung_box_p_value = np.full(number_of_marks, np.nan)
+    for m in range(number_of_marks):
+        length = counts[m]
+        lags = min(number_of_lags, length - 1)
+        if lags < 1:
+            continue
+        rho = autocorrelation(values[offsets[m]:offsets[m+1]], lags)[1:]
+        if np.any(np.isnan(rho)):
+            continue
+        ljung_box[m] = length * (length + 2) * np.sum(rho**2 / (length - np.arange(1, lags + 1)))
+        ljung_box_p_value[m] = scipy.stats.chi2.sf(ljung_box[m], lags)
+    result = {}
+    result['number_of_residuals'] = counts
+    result['mean'] = mean
+    result['variance'] = variance
+    result['mean_z_score'] = mean_z_score
+    result['mean_p_value'] = 2 * scipy.stats.norm.sf(np.abs(mean_z_score))
+    result['variance_z_score'] = variance_z_score
+    result['variance_p_value'] = 2 * scipy.stats.norm.sf(np.abs(variance_z_score))
+    result['ks_distance'] = ks_distance
+    result['ks_p_value'] = ks_p_value
+    result['ljung_box'] = ljung_box
+    result['ljung_box_p_value'] = ljung_box_p_value
+    return result
+
+def cross_correlations(residuals, number_of_lags):
+    r"""
+    Computes the cross-correlation functions of all the pairs of residual series.
+    Each series is Fourier transformed once and every pairwise cross-correlation is derived from the cached
+    transforms, instead of computing one full cross-correlation function per pair.
+
+    The result coincides with `statsmodels.tsa.stattools.ccf(x, y, adjusted=True)` applied to the series
+    `x` and `y` truncated to their common length :math:`L`, that is,
+
+    .. math::
+
+        \hat\rho_{ij}(k) := \frac{1}{(L-k)\hat\sigma_i\hat\sigma_j}\sum_{t=0}^{L-1-k}(x^i_{t+k}-\hat\mu_i)(x^j_t-\hat\mu_j),
+
+    where the means :math:`\hat\mu` and standard deviations :math:`\hat\sigma` are computed on the first
+    :math:`L` terms. The truncation is accounted for with cumulative sums and at most `number_of_lags`
+    products per pair.
+
+    :type residuals: list of 1D numpy arrays, or tuple of two 1D numpy arrays
+    :param residuals: one array of residuals per mark, or the compact format `(values, offsets)`,
+                      see :py:func:`~mpoints.diagnostics.residuals_to_compact`.
+    :type number_of_lags: int
+    :param number_of_lags: the largest lag :math:`k`.
+    :rtype: 3D numpy array
+    :return: `result[i, j, k]` is :math:`\hat\rho_{ij}(k)`, NaN when :math:`k \geq L`.
+    """
+    values, offsets = residuals_to_compact(residuals)
+    dim = len(offsets) - 1
+    lengths = np.diff(offsets)
+    result = np.full((dim, dim, number_of_lags + 1), np.nan)
+    if dim == 0 or np.max(lengths) == 0:
+        return result
+    'Fourier transforms, the series are centred around their means to improve the accuracy'
+    size = 1 << int(np.ceil(np.log2(np.max(lengths) + number_of_lags + 1)))  # no circular overlap for lags <= number_of_lags
+    series = []
+    cumulative_sums = []
+    cumulative_sums_of_squares = []
+    transforms = np.zeros((dim, size // 2 + 1), dtype=complex)
+    for i in range(dim):
+        x = values[offsets[i]:offsets[i+1]]
+        if len(x) > 0:
+            x = x - np.mean(x)
+        series.append(x)
+        cumulative_sums.append(np.concatenate(([0.], np.cumsum(x))))
+        cumulative_sums_of_squares.append(np.concatenate(([0.], np.cumsum(x**2))))
+        transforms[i] = np.fft.rfft(x, size)
+    lags = np.arange(number_of_lags + 1)
+    for i in range(dim):
+        'Raw cross products sum_t x^i_{t+k} x^j_t of the full series, for all j at once'
+        products = np.fft.irfft(transforms[i] * np.conj(transforms), size, axis=1)[:, :number_of_lags + 1]
+        for j in range(dim):
+            length = min(lengths[i], lengths[j])
+            if length < 2:
+                continue
+            k = lags[lags < length]
+            x = series[i]
+            y = series[j]
+            raw = products[j, k]
+            if lengths[i] > length:
+                # remove the terms x^i_{t+k} x^j_t with t+k >= length, which the truncation excludes
+                for lag in k[1:]:
+                    raw[lag] -= np.dot(x[length:length + lag], y[length - lag:length])
+            'Means and standard deviations of the truncated series'
+            mean_x = cumulative_sums[i][length] / length
+            mean_y = cumulative_sums[j][length] / length
+            std_x = np.sqrt(max(cumulative_sums_of_squares[i][length] / length - mean_x**2, 0))
+            std_y = np.sqrt(max(cumulative_sums_of_squares[j][length] / length - mean_y**2, 0))
+            covariances = (raw - mean_y * (cumulative_sums[i][length] - cumulative_sums[i][k])
+                           - mean_x * cumulative_sums[j][length - k] + (length - k) * mean_x * mean_y) / (length - k)
+            result[i, j, k] = covariances / (std_x * std_y)
+    return result
+
+class QuantileSketch:
+    r"""
+    Mergeable fixed-bin summary of the distribution of residuals, one histogram per mark.
+
+    The bins are logarithmically spaced between `min_value` and `max_value`, with two additional bins for
+    the values below and above. Inside this range, the order statistics are therefore located with a relative
+    error of at most :math:`(\mbox{max_value}/\mbox{min_value})^{1/\mbox{number_of_bins}} - 1`.
+    Since the bins are fixed, the summaries of different chunks, days or processes are merged exactly by
+    adding their counts, so that the residuals never need to be held in memory at once.
+
+    :type number_of_marks: int
+    :param number_of_marks: the number of marks (e.g., event types or pairs (event type, state)).
+    :type min_value: float
+    :param min_value: the lower bound of the logarithmic bins.
+    :type max_value: float
+    :param max_value: the upper bound of the logarithmic bins.
+    :type number_of_bins: int
+    :param number_of_bins: the number of logarithmic bins.
+    """
+    def __init__(self, number_of_marks, min_value=1e-6, max_value=1e3, number_of_bins=2000):
+        self.number_of_marks = number_of_marks
+        self.edges = np.geomspace(min_value, max_value, number_of_bins + 1)
+        # counts[m, 0] counts the values below min_value and counts[m, -1] those not smaller than max_value
+        self.counts = np.zeros((number_of_marks, number_of_bins + 2), dtype=np.int64)
+        self.min_values = np.full(number_of_marks, np.inf)
+        self.max_values = np.full(number_of_marks, -np.inf)
+
+    def update(self, residuals):
+        """
+        Adds residuals to the summary.
+
+        :type residuals: list of 1D numpy arrays, or tuple of two 1D numpy arrays
+        :param residuals: one array of residuals per mark, or the compact format `(values, offsets)` such as
+                          the chunks generated by
+                          :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.iterate_total_residuals`.
+        """
+        values, offsets = residuals_to_compact(residuals)
+        if len(offsets) - 1 != self.number_of_marks:
+            raise ValueError('the residuals must have one entry per mark')
+        if len(values) == 0:
+            return
+        counts = np.diff(offsets)
+        marks = np.repeat(np.arange(self.number_of_marks), counts)
+        bins = np.searchsorted(self.edges, values, side='right')
+        number_of_columns = self.counts.shape[1]
+        self.counts += np.bincount(marks * number_of_columns + bins,
+                                   minlength=self.counts.size).reshape(self.counts.shape)
+        valid = counts > 0
+        self.min_values[valid] = np.minimum(self.min_values[valid], np.minimum.reduceat(values, offsets[:-1][valid]))
+        self.max_values[valid] = np.maximum(self.max_values[valid], np.maximum.reduceat(values, offsets[:-1][valid]))
+
+    def merge(self, other):
+        """
+        Adds the content of another summary with the same bins to this summary.
+
+        :type other: :py:class:`~mpoints.diagnostics.QuantileSketch`
+        :param other: the summary to merge.
+        :rtype: :py:class:`~mpoints.diagnostics.QuantileSketch`
+        :return: this summary, after the merge.
+        """
+        if self.counts.shape != other.counts.shape or not np.array_equal(self.edges, other.edges):
+            raise ValueError('the sketches must have the same marks and bins')
+        self.counts += other.counts
+        self.min_values = np.minimum(self.min_values, other.min_values)
+        self.max_values = np.maximum(self.max_values, other.max_values)
+        return self
+
+    def quantile(self, quantile_levels):
+        """
+        Approximates the quantiles of the residuals of each mark.
+        Inside a bin, the quantile is interpolated geometrically (linearly in the underflow and overflow bins).
+
+        :type quantile_levels: 1D array of float
+        :param quantile_levels: the quantile levels, between 0 and 1.
+        :rtype: 2D numpy array
+        :return: `result[m, k]` is the approximate quantile of level `quantile_levels[k]` of the `m` th mark
+                 (NaN if this mark has no residuals).
+        """
+        quantile_levels = np.atleast_1d(np.asarray(quantile_levels, dtype=float))
+        result = np.full((self.number_of_marks, len(quantile_levels)), np.nan)
+        lower_edges = np.concatenate(([0.], self.edges))
+        upper_edges = np.concatenate((self.edges, [np.inf]))
+        for m in range(self.number_of_marks):
+            cumulative_counts = np.cumsum(self.counts[m])
+            total = cumulative_counts[-1]
+            if total == 0:
+                continue
+            ranks = quantile_levels * (total - 1) + 0.5  # position of the quantile among the ordered residuals
+            bins = np.minimum(np.searchsorted(cumulative_counts, ranks, side='left'), len(cumulative_counts) - 1)
+            previous_counts = cumulative_counts[bins] - self.counts[m, bins]
+            fractions = np.clip((ranks - previous_counts) / np.maximum(self.counts[m, bins], 1), 0, 1)
+            # the observed extreme values give tighter bounds than the edges
+            lows = np.maximum(lower_edges[bins], self.min_values[m])
+            highs = np.minimum(upper_edges[bins], self.max_values[m])
+            geometric = (lows > 0) & (bins > 0) & (bins < len(cumulative_counts) - 1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                result[m] = np.where(geometric, lows * (highs / lows)**fractions, lows + (highs - lows) * fractions)
+        return result
+
+def sketch_residuals(residuals_chunks, number_of_marks, min_value=1e-6, max_value=1e3, number_of_bins=2000):
+    """
+    Summarises residuals computed by chunks in a single streaming pass.
+
+    :type residuals_chunks: iterable
+    :param residuals_chunks: chunks of residuals, e.g., the generator returned by
+                             :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.iterate_events_residuals` or
+                             :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.iterate_total_residuals`.
+    :type number_of_marks: int
+    :param number_of_marks: the number of marks.
+    :type min_value: float
+    :param min_value: the lower bound of the logarithmic bins.
+    :type max_value: float
+    :param max_value: the upper bound of the logarithmic bins.
+    :type number_of_bins: int
+    :param number_of_bins: the number of logarithmic bins.
+    :rtype: :py:class:`~mpoints.diagnostics.QuantileSketch`
+    :return: the summary of all the residuals.
+    """
+    sketch = QuantileSketch(number_of_marks, min_value, max_value, number_of_bins)
+    for chunk in residuals_chunks:
+        sketch.update(chunk)
+    return sketch
+
+def empirical_quantiles(residuals, quantile_levels):
+    """
+    Computes the empirical quantiles of the residuals of each mark.
+
+    :type residuals: list of 1D numpy arrays, tuple of two 1D numpy arrays or QuantileSketch
+    :param residuals: one array of residuals per mark, the compact format `(values, offsets)` or a summary.
+    :type quantile_levels: 1D array of float
+    :param quantile_levels: the quantile levels, between 0 and 1.
+    :rtype: 2D numpy array
+    :return: `result[m, k]` is the quantile of level `quantile_levels[k]` of the `m` th mark.
+    """
+    if isinstance(residuals, QuantileSketch):
+        return residuals.quantile(quantile_levels)
+    values, offsets = residuals_to_compact(residuals)
+    result = np.full((len(offsets) - 1, len(quantile_levels)), np.nan)
+    for m in range(len(offsets) - 1):
+        if offsets[m+1] > offsets[m]:
+            result[m] = np.percentile(values[offsets[m]:offsets[m+1]], 100 * np.asarray(quantile_levels))
+    return result
+
+def goodness_of_fit_batch(residuals, number_of_lags=20, number_of_processes=1):
+    """
+    Computes :py:func:`~mpoints.diagnostics.goodness_of_fit` for many models (or days) at once.
+    Within a model, the statistics are vectorised across marks; the models are distributed across processes.
+
+    :type residuals: list
+    :param residuals: one element per model, in any format accepted by
+                      :py:func:`~mpoints.diagnostics.goodness_of_fit`.
+    :type number_of_lags: int
+    :param number_of_lags: the number of lags used in the Ljung-Box test.
+    :type number_of_processes: int
+    :param number_of_processes: the number of worker processes; if 1, everything is computed in the current process.
+    :rtype: list of dict
+    :return: the statistics of each model, in the same order as `residuals`.
+    """
+    if number_of_processes == 1 or len(residuals) < 2:
+        return [goodness_of_fit(r, number_of_lags) for r in residuals]
+    with ProcessPoolExecutor(max_workers=number_of_processes) as executor:
+        return list(executor.map(goodness_of_fit, residuals, [number_of_lags] * len(residuals)))
@@ -2,8 +2,13 @@ import numpy as np
 import math
 import copy
 import bisect
-import scipy.optimize as opt
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
 from . import hybrid_hawkes_exp_cython as cy
+# scipy.optimize, scipy.linalg and scipy.sparse are imported by the methods that need them,
+# so that processes that only simulate or evaluate likelihoods do not pay for these imports
 
 class HybridHawkesExp:
     """
@@ -49,14 +54,25 @@ class HybridHawkesExp:
         The are used to :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.simulate` and
         :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.compute_total_residuals`.
 
-        :type transition_probabilities: 3D numpy array
+        :type transition_probabilities: 3D numpy array or scipy sparse matrix
         :param transition_probabilities: shape should be :math:`(d_x, d_e,d_x)` where :math:`d_e` and :math:`d_x`
                                          are the number of event types and states, respectively.
                                          The entry :math:`i, j, k` is the probability of going from state :math:`i`
                                          to state :math:`k` when an event of type :math:`j` occurs.
+                                         When there are many states, a scipy sparse matrix of shape
+                                         :math:`(d_x d_e, d_x)` can be given instead, whose entry
+                                         :math:`i d_e + j, k` is the probability above. It is stored in compressed
+                                         sparse row format and the memory and computational costs then scale with
+                                         the number of nonzero transition probabilities.
         :return:
         """
         'Raise ValueError if the given parameters do not have the right shape'
+        if hasattr(transition_probabilities, 'tocsr'):  # scipy sparse matrix
+            if np.shape(transition_probabilities) != (self.number_of_states * self.number_of_event_types,
+                                                      self.number_of_states):
+                raise ValueError('given transition probabilities have incorrect shape')
+            self.transition_probabilities = transition_probabilities.tocsr(copy=True)
+            return
         if np.shape(transition_probabilities) != (self.number_of_states, self.number_of_event_types,
                                                   self.number_of_states):
             raise ValueError('given transition probabilities have incorrect shape')
@@ -108,9 +124,199 @@ class HybridHawkesExp:
         """
         return alpha * np.exp(- np.multiply(time, beta))
 
+    def transition_probabilities_csr(self):
+        r"""
+        Returns the transition probabilities :math:`\phi` in compressed sparse row format, whatever the format in which
+        they were set. The row :math:`x d_e + e` contains the probabilities :math:`\phi_e(x, \cdot)`.
+        This is the format used by the C implementation of the simulation and of the total residuals.
+
+        :rtype: 1D numpy array of int, 1D numpy array of int, 1D numpy array of float
+        :return: the row pointers, the column indices (next states) and the nonzero probabilities.
+        """
+        if hasattr(self.transition_probabilities, 'tocsr'):  # scipy sparse matrix
+            matrix = self.transition_probabilities.tocsr()
+            return matrix.indptr.astype(np.int64), matrix.indices.astype(np.int64), matrix.data.astype(np.float64)
+        dense = np.reshape(self.transition_probabilities,
+                           (self.number_of_states * self.number_of_event_types, self.number_of_states))
+        rows, indices = np.nonzero(dense)
+        indptr = np.zeros(len(dense) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(np.bincount(rows, minlength=len(dense)))
+        return indptr, indices.astype(np.int64), dense[rows, indices].astype(np.float64)
+
+    'Stability'
+
+    def stationary_distribution_of_states(self, event_weights=None):
+        r"""
+        Computes the stationary distribution of the state process when the event types are drawn independently with
+        the given weights, that is, the stationary distribution of the transition matrix
+        :math:`\sum_e w_e \phi_e`.
+
+        :type event_weights: 1D numpy array of float
+        :param event_weights: one non-negative weight per event type, they are normalised to sum to one.
+                              By default, the weights are proportional to the base rates :math:`\nu`.
+        :rtype: 1D numpy array of float
+        :return: `array[x]` is the stationary probability of the state `x`.
+                 It is uniform if the transition probabilities have not been set.
+        """
+        if event_weights is None:
+            event_weights = self.base_rates
+        if np.sum(event_weights) <= 0:
+            event_weights = np.ones(self.number_of_event_types)
+        event_weights = np.divide(event_weights, np.sum(event_weights))
+        indptr, indices, data = self.transition_probabilities_csr()
+        rows = np.repeat(np.arange(self.number_of_states * self.number_of_event_types), np.diff(indptr))
+        transition_matrix = np.zeros((self.number_of_states, self.number_of_states))
+        np.add.at(transition_matrix, (rows // self.number_of_event_types, indices),
+                  data * event_weights[rows % self.number_of_event_types])
+        if not np.all(np.isclose(np.sum(transition_matrix, axis=1), 1)):
+            return np.ones(self.number_of_states) / self.number_of_states
+        'Solve p (P - I) = 0 under the constraint that p sums to one'
+        a = np.vstack((np.transpose(transition_matrix) - np.eye(self.number_of_states),
+                       np.ones((1, self.number_of_states))))
+        b = np.zeros(self.number_of_states + 1)
+        b[-1] = 1
+        result = np.linalg.lstsq(a, b, rcond=None)[0]
+        result = np.maximum(result, 0)
+        return result / np.sum(result)
+
+    @staticmethod
+    def branching_matrix(impact_coefficients, decay_coefficients, states_after_events):
+        r"""
+        Computes the branching matrix
+
+        .. math::
+
+            K_{e'e} := \sum_x \pi_{e'}(x) \frac{\alpha_{e'xe}}{\beta_{e'xe}},
+
+        where :math:`\pi_{e'}(x)` is the probability that the state is `x` right after an event of type `e'`.
+        :math:`K_{e'e}` is the average number of events of type `e` that are directly triggered by an event of type
+        `e'`. The process is stable when the spectral radius of :math:`K` is smaller than one.
+
+        :type impact_coefficients: 3D numpy array
+        :param impact_coefficients: the alphas :math:`\alpha_{e'xe}`.
+        :type decay_coefficients: 3D numpy array
+        :param decay_coefficients: the betas :math:`\beta_{e'xe}`.
+        :type states_after_events: 2D numpy array
+        :param states_after_events: `array[e', x]` is :math:`\pi_{e'}(x)`.
+        :rtype: 2D numpy array
+        :return: the branching matrix, `array[e', e]` is :math:`K_{e'e}`.
+        """
+        return np.einsum('ex,exk->ek', states_after_events, np.divide(impact_coefficients, decay_coefficients))
+
+    @property
+    def branching_ratio(self):
+        r"""
+        The spectral radius of the branching matrix :math:`K` (see
+        :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.branching_matrix`), where the distribution of the state
+        right after an event of type `e'` is :math:`\pi_{e'}(x) = \sum_y p(y)\phi_{e'}(y, x)` and :math:`p` is given by
+        :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.stationary_distribution_of_states`.
+        The process is supercritical (explosive) when the branching ratio is greater than or equal to one.
+
+        :rtype: float
+        """
+        stationary_distribution = self.stationary_distribution_of_states()
+        indptr, indices, data = self.transition_probabilities_csr()
+        rows = np.repeat(np.arange(self.number_of_states * self.number_of_event_types), np.diff(indptr))
+        states_after_events = np.zeros((self.number_of_event_types, self.number_of_states))
+        np.add.at(states_after_events, (rows % self.number_of_event_types, indices),
+                  data * stationary_distribution[rows // self.number_of_event_types])
+        if np.sum(states_after_events) == 0:  # transition probabilities have not been set
+            states_after_events = np.ones((self.number_of_event_types, self.number_of_states)) / self.number_of_states
+        k = self.branching_matrix(self.impact_coefficients, self.decay_coefficients, states_after_events)
+        return np.max(np.abs(np.linalg.eigvals(k)))
+
+    @staticmethod
+    def stability_penalty(impact_coefficients, decay_coefficients, states_after_events, weight,
+                          max_branching_ratio=1):
+        r"""
+        Computes a penalty on the parameters that makes the process supercritical, along with its gradient.
+        The penalty is
+
+        .. math::
+
+            w \sum_e \Big(\max\big(\sum_{e'} K_{e'e} - \rho, 0\big)\Big)^2,
+
+        where :math:`K` is the branching matrix. Since the spectral radius of :math:`K` is bounded by its largest
+        column sum, the penalty vanishes on a set of parameters whose branching ratio is at most :math:`\rho`.
+        It only involves the parameters of one event type `e` per term, so that it can be added to the partial
+        log-likelihoods.
+
+        :type impact_coefficients: 3D numpy array
+        :param impact_coefficients: the alphas :math:`\alpha_{e'xe}`, the third dimension can be restricted to a subset
+                                    of event types `e`.
+        :type decay_coefficients: 3D numpy array
+        :param decay_coefficients: the betas :math:`\beta_{e'xe}`, with the same shape as `impact_coefficients`.
+        :type states_after_events: 2D numpy array
+        :param states_after_events: `array[e', x]` is the probability that the state is `x` right after an event of
+                                    type `e'`.
+        :type weight: float
+        :param weight: the weight :math:`w` of the penalty.
+        :type max_branching_ratio: float
+        :param max_branching_ratio: the threshold :math:`\rho`.
+        :rtype: float, 3D numpy array, 3D numpy array
+        :return: the penalty and its gradients with respect to :math:`\alpha` and :math:`\beta`.
+        """
+        ratios = np.divide(impact_coefficients, decay_coefficients)
+        column_sums = np.einsum('ex,exk->k', states_after_events, ratios)
+        excess = np.maximum(column_sums - max_branching_ratio, 0)
+        penalty = weight * np.sum(np.square(excess))
+        gradient_impact_coefficients = np.divide(states_after_events[:, :, np.newaxis] * 2 * weight * excess,
+                                                 decay_coefficients)
+        gradient_decay_coefficients = - gradient_impact_coefficients * ratios
+        return penalty, gradient_impact_coefficients, gradient_decay_coefficients
+
+    @staticmethod
+    def stability_penalty_hessian(impact_coefficients, decay_coefficients, states_after_events, weight,
+                                  max_branching_ratio=1):
+        r"""
+        Computes the Hessian of the penalty given by
+        :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.stability_penalty`.
+
+        :type impact_coefficients: 3D numpy array
+        :param impact_coefficients: the alphas :math:`\alpha_{e'xe}`, the third dimension can be restricted to a subset
+                                    of event types `e`.
+        :type decay_coefficients: 3D numpy array
+        :param decay_coefficients: the betas :math:`\beta_{e'xe}`, with the same shape as `impact_coefficients`.
+        :type states_after_events: 2D numpy array
+        :param states_after_events: `array[e', x]` is the probability that the state is `x` right after an event of
+                                    type `e'`.
+        :type weight: float
+        :param weight: the weight :math:`w` of the penalty.
+        :type max_branching_ratio: float
+        :param max_branching_ratio: the threshold :math:`\rho`.
+        :rtype: 2D numpy array
+        :return: the Hessian of the penalty, the rows and columns are ordered as in
+                 :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.parameters_to_array` (the base rates have no
+                 effect on the penalty).
+        """
+        number_of_event_types_1, number_of_states, number_of_event_types_2 = np.shape(impact_coefficients)
+        dimension = number_of_event_types_2 + 2 * number_of_event_types_1 * number_of_states * number_of_event_types_2
+        v, impact_indices, decay_indices = HybridHawkesExp.array_to_parameters(
+            np.arange(dimension), number_of_event_types_1, number_of_states, number_of_event_types_2)
+        ratios = np.divide(impact_coefficients, decay_coefficients)
+        column_sums = np.einsum('ex,exk->k', states_after_events, ratios)
+        excess = np.maximum(column_sums - max_branching_ratio, 0)
+        result = np.zeros((dimension, dimension))
+        for k in range(number_of_event_types_2):
+            if excess[k] == 0:
+                continue
+            'Gradient and Hessian of the column sum k, which only depends on the parameters of the column k'
+            alpha = impact_coefficients[:, :, k].ravel()
+            beta = decay_coefficients[:, :, k].ravel()
+            pi = states_after_events.ravel()
+            indices = np.concatenate([impact_indices[:, :, k].ravel(), decay_indices[:, :, k].ravel()]).astype(int)
+            g = np.concatenate([pi / beta, - pi * alpha / beta**2])
+            h = np.outer(g, g)
+            size = len(alpha)
+            h[np.arange(size), size + np.arange(size)] -= excess[k] * pi / beta**2
+            h[size + np.arange(size), np.arange(size)] -= excess[k] * pi / beta**2
+            h[size + np.arange(size), size + np.arange(size)] += excess[k] * 2 * pi * alpha / beta**3
+            result[np.ix_(indices, indices)] += 2 * weight * h
+        return result
+
     'Functions that estimate the model parameters'
 
-    def estimate_transition_probabilities(self, events, states):
+    def estimate_transition_probabilities(self, events, states, sparse=False):
         r"""
         Estimates the transition probabilities :math:`\phi` of the state process from the data.
         This method returns the maximum likelihood estimate.
@@ -120,34 +326,88 @@ class HybridHawkesExp:
         :param events: the sequence of event types, `events[n]` is the event type of the `n` th event.
         :type states: 1D array of int
         :param states: the sequence of states, `states[n]` is the new state of the system following the `n` th event.
-        :rtype: 3D array
+        :type sparse: boolean
+        :param sparse: set to True to obtain the estimate as a scipy sparse matrix of shape :math:`(d_x d_e, d_x)`
+                       in compressed sparse row format (see
+                       :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.set_transition_probabilities`).
+                       Only the observed transitions are then stored.
+        :rtype: 3D array or scipy sparse matrix
         :return: the estimated transition probabilities :math:`\phi`.
         """
-        result = np.zeros((self.number_of_states, self.number_of_event_types, self.number_of_states))
-        count_of_states_events = np.zeros((self.number_of_states, self.number_of_event_types))
-        for n in range(1, len(events)):
-            event = events[n]
-            state_before = states[n - 1]
-            state_after = states[n]
-            count_of_states_events[state_before, event] += 1
-            result[state_before, event, state_after] += 1
-        for x1 in range(self.number_of_states):
-            for e in range(self.number_of_event_types):
-                size = count_of_states_events[x1, e]
-                if size > 0:
-                    for x2 in range(self.number_of_states):
-                        result[x1, e, x2] /= size
-                else:
-                    message = 'Warning: Transition probabilities from state ' + str(x1)
-                    message += ' when events of type ' + str(e) + ' occur cannot be estimated because'
-                    message += ' events of this type never occur this state'
-                    print(message)
-        return result
+        import scipy.sparse
+        events = np.asarray(events, dtype=np.int64)
+        states = np.asarray(states, dtype=np.int64)
+        'Count the transitions, the row x1 * d_e + e corresponds to events of type e occurring in state x1'
+        rows = states[:-1] * self.number_of_event_types + events[1:]
+        counts = scipy.sparse.coo_matrix((np.ones(len(rows)), (rows, states[1:])),
+                                         shape=(self.number_of_states * self.number_of_event_types,
+                                                self.number_of_states)).tocsr()
+        count_of_states_events = np.asarray(counts.sum(axis=1)).ravel()
+        for row in np.nonzero(count_of_states_events == 0)[0]:
+            message = 'Warning: Transition probabilities from state ' + str(row // self.number_of_event_types)
+            message += ' when events of type ' + str(row % self.number_of_event_types) + ' occur cannot be estimated'
+            message += ' because events of this type never occur this state'
+            print(message)
+        'Normalise the rows'
+        sizes = np.repeat(count_of_states_events, np.diff(counts.indptr))
+        counts.data = np.divide(counts.data, sizes)
+        if sparse:
+            return counts
+        return np.reshape(counts.toarray(), (self.number_of_states, self.number_of_event_types,
+                                             self.number_of_states))
+
+    def random_guess(self, average_intensities, min_decay_coefficients, max_decay_coefficients):
+        r"""
+        Generates a random guess of the parameters :math:`(\nu, \alpha, \beta)`, as in
+        :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.estimate_hawkes_parameters`.
+        The base rates are half the average intensities, the decay coefficients :math:`\beta_{e'xe}` are drawn uniformly
+        on a logarithmic scale and the impact coefficients :math:`\alpha_{e'xe}` uniformly in
+        :math:`[0, \beta_{e'xe}]`.
+
+        :type average_intensities: 1D numpy array
+        :param average_intensities: the average intensity of each event type.
+        :type min_decay_coefficients: 3D numpy array
+        :param min_decay_coefficients: lower bounds of the intervals in which the decay coefficients are drawn.
+        :type max_decay_coefficients: 3D numpy array
+        :param max_decay_coefficients: upper bounds of the intervals in which the decay coefficients are drawn.
+        :rtype: 1D numpy array
+        :return: the random guess put into a single array.
+        """
+        'Base rates'
+        guess_base_rates = np.zeros(self.number_of_event_types)
+        for e in range(self.number_of_event_types):
+            guess_base_rates[e] = average_intensities[e] / 2
+        'Decay coefficients'
+        guess_decay_coefficients = np.zeros((self.number_of_event_types, self.number_of_states,
+                                             self.number_of_event_types))
+        for e1 in range(self.number_of_event_types):
+            for x in range(self.number_of_states):
+                for e2 in range(self.number_of_event_types):
+                    u_min = math.log10(min_decay_coefficients[e1, x, e2])
+                    u_max = math.log10(max_decay_coefficients[e1, x, e2])
+                    u = np.random.uniform(u_min, u_max)
+                    beta = 10 ** u
+                    guess_decay_coefficients[e1, x, e2] = beta
+        'Impact coefficients'
+        guess_impact_coefficients = np.zeros((self.number_of_event_types, self.number_of_states,
+                                              self.number_of_event_types))
+        for e1 in range(self.number_of_event_types):
+            for x in range(self.number_of_states):
+                for e2 in range(self.number_of_event_types):
+                    u = np.random.uniform(0, 1)
+                    alpha = u * guess_decay_coefficients[e1, x, e2]
+                    guess_impact_coefficients[e1, x, e2] = alpha
+        return HybridHawkesExp.parameters_to_array(guess_base_rates, guess_impact_coefficients,
+                                                   guess_decay_coefficients)
 
     def estimate_hawkes_parameters(self, times, events, states, time_start, time_end, maximum_number_of_iterations=2000,
                                    method='TNC', parameters_lower_bound=10**(-6), parameters_upper_bound=None,
                                    given_guesses=[], number_of_random_guesses=1,
-                                   min_decay_coefficient=0.5, max_decay_coefficient=100, parallel_estimation=True):
+                                   min_decay_coefficient=0.5, max_decay_coefficient=100, parallel_estimation=True,
+                                   stability_penalty_weight=0, max_branching_ratio=1, monitor=None,
+                                   checkpoint_file=None, checkpoint_interval=60, fisher_information=True,
+                                   number_of_em_iterations=0, reparametrisation=None, structure=None,
+                                   time_scale=None):
         r"""
         Estimates the parameters of the intensities (arrival rates) of events, i.e., :math:`(\nu, \alpha, \beta)`.
         Estimation if performed via maximum likelihood. This method uses the `scipy.minimize` library.
@@ -169,6 +429,14 @@ class HybridHawkesExp:
                                               function evaluations.
         :type method: string
         :param method: the optimisation method used in `scipy.minimize`.
+                       The exact Hessian of the log-likelihood is passed to the methods that use second-order
+                       information ('Newton-CG', 'dogleg', 'trust-ncg', 'trust-krylov', 'trust-exact' and
+                       'trust-constr'); among them, only 'trust-constr' handles the bounds on the parameters.
+                       Its iterates can leave the bounds and it stalls with the exact Hessian with respect to
+                       :math:`(\nu, \alpha, \beta)`, so, without `reparametrisation`, it works on
+                       :math:`(\log \nu, \log \alpha, \log \beta)` with the logarithms of the bounds, as with
+                       `reparametrisation` 'log': the result then also contains 'reparametrised_x' and its other
+                       entries, e.g., 'jac', refer to the logarithms.
         :type parameters_lower_bound: float
         :param parameters_lower_bound: lower bound on all the parameters.
         :type parameters_upper_bound: float
@@ -193,13 +461,86 @@ class HybridHawkesExp:
                                     problems, where :math:`d_e` is the number of event types. When True, each problem
                                     is solved independently. In this case, the limit on the number of iterations
                                     or function evaluations is applied independently to each sub-problem.
+        :type stability_penalty_weight: float
+        :param stability_penalty_weight: when positive, the penalty given by
+                                         :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.stability_penalty` is
+                                         added to the minus log-likelihood, which keeps the optimiser away from
+                                         supercritical (explosive) parameters. The distribution of the state after
+                                         each event type is estimated from the data.
+        :type max_branching_ratio: float
+        :param max_branching_ratio: the penalty vanishes when the branching ratio is guaranteed to be at most this
+                                    value.
+        :type monitor: :py:class:`~mpoints.instrumentation.EstimationMonitor`
+        :param monitor: when given, the evaluations of the likelihood and of its gradient are counted and timed, and
+                        the progress of the optimiser is reported at every iteration of every sub-problem.
+        :type checkpoint_file: string
+        :param checkpoint_file: path of a file where the progress of the estimation is saved, see
+                                :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.save_checkpoint`.
+                                The checkpoint contains the initial guesses, the results of the completed
+                                sub-problems ((event type, initial guess) pairs when the estimation is parallel)
+                                and the current iterate of the running ones.
+                                If the file already exists, the estimation is resumed: the saved guesses are used,
+                                the completed sub-problems are not optimised again and the interrupted ones restart
+                                from their last saved iterate (with a new budget of iterations).
+                                Delete the file to start from scratch. A ValueError is raised if the file was
+                                saved for other data or other estimation settings, see
+                                :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.checkpoint_digest`.
+        :type checkpoint_interval: float
+        :param checkpoint_interval: the minimum number of seconds between two checkpoints during the optimisation
+                                    of a sub-problem. A checkpoint is also saved when a sub-problem is completed.
+        :type fisher_information: boolean
+        :param fisher_information: set to True to add the observed Fisher information, i.e., minus the Hessian of the
+                                   log-likelihood at the estimate (see
+                                   :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.hessian`), and the
+                                   resulting standard errors of the parameters to the optimisation result, under
+                                   the keys 'fisher_information' and 'standard_errors'.
+        :type number_of_em_iterations: int
+        :param number_of_em_iterations: when positive, every initial guess is first improved by this number of
+                                        iterations of the EM algorithm, see
+                                        :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.estimate_hawkes_parameters_em`.
+                                        The returned initial guess is the improved one.
+        :type reparametrisation: string
+        :param reparametrisation: when given, the optimiser works on unconstrained variables instead of
+                                  :math:`(\nu, \alpha, \beta)`, see
+                                  :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.reparametrise`:
+                                  'log' for :math:`(\log \nu, \log \alpha, \log \beta)` and 'log_ratio' for
+                                  :math:`(\log \nu, \log (\alpha / \beta), \log \beta)`.
+                                  The bounds are then ignored, so that any unconstrained method of `scipy.minimize`
+                                  can be used, e.g., 'BFGS', 'Newton-CG' or 'trust-exact'.
+                                  The optimisation result contains the estimate of :math:`(\nu, \alpha, \beta)` in
+                                  'x' and the optimal variables in 'reparametrised_x'; the other entries, e.g., 'jac',
+                                  refer to the variables.
+        :type structure: :py:class:`~mpoints.parameter_structure.ParameterStructure`
+        :param structure: when given, only the free parameters of this structure are estimated, the other
+                          parameters being tied or fixed at zero.
+                          The initial guesses are projected onto the structure (after the EM iterations, which do not
+                          take the structure into account) and the optimisation result contains all the
+                          parameters in 'x' and the free parameters in 'free_x'; the other entries, e.g., 'jac' and
+                          'fisher_information', refer to the free parameters.
+                          The estimation can be parallel only if the tied decay coefficients govern the intensity of
+                          a single event type, and the 'log_ratio' reparametrisation is not available.
+        :type time_scale: float
+        :param time_scale: when given, the times are integer numbers of ticks and `time_scale` is the duration of a
+                           tick, see :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.tick_times`.
+                           The parameters are expressed in the unit of time of `time_scale`.
         :rtype: scipy.optimize.OptimizerResult, 1D numpy array, string
         :return: The first object is the optimisation result and contains the maximum likelihood estimate along with
                  additional information on the optimisation routine. The second object contains the initial guess
                  that resulted in the highest likelihood after running the optimisation procedure.
                  The third object indicates the nature of this initial guess ('random' or 'given').
         """
-
+        import scipy.optimize as opt
+
+        if reparametrisation not in [None, 'log', 'log_ratio']:
+            raise ValueError('unknown reparametrisation ' + str(reparametrisation))
+        if structure is not None:
+            if parallel_estimation and structure.ties_event_types:
+                raise ValueError('the structure ties parameters of different event types, '
+                                 'the estimation cannot be parallel')
+            if reparametrisation == 'log_ratio':
+                raise ValueError('the log_ratio reparametrisation cannot be used with a structure')
+        'In tick mode, the EM algorithm works on the times converted to floats'
+        float_times, float_time_start, float_time_end = self.tick_times(times, time_start, time_end, time_scale)[0:3]
         'Generate additional random guesses of the parameters'
         guesses = copy.copy(given_guesses)
         if np.shape(min_decay_coefficient) == ():  # if a scalar was given instead of a matrix
@@ -214,54 +555,179 @@ class HybridHawkesExp:
             for n in range(len(times)):
                 e = events[n]
                 average_intensities[e] += 1
-            average_intensities = np.divide(average_intensities, time_end - time_start)
+            average_intensities = np.divide(average_intensities, float_time_end - float_time_start)
             for n in range(number_of_random_guesses):
-                'Base rates'
-                guess_base_rates = np.zeros(self.number_of_event_types)
-                for e in range(self.number_of_event_types):
-                    guess_base_rates[e] = average_intensities[e] / 2
-                'Decay coefficients'
-                guess_decay_coefficients = np.zeros((self.number_of_event_types, self.number_of_states,
-                                                     self.number_of_event_types))
-                for e1 in range(self.number_of_event_types):
-                    for x in range(self.number_of_states):
-                        for e2 in range(self.number_of_event_types):
-                            u_min = math.log10(min_decay_coefficients[e1, x, e2])
-                            u_max = math.log10(max_decay_coefficients[e1, x, e2])
-                            u = np.random.uniform(u_min, u_max)
-                            beta = 10 ** u
-                            guess_decay_coefficients[e1, x, e2] = beta
-                'Impact coefficients'
-                guess_impact_coefficients = np.zeros((self.number_of_event_types, self.number_of_states,
-                                                      self.number_of_event_types))
-                for e1 in range(self.number_of_event_types):
-                    for x in range(self.number_of_states):
-                        for e2 in range(self.number_of_event_types):
-                            u = np.random.uniform(0, 1)
-                            alpha = u * guess_decay_coefficients[e1, x, e2]
-                            guess_impact_coefficients[e1, x, e2] = alpha
-                'Save the random guess to the list of guesses'
-                g = HybridHawkesExp.parameters_to_array(guess_base_rates, guess_impact_coefficients,
-                                                        guess_decay_coefficients)
-                guesses.append(g)
+                guesses.append(self.random_guess(average_intensities, min_decay_coefficients,
+                                                 max_decay_coefficients))
+
+        'Load the checkpoint if there is one'
+        checkpoint = None
+        '''The checkpoint must have been saved for the same data and the same estimation settings; the random guesses
+        are drawn again at every call, so only their number enters the problem'''
+        problem = (self.number_of_event_types, self.number_of_states, len(times), bool(parallel_estimation),
+                   len(guesses), time_scale, method, reparametrisation, stability_penalty_weight,
+                   max_branching_ratio, number_of_random_guesses, number_of_em_iterations,
+                   self.checkpoint_digest(times, events, states, time_start, time_end, *given_guesses,
+                                          parameters_lower_bound, parameters_upper_bound, min_decay_coefficient,
+                                          max_decay_coefficient))
+        if structure is not None:
+            problem += (structure.number_of_free_parameters,
+                        self.checkpoint_digest(structure.free_indices, structure.fixed_values))
+        if checkpoint_file is not None:
+            checkpoint = self.load_checkpoint(checkpoint_file)
+        if checkpoint is not None:
+            if checkpoint['problem'] != problem:
+                raise ValueError('the checkpoint ' + checkpoint_file + ' was saved for another estimation problem')
+            guesses = checkpoint['guesses']
+        else:
+            'Improve the initial guesses with the EM algorithm'
+            if number_of_em_iterations > 0:
+                guesses = [self.estimate_hawkes_parameters_em(float_times, events, states, float_time_start,
+                                                              float_time_end, g,
+                                                              maximum_number_of_iterations=number_of_em_iterations,
+                                                              parameters_lower_bound=parameters_lower_bound).x
+                           for g in guesses]
+            'Project the initial guesses onto the structure'
+            if structure is not None:
+                guesses = [structure.free_to_full(structure.full_to_free(g)) for g in guesses]
+            'Create the checkpoint'
+            if checkpoint_file is not None:
+                checkpoint = {'problem': problem, 'guesses': guesses, 'completed': {}, 'iterates': {}}
+                self.save_checkpoint(checkpoint_file, checkpoint)
+
+        'Methods of scipy.minimize that use the Hessian'
+        methods_using_hessian = ['newton-cg', 'dogleg', 'trust-ncg', 'trust-krylov', 'trust-exact', 'trust-constr']
+
+        def minimize(key, objective, jacobian, hessian, guess):
+            '''Minimises the objective of the sub-problem `key` = (event type, index of the guess),
+            or retrieves its result from the checkpoint'''
+            if checkpoint is not None and key in checkpoint['completed']:
+                return checkpoint['completed'][key]
+            initial_point = guess
+            if checkpoint is not None and key in checkpoint['iterates']:
+                initial_point = checkpoint['iterates'][key]
+            if method.lower() not in methods_using_hessian:
+                hessian = None
+            '''The iterates of 'trust-constr' can leave the bounds, where the likelihood is not defined, and it
+            stalls with the exact Hessian: it works on the logarithms of the parameters, with the same bounds'''
+            bounded_logarithms = reparametrisation is None and method.lower() == 'trust-constr'
+            subproblem_reparametrisation = 'log' if bounded_logarithms else reparametrisation
+            to_parameters = None
+            if subproblem_reparametrisation is not None:
+                'Optimise over the unconstrained variables, the derivatives are obtained by the chain rule'
+                number_of_base_rates = self.number_of_event_types if key[0] is None else 1
+                natural_objective, natural_jacobian, natural_hessian = objective, jacobian, hessian
+                def to_parameters(z):
+                    return self.parameters_from_reparametrisation(z, number_of_base_rates,
+                                                                  subproblem_reparametrisation)
+                def objective(z):
+                    return natural_objective(to_parameters(z))
+                def jacobian(z):
+                    parameters = to_parameters(z)
+                    return self.reparametrise_derivatives(parameters, natural_jacobian(parameters), None,
+                                                          number_of_base_rates, subproblem_reparametrisation)[0]
+                if natural_hessian is not None:
+                    def hessian(z):
+                        parameters = to_parameters(z)
+                        return self.reparametrise_derivatives(parameters, natural_jacobian(parameters),
+                                                              natural_hessian(parameters), number_of_base_rates,
+                                                              subproblem_reparametrisation)[1]
+                initial_point = self.reparametrise(np.maximum(initial_point, parameters_lower_bound),
+                                                   number_of_base_rates, subproblem_reparametrisation)
+            callbacks = []
+            if monitor is not None:
+                monitor.start_subproblem(key[0], key[1], 'given' if key[1] < len(given_guesses) else 'random',
+                                         initial_point)
+                objective, jacobian, monitor_callback = monitor.instrument(objective, jacobian)
+                callbacks.append(monitor_callback)
+            if checkpoint is not None:
+                last_save = [time.time()]
+                def checkpoint_callback(x, *args):
+                    # the iterates are saved in terms of the parameters (nu, alpha, beta)
+                    checkpoint['iterates'][key] = np.array(x if to_parameters is None else to_parameters(x),
+                                                           copy=True)
+                    if time.time() - last_save[0] >= checkpoint_interval:
+                        self.save_checkpoint(checkpoint_file, checkpoint)
+                        last_save[0] = time.time()
+                callbacks.append(checkpoint_callback)
+            callback = None
+            if len(callbacks) > 0:
+                def callback(x, *args):
+                    for c in callbacks:
+                        c(x, *args)
+            bounds = [(parameters_lower_bound, parameters_upper_bound)] * len(guess)
+            if bounded_logarithms:
+                upper_bound = np.inf if parameters_upper_bound is None else np.log(parameters_upper_bound)
+                bounds = opt.Bounds(np.log(parameters_lower_bound), upper_bound)
+            elif reparametrisation is not None:
+                bounds = None
+            o = opt.minimize(objective, initial_point, method=method,
+                             bounds=bounds, jac=jacobian, hess=hessian, callback=callback,
+                             options={'maxiter': maximum_number_of_iterations})
+            if subproblem_reparametrisation is not None:
+                o['reparametrised_x'] = o.x
+                o['x'] = to_parameters(o.x)
+            if structure is not None:
+                o['free_x'] = o.x
+                o['x'] = (structure if key[0] is None else structure.partial(key[0])).free_to_full(o.x)
+            if monitor is not None:
+                monitor.end_subproblem(o)
+            if checkpoint is not None:
+                checkpoint['completed'][key] = o
+                checkpoint['iterates'].pop(key, None)
+                self.save_checkpoint(checkpoint_file, checkpoint)
+            return o
+
+        'Distribution of the state right after each event type, used by the stability penalty'
+        states_after_events = self.proportion_of_events_and_states(events, states, self.number_of_event_types,
+                                                                   self.number_of_states)
+        counts = np.sum(states_after_events, axis=1, keepdims=True)
+        states_after_events = np.divide(states_after_events, counts, out=np.zeros_like(states_after_events),
+                                        where=counts > 0)
 
         'For each initial guess, apply the optimizer'
         if not parallel_estimation:
             optimal_results = []
-            for g in guesses:
-                dimension = self.number_of_event_types + 2 * self.number_of_states * self.number_of_event_types ** 2
-                bounds = [(parameters_lower_bound, parameters_upper_bound)] * dimension
+            for i, g in enumerate(guesses):
                 'Define the minus likelihood and gradient functions'
                 def likelihood_minus(parameters):
                     result = - self.log_likelihood_of_events(parameters, times, events, states,
-                                                             time_start, time_end)
+                                                             time_start, time_end, structure, time_scale)
+                    if stability_penalty_weight > 0:
+                        v, a, b = self.array_to_parameters(parameters, self.number_of_event_types,
+                                                           self.number_of_states, structure=structure)
+                        result += self.stability_penalty(a, b, states_after_events, stability_penalty_weight,
+                                                         max_branching_ratio)[0]
                     return result
                 def gradient_of_likelihood_minus(parameters):
-                    result = - self.gradient(parameters, times, events, states, time_start, time_end)
+                    result = - self.gradient(parameters, times, events, states, time_start, time_end, structure,
+                                             time_scale)
+                    if stability_penalty_weight > 0:
+                        v, a, b = self.array_to_parameters(parameters, self.number_of_event_types,
+                                                           self.number_of_states, structure=structure)
+                        p, g_a, g_b = self.stability_penalty(a, b, states_after_events, stability_penalty_weight,
+                                                             max_branching_ratio)
+                        penalty_gradient = self.parameters_to_array(np.zeros(self.number_of_event_types), g_a, g_b)
+                        if structure is not None:
+                            penalty_gradient = structure.gradient_to_free(penalty_gradient)
+                        result += penalty_gradient
+                    return result
+                def hessian_of_likelihood_minus(parameters):
+                    result = - self.hessian(parameters, times, events, states, time_start, time_end, structure,
+                                            time_scale)
+                    if stability_penalty_weight > 0:
+                        v, a, b = self.array_to_parameters(parameters, self.number_of_event_types,
+                                                           self.number_of_states, structure=structure)
+                        penalty_hessian = self.stability_penalty_hessian(a, b, states_after_events,
+                                                                         stability_penalty_weight, max_branching_ratio)
+                        if structure is not None:
+                            penalty_hessian = structure.hessian_to_free(penalty_hessian)
+                        result += penalty_hessian
                     return result
-                o = opt.minimize(likelihood_minus, g, method=method,
-                                 bounds=bounds, jac=gradient_of_likelihood_minus,
-                                 options={'maxiter': maximum_number_of_iterations})
+                if structure is not None:
+                    g = structure.full_to_free(g)
+                o = minimize((None, i), likelihood_minus, gradient_of_likelihood_minus, hessian_of_likelihood_minus,
+                             g)
                 optimal_results.append(o)
             'Look for the solution that gives the highest log-likelihood'
             index_of_best_result = 0
@@ -277,18 +743,18 @@ class HybridHawkesExp:
                 kind_of_best_initial_guess += 'given'
             elif index_of_best_result - len(given_guesses) < number_of_random_guesses:
                 kind_of_best_initial_guess += 'random'
+            o = optimal_results[index_of_best_result]
+            if fisher_information:
+                o['fisher_information'] = - self.hessian(o.x if structure is None else o.free_x, times, events,
+                                                         states, time_start, time_end, structure, time_scale)
+                o['standard_errors'] = self.standard_errors(o['fisher_information'])
+            if monitor is not None:
+                monitor.summary()
             'Return the OptimizeResult instance that gives the biggest likelihood'
-            return optimal_results[index_of_best_result], best_initial_guess, kind_of_best_initial_guess
+            return o, best_initial_guess, kind_of_best_initial_guess
         else:
-            dimension = 1 + 2 * self.number_of_states * self.number_of_event_types
-            bounds = [(parameters_lower_bound, parameters_upper_bound)] * dimension
-            opt_nus = np.zeros(self.number_of_event_types)
-            opt_alphas = np.zeros((self.number_of_event_types, self.number_of_states, self.number_of_event_types))
-            opt_betas = np.zeros((self.number_of_event_types, self.number_of_states, self.number_of_event_types))
-            best_guess_nu = np.zeros(self.number_of_event_types)
-            best_guess_alphas =\
-                np.zeros((self.number_of_event_types, self.number_of_states, self.number_of_event_types))
-            best_guess_betas = np.zeros((self.number_of_event_types, self.number_of_states, self.number_of_event_types))
+            x = np.zeros(len(guesses[0]))
+            best_initial_guess = np.zeros(len(guesses[0]))
             success = True
             successes = []
             status = -999
@@ -302,26 +768,53 @@ class HybridHawkesExp:
             nit = 0
             kinds_of_best_initial_guesses = ''
             for e in range(self.number_of_event_types):
+                partial_structure = None if structure is None else structure.partial(e)
+                # the parameters of the event type e are gathered from (and scattered to) the array of all the
+                # parameters, which avoids slicing the coefficients along their last dimension
+                indices = self.partial_parameters_indices(e, self.number_of_event_types, self.number_of_states)
                 'Define the minus likelihood and gradient functions'
                 def likelihood_minus(parameters):
                     result = - self.log_likelihood_of_events_partial(e, parameters, times, events, states,
-                                                                     time_start, time_end)
+                                                                     time_start, time_end, structure, time_scale)
+                    if stability_penalty_weight > 0:
+                        v, a, b = self.array_to_parameters(parameters, self.number_of_event_types,
+                                                           self.number_of_states, 1, partial_structure)
+                        result += self.stability_penalty(a, b, states_after_events, stability_penalty_weight,
+                                                         max_branching_ratio)[0]
                     return result
                 def gradient_of_likelihood_minus(parameters):
-                    result = - self.gradient_partial(e, parameters, times, events, states,time_start, time_end)
+                    result = - self.gradient_partial(e, parameters, times, events, states,time_start, time_end,
+                                                     structure, time_scale)
+                    if stability_penalty_weight > 0:
+                        v, a, b = self.array_to_parameters(parameters, self.number_of_event_types,
+                                                           self.number_of_states, 1, partial_structure)
+                        p, g_a, g_b = self.stability_penalty(a, b, states_after_events, stability_penalty_weight,
+                                                             max_branching_ratio)
+                        penalty_gradient = self.parameters_to_array(np.zeros(1), g_a, g_b)
+                        if partial_structure is not None:
+                            penalty_gradient = partial_structure.gradient_to_free(penalty_gradient)
+                        result += penalty_gradient
+                    return result
+                def hessian_of_likelihood_minus(parameters):
+                    result = - self.hessian_partial(e, parameters, times, events, states, time_start, time_end,
+                                                    structure, time_scale)
+                    if stability_penalty_weight > 0:
+                        v, a, b = self.array_to_parameters(parameters, self.number_of_event_types,
+                                                           self.number_of_states, 1, partial_structure)
+                        penalty_hessian = self.stability_penalty_hessian(a, b, states_after_events,
+                                                                         stability_penalty_weight, max_branching_ratio)
+                        if partial_structure is not None:
+                            penalty_hessian = partial_structure.hessian_to_free(penalty_hessian)
+                        result += penalty_hessian
                     return result
                 'For each initial guess, optimise likelihood'
                 optimal_results = []
-                for g in guesses:
-                    guess_nus, guess_alphas, guess_betas = self.array_to_parameters(g, self.number_of_event_types,
-                                                                                    self.number_of_states,
-                                                                                    self.number_of_event_types)
-                    g_partial = self.parameters_to_array(guess_nus[e:e+1],
-                                                         guess_alphas[:,:,e:e+1],
-                                                         guess_betas[:,:,e:e+1])
-                    o = opt.minimize(likelihood_minus, g_partial, method=method,
-                                     bounds=bounds, jac=gradient_of_likelihood_minus,
-                                     options={'maxiter': maximum_number_of_iterations})
+                for i, g in enumerate(guesses):
+                    g_partial = np.asarray(g, dtype=float)[indices]
+                    if partial_structure is not None:
+                        g_partial = partial_structure.full_to_free(g_partial)
+                    o = minimize((e, i), likelihood_minus, gradient_of_likelihood_minus, hessian_of_likelihood_minus,
+                                 g_partial)
                     optimal_results.append(o)
                 'Look for the solution that gives the highest log-likelihood'
                 index_of_best_result = 0
@@ -331,7 +824,6 @@ class HybridHawkesExp:
                     if current_log_likelihood_minus < log_likelihood_minus:
                         index_of_best_result = i
                         log_likelihood_minus = current_log_likelihood_minus
-                best_initial_guess = guesses[index_of_best_result]
                 kind_of_best_initial_guess = ''
                 if index_of_best_result < len(given_guesses):
                     kind_of_best_initial_guess += 'given'
@@ -341,16 +833,9 @@ class HybridHawkesExp:
                 # Save the kind of best initial guess for this event type
                 kinds_of_best_initial_guesses += kind_of_best_initial_guess + ' '
                 # Save optimal parameters
-                v, a, b = self.array_to_parameters(o.x, self.number_of_event_types, self.number_of_states, 1)
-                opt_nus[e:e+1] = v
-                opt_alphas[:,:,e:e+1] = a
-                opt_betas[:,:,e:e+1] = b
+                x[indices] = o.x
                 # Save best initial guess
-                v, a, b = self.array_to_parameters(best_initial_guess, self.number_of_event_types,
-                                                   self.number_of_states, self.number_of_event_types)
-                best_guess_nu[e] = v[e]
-                best_guess_alphas[:,:,e] = a[:,:,e]
-                best_guess_betas[:,:,e] = b[:,:,e]
+                best_initial_guess[indices] = np.asarray(guesses[index_of_best_result], dtype=float)[indices]
                 # Save optimiser information
                 successes.append(o.success)
                 statuses.append(o.status)
@@ -363,9 +848,7 @@ class HybridHawkesExp:
                 nfev += o.nfev
                 nit += o.nit
             'Aggregate the Optimize Results into a single one'
-            best_initial_guess = self.parameters_to_array(best_guess_nu, best_guess_alphas, best_guess_betas)
             o = opt.OptimizeResult()
-            x = self.parameters_to_array(opt_nus, opt_alphas, opt_betas)
             o['x'] = x
             o['success'] = success
             o['successes'] = successes
@@ -378,11 +861,641 @@ class HybridHawkesExp:
             o['hesss'] = hesss
             o['nfev'] = nfev
             o['nit'] = nit
+            if structure is not None:
+                o['free_x'] = structure.full_to_free(x)
+            if fisher_information:
+                o['fisher_information'] = - self.hessian(x if structure is None else o.free_x, times, events, states,
+                                                         time_start, time_end, structure, time_scale)
+                o['standard_errors'] = self.standard_errors(o['fisher_information'])
+            if monitor is not None:
+                monitor.summary()
             return o, best_initial_guess, kinds_of_best_initial_guesses
 
+    def estimate_hawkes_parameters_rolling(self, times, events, states, window_length, step, time_start=None,
+                                           time_end=None, lookback=None, given_guesses=[],
+                                           number_of_random_guesses=1, number_of_random_guesses_per_window=0,
+                                           **estimation_arguments):
+        r"""
+        Re-estimates the parameters :math:`(\nu, \alpha, \beta)` on a window of length `window_length` that slides
+        by `step` over a long sample path. This is a generator: the result of each window is available as soon as
+        its estimation is completed.
+
+        Every window is warm-started from the optimum of the previous window, which is passed as the first of the
+        `given_guesses` of :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.estimate_hawkes_parameters`.
+        The events before a window are an initial condition whose contribution to the partial sums depends on the
+        decay coefficients being estimated, so they cannot be summarised once and for all.
+        Instead, only the events within `lookback` before the start of the window are passed as initial condition,
+        which makes the cost of each window independent of the length of the history.
+        The contribution of the discarded events to the intensities is at most of the order of
+        :math:`\exp(-\beta \times \mbox{lookback})`.
+
+        :type times: 1D numpy array of float
+        :param times: the times at which events occur.
+        :type events: 1D numpy array of int
+        :param events: the sequence of event types, `events[n]` is the event type of the `n` th event.
+        :type states: 1D numpy array of int
+        :param states: the sequence of states, `states[n]` is the new state of the system following the `n` th event.
+        :type window_length: float
+        :param window_length: the length of the estimation windows.
+        :type step: float
+        :param step: the time between the ends of two consecutive windows.
+        :type time_start: float
+        :param time_start: the start of the first window, by default the first event time.
+        :type time_end: float
+        :param time_end: no window ends after this time, by default the last event time.
+        :type lookback: float
+        :param lookback: the length of the history that is passed as initial condition, by default `window_length`.
+                         Set it to `numpy.inf` to use the entire history.
+        :type given_guesses: list of 1D numpy array
+        :param given_guesses: initial guesses for the first window.
+        :type number_of_random_guesses: int
+        :param number_of_random_guesses: the number of random initial guesses for the first window.
+        :type number_of_random_guesses_per_window: int
+        :param number_of_random_guesses_per_window: the number of random initial guesses for the next windows,
+                                                    in addition to the warm start.
+        :param estimation_arguments: the other arguments are passed to
+                                     :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.estimate_hawkes_parameters`.
+                                     When `time_scale` is among them, the times are integer numbers of ticks and
+                                     `window_length`, `step`, `lookback`, `time_start` and `time_end` are also
+                                     integer numbers of ticks.
+                                     When `checkpoint_file` is among them, every window has its own checkpoint, the
+                                     path suffixed with the end of the window. The checkpoints of the finished
+                                     windows are kept until the last window has been yielded, so that an
+                                     interrupted run that is started again with the same arguments retrieves the
+                                     finished windows without estimating them again, with the same warm starts,
+                                     and resumes the interrupted window.
+        :rtype: generator of dict
+        :return: for each window, a dictionary with keys 'window_start', 'window_end', 'number_of_events'
+                 (in the window), 'result', 'initial_guess' and 'kind', the last three being the outputs of
+                 :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.estimate_hawkes_parameters`.
+        """
+        if window_length <= 0 or step <= 0:
+            raise ValueError('window_length and step must be positive')
+        if time_start is None:
+            time_start = times[0]
+        if time_end is None:
+            time_end = times[-1]
+        if lookback is None:
+            lookback = window_length
+        checkpoint_file = estimation_arguments.pop('checkpoint_file', None)
+        window_checkpoint_files = []
+        guesses = given_guesses
+        random_guesses = number_of_random_guesses
+        window_end = time_start + window_length
+        while window_end <= time_end:
+            window_start = window_end - window_length
+            'Slice the sample path: lookback history (initial condition) and window'
+            index_start = bisect.bisect_left(times, window_start - lookback)
+            index_window = bisect.bisect_right(times, window_start)
+            index_end = bisect.bisect_right(times, window_end)
+            'A checkpoint only holds the estimation problem of a single window'
+            window_checkpoint_file = None
+            if checkpoint_file is not None:
+                window_checkpoint_file = checkpoint_file + '.' + str(window_end)
+                window_checkpoint_files.append(window_checkpoint_file)
+            result, initial_guess, kind = \
+                self.estimate_hawkes_parameters(times[index_start:index_end], events[index_start:index_end],
+                                                states[index_start:index_end], window_start, window_end,
+                                                given_guesses=guesses, number_of_random_guesses=random_guesses,
+                                                checkpoint_file=window_checkpoint_file, **estimation_arguments)
+            yield {'window_start': window_start, 'window_end': window_end,
+                   'number_of_events': index_end - index_window,
+                   'result': result, 'initial_guess': initial_guess, 'kind': kind}
+            'Warm start of the next window'
+            guesses = [result.x]
+            random_guesses = number_of_random_guesses_per_window
+            window_end += step
+        'All the windows are finished, their checkpoints are no longer needed'
+        for window_checkpoint_file in window_checkpoint_files:
+            if os.path.exists(window_checkpoint_file):
+                os.remove(window_checkpoint_file)
+
+    def estimate_hawkes_parameters_em(self, times, events, states, time_start, time_end, initial_guess=None,
+                                      maximum_number_of_iterations=1000, tolerance=10**(-8),
+                                      parameters_lower_bound=10**(-6), min_decay_coefficient=0.5,
+                                      max_decay_coefficient=100, number_of_chunks=1, number_of_processes=1,
+                                      lookback=None):
+        r"""
+        Estimates the parameters of the intensities (arrival rates) of events, i.e., :math:`(\nu, \alpha, \beta)`,
+        with the expectation-maximisation (EM) algorithm.
+        The EM algorithm relies on the branching structure of the Hawkes process: every event is either an immigrant,
+        or it was triggered by a previous event.
+        The expectation step computes the probability of each of these scenarios given the events and the current
+        parameters, along with the expected time lags between the events and their parents.
+        The maximisation step maximises the expected complete log-likelihood, which has a closed form in
+        :math:`\nu` and :math:`\alpha`:
+
+        .. math::
+
+            \nu_e = \frac{P_e}{T - t_0}, \quad \alpha_{e'xe} = \frac{P_{e'xe}}{G_{e'xe}(\beta_{e'xe})},
+
+        where :math:`P_e` is the expected number of immigrants of type `e`, :math:`P_{e'xe}` is the expected number of
+        events of type `e` triggered by events of type `e'` in state `x`, and
+        :math:`G_{e'xe}(\beta) = \sum_{m : e_m = e', x_m = x} \int_{t_0}^T \exp(-\beta (t - t_m))1_{t > t_m}dt`.
+        The decay coefficients minimise the one-dimensional function
+        :math:`P_{e'xe} \log G_{e'xe}(\beta) + \beta Q_{e'xe}`, where :math:`Q_{e'xe}` is the expected sum of the
+        corresponding time lags, which is done with a few safeguarded Newton steps in :math:`\log \beta`.
+        Without chunks, an iteration is not expected to decrease the likelihood, up to the inexact update of the
+        decay coefficients. With chunks, the likelihood of the expectation step is computed with the truncated
+        histories of the chunks, so that it can decrease. When it decreases by more than the relative `tolerance`,
+        the algorithm stops and returns the previous iterate, with 'success' set to False.
+        EM is insensitive to the relative scales of :math:`\alpha` and :math:`\beta` and it is robust to the
+        initial guess, so it is also a good way to initialise
+        :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.estimate_hawkes_parameters`, see its argument
+        `number_of_em_iterations`.
+
+        :type times: 1D numpy array of float
+        :param times: the times at which events occur.
+        :type events: 1D numpy array of int
+        :param events: the sequence of event types, `events[n]` is the event type of the `n` th event.
+        :type states: 1D numpy array of int
+        :param states: the sequence of states, `states[n]` is the new state of the system following the `n` th event.
+        :type time_start: float
+        :param time_start: the time at which we consider that the process started, prior times are treated as an
+                           initial condition.
+        :type time_end: float
+        :param time_end: the time at which we stopped to record the process.
+        :type initial_guess: 1D numpy array
+        :param initial_guess: the initial guess on the parameters, see
+                              :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.parameters_to_array`.
+                              If None, a random guess is generated as in
+                              :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.estimate_hawkes_parameters`.
+        :type maximum_number_of_iterations: int
+        :param maximum_number_of_iterations: the maximum number of EM iterations.
+        :type tolerance: float
+        :param tolerance: the algorithm stops when the relative increase of the log-likelihood is smaller.
+        :type parameters_lower_bound: float
+        :param parameters_lower_bound: lower bound on all the parameters, so that the estimate can be used as an
+                                       initial guess of the bounded optimisers of `scipy.minimize`.
+        :type min_decay_coefficient: numpy array or float
+        :param min_decay_coefficient: defines how the random guess is generated.
+        :type max_decay_coefficient: numpy array or float
+        :param max_decay_coefficient: defines how the random guess is generated.
+        :type number_of_chunks: int
+        :param number_of_chunks: the expectation step is split into this number of time intervals with the same
+                                 number of events, whose expected sufficient statistics are added.
+                                 Every chunk but the first receives only its own events and those within
+                                 `lookback` before its start, as initial condition, so that the cost of a chunk
+                                 and the data sent to a worker do not grow with the length of the history.
+                                 The contribution of the discarded events to the intensities is at most of the
+                                 order of :math:`\exp(-\beta \times \mbox{lookback})`.
+        :type number_of_processes: int
+        :param number_of_processes: the number of worker processes among which the chunks are distributed;
+                                    if 1, everything is computed in the current process.
+        :type lookback: float
+        :param lookback: the length of the history that is passed to a chunk as initial condition, by default
+                         `(time_end - time_start) / number_of_chunks`.
+        :rtype: scipy.optimize.OptimizerResult
+        :return: the optimisation result: the estimate 'x', minus its log-likelihood 'fun', the number of
+                 iterations 'nit', 'success', 'message' and the log-likelihood at every iteration
+                 'log_likelihoods'. With chunks, the log-likelihoods of the iterations are computed with the
+                 truncated histories and are approximate, but 'fun' is computed exactly, over the whole sample.
+        """
+        import scipy.optimize as opt
+
+        number_of_event_types = self.number_of_event_types
+        number_of_states = self.number_of_states
+        if initial_guess is None:
+            average_intensities = np.bincount(events, minlength=number_of_event_types) / (time_end - time_start)
+            shape = (number_of_event_types, number_of_states, number_of_event_types)
+            initial_guess = self.random_guess(average_intensities, min_decay_coefficient * np.ones(shape),
+                                              max_decay_coefficient * np.ones(shape))
+        parameters = np.maximum(np.array(initial_guess, dtype=float), parameters_lower_bound)
+        'Time elapsed between each event and the beginning and the end of the sample, grouped by mark (e,x)'
+        index_end = bisect.bisect_right(times, time_end)
+        marks = events[:index_end] * number_of_states + states[:index_end]
+        elapsed_times_start = []
+        elapsed_times_end = []
+        for mark in range(number_of_event_types * number_of_states):
+            times_of_mark = times[:index_end][marks == mark]
+            elapsed_times_start.append(time_start - times_of_mark[times_of_mark < time_start])
+            elapsed_times_end.append(time_end - times_of_mark[::-1])
+        'Split the sample into chunks with the same number of events for the expectation step'
+        index_start = bisect.bisect_right(times, time_start)
+        indices = np.linspace(index_start, index_end, number_of_chunks + 1).astype(int)
+        boundaries = [time_start] + [times[i - 1] for i in indices[1:-1]] + [time_end]
+        if lookback is None:
+            lookback = (time_end - time_start) / number_of_chunks
+        'Slice the sample path once: lookback history (initial condition) and events of each chunk'
+        chunks = []
+        for c in range(number_of_chunks):
+            if c == 0:
+                index_history = 0
+            else:
+                index_history = bisect.bisect_left(times, boundaries[c] - lookback)
+            i = bisect.bisect_right(times, boundaries[c + 1])
+            chunks.append((times[index_history:i], events[index_history:i], states[index_history:i],
+                           boundaries[c], boundaries[c + 1]))
+        chunk_arguments = [[number_of_event_types] * number_of_chunks, [number_of_states] * number_of_chunks] + \
+                          [list(a) for a in zip(*chunks)]
+        executor = None
+        if number_of_processes > 1 and number_of_chunks > 1:
+            executor = ProcessPoolExecutor(max_workers=number_of_processes)
+        log_likelihoods = []
+        success = False
+        message = 'Maximum number of iterations reached'
+        try:
+            for iteration in range(maximum_number_of_iterations + 1):
+                'Expectation step'
+                arguments = [[parameters] * number_of_chunks] + chunk_arguments
+                if executor is not None:
+                    statistics = list(executor.map(HybridHawkesExp.expectation_step, *arguments))
+                else:
+                    statistics = list(map(HybridHawkesExp.expectation_step, *arguments))
+                expected_immigrants, expected_children, expected_lags, log_likelihood = \
+                    [sum(s) for s in zip(*statistics)]
+                log_likelihoods.append(log_likelihood)
+                if iteration > 0 and log_likelihood - log_likelihoods[-2] < - tolerance * abs(log_likelihood):
+                    parameters = previous_parameters
+                    log_likelihood = log_likelihoods[-2]
+                    message = 'The log-likelihood decreased, the previous iterate is returned'
+                    break
+                if iteration > 0 and log_likelihood - log_likelihoods[-2] <= tolerance * abs(log_likelihood):
+                    success = True
+                    message = 'The relative change of the log-likelihood is smaller than the tolerance'
+                    break
+                if iteration == maximum_number_of_iterations:
+                    break
+                'Maximisation step'
+                base_rates, impact_coefficients, decay_coefficients = \
+                    self.array_to_parameters(parameters, number_of_event_types, number_of_states)
+                base_rates, impact_coefficients, decay_coefficients = \
+                    self.maximisation_step(expected_immigrants, expected_children, expected_lags,
+                                           decay_coefficients, elapsed_times_start, elapsed_times_end,
+                                           time_end - time_start, parameters_lower_bound)
+                previous_parameters = parameters
+                parameters = self.parameters_to_array(base_rates, impact_coefficients, decay_coefficients)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        o = opt.OptimizeResult()
+        o['x'] = parameters
+        if number_of_chunks > 1:
+            'The log-likelihood of the chunks is approximate, the one of the estimate is computed exactly'
+            log_likelihood = self.log_likelihood_of_events(parameters, times, events, states, time_start, time_end)
+        o['fun'] = - log_likelihood
+        o['nit'] = iteration
+        o['success'] = success
+        o['message'] = message
+        o['log_likelihoods'] = np.array(log_likelihoods)
+        return o
+
+    @staticmethod
+    def expectation_step(parameters, number_of_event_types, number_of_states, times, events, states, time_start,
+                         time_end):
+        r"""
+        Computes the expectation step of the EM algorithm, see
+        :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.estimate_hawkes_parameters_em`.
+        The expected sufficient statistics and the log-likelihood are additive: those of a sample are the sums of
+        those of sub-intervals (where the prior events are an initial condition).
+        The method wraps a C implementation that was obtained via Cython.
+
+        :type parameters: 1D numpy array
+        :param parameters: the parameters :math:`(\nu, \alpha, \beta)` put into a single array.
+        :type number_of_event_types: int
+        :param number_of_event_types: number of event types.
+        :type number_of_states: int
+        :param number_of_states: number of states.
+        :type times: 1D numpy array of float
+        :param times: the times at which events occur.
+        :type events: 1D numpy array of int
+        :param events: the sequence of event types, `events[n]` is the event type of the `n` th event.
+        :type states: 1D numpy array of int
+        :param states: the sequence of states, `states[n]` is the new state of the system following the `n` th event.
+        :type time_start: float
+        :param time_start: the time at which we consider that the process started, prior times are treated as an
+                           initial condition.
+        :type time_end: float
+        :param time_end: the time at which we stopped to record the process.
+        :rtype: 1D numpy array, 3D numpy array, 3D numpy array, float
+        :return: the expected numbers of immigrants :math:`P_e`, the expected numbers of children
+                 :math:`P_{e'xe}`, the expected sums of the time lags between children and parents
+                 :math:`Q_{e'xe}` and the log-likelihood.
+        """
+        base_rates, impact_coefficients, decay_coefficients = \
+            HybridHawkesExp.array_to_parameters(parameters, number_of_event_types, number_of_states)
+        'Only the kernels with non-zero impact coefficients can trigger events'
+        kernels, source_indptr, source_kernels, target_indptr = \
+            HybridHawkesExp.active_kernels(impact_coefficients != 0)
+        times, events, states = HybridHawkesExp.kernel_arrays(times, events, states)
+        expected_immigrants, active_expected_children, active_expected_lags, log_likelihood = \
+            cy.expectation_step(base_rates, impact_coefficients[kernels], decay_coefficients[kernels],
+                                number_of_event_types, number_of_states, times, events, states, float(time_start),
+                                float(time_end), source_indptr, source_kernels, target_indptr)
+        expected_children = np.zeros(impact_coefficients.shape)
+        expected_lags = np.zeros(impact_coefficients.shape)
+        expected_children[kernels] = active_expected_children
+        expected_lags[kernels] = active_expected_lags
+        return expected_immigrants, expected_children, expected_lags, log_likelihood
+
+    @staticmethod
+    def maximisation_step(expected_immigrants, expected_children, expected_lags, decay_coefficients,
+                          elapsed_times_start, elapsed_times_end, duration, parameters_lower_bound,
+                          number_of_newton_steps=10):
+        r"""
+        Computes the maximisation step of the EM algorithm, see
+        :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.estimate_hawkes_parameters_em`.
+
+        :type expected_immigrants: 1D numpy array
+        :param expected_immigrants: :math:`P_e`.
+        :type expected_children: 3D numpy array
+        :param expected_children: :math:`P_{e'xe}`.
+        :type expected_lags: 3D numpy array
+        :param expected_lags: :math:`Q_{e'xe}`.
+        :type decay_coefficients: 3D numpy array
+        :param decay_coefficients: the current decay coefficients, the starting point of the Newton steps.
+        :type elapsed_times_start: list of 1D numpy arrays
+        :param elapsed_times_start: see :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.kernel_integrals`.
+        :type elapsed_times_end: list of 1D numpy arrays
+        :param elapsed_times_end: see :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.kernel_integrals`.
+        :type duration: float
+        :param duration: :math:`T - t_0`.
+        :type parameters_lower_bound: float
+        :param parameters_lower_bound: lower bound on all the parameters.
+        :type number_of_newton_steps: int
+        :param number_of_newton_steps: maximum number of Newton steps in :math:`\log \beta`.
+        :rtype: 1D numpy array, 3D numpy array, 3D numpy array
+        :return: the new parameters :math:`(\nu, \alpha, \beta)`.
+        """
+        base_rates = np.maximum(expected_immigrants / duration, parameters_lower_bound)
+        decay_coefficients = np.array(decay_coefficients, dtype=float)
+        integrals = HybridHawkesExp.kernel_integrals(decay_coefficients, elapsed_times_start, elapsed_times_end)[0]
+        'Kernels that triggered no event keep their decay coefficient'
+        active = (expected_children > 0) & (integrals > 0)
+        def objective(g, beta):
+            return expected_children * np.log(np.where(active, g, 1)) + expected_lags * beta
+        for step in range(number_of_newton_steps):
+            g, g_1, g_2 = HybridHawkesExp.kernel_integrals(decay_coefficients, elapsed_times_start,
+                                                           elapsed_times_end)
+            g = np.where(active, g, 1)
+            'First and second derivatives of the objective with respect to log(beta)'
+            d_1 = decay_coefficients * (expected_children * g_1 / g + expected_lags)
+            d_2 = d_1 + decay_coefficients**2 * expected_children * (g_2 / g - (g_1 / g)**2)
+            # where the objective is not convex, move by one unit in the direction of descent
+            increments = np.where(d_2 > 0, - d_1 / np.where(d_2 > 0, d_2, 1), - np.sign(d_1))
+            increments = np.where(active, np.clip(increments, -1, 1), 0)
+            if np.max(np.abs(increments)) < 10**(-8):
+                break
+            'Halve the increments that do not decrease the objective'
+            current_value = objective(g, decay_coefficients)
+            for k in range(30):
+                candidate = decay_coefficients * np.exp(increments)
+                candidate_value = objective(HybridHawkesExp.kernel_integrals(candidate, elapsed_times_start,
+                                                                             elapsed_times_end, False)[0],
+                                            candidate)
+                rejected = candidate_value > current_value
+                if not np.any(rejected):
+                    break
+                increments = np.where(rejected, increments / 2, increments)
+            decay_coefficients = np.where(rejected, decay_coefficients, candidate)
+        decay_coefficients = np.maximum(decay_coefficients, parameters_lower_bound)
+        integrals = HybridHawkesExp.kernel_integrals(decay_coefficients, elapsed_times_start, elapsed_times_end,
+                                                     False)[0]
+        impact_coefficients = np.divide(expected_children, integrals, out=np.zeros_like(expected_children),
+                                        where=active)
+        impact_coefficients = np.maximum(impact_coefficients, parameters_lower_bound)
+        return base_rates, impact_coefficients, decay_coefficients
+
+    @staticmethod
+    def kernel_integrals(decay_coefficients, elapsed_times_start, elapsed_times_end, derivatives=True):
+        r"""
+        Computes the integrals of the exponential kernels triggered by the events of each mark over the sample,
+
+        .. math::
+
+            G_{e'xe}(\beta) = \sum_{m : e_m = e', x_m = x} \int_{t_0}^T \exp(-\beta (t - t_m))1_{t > t_m}dt
+            = \sum_{m : e_m = e', x_m = x} \frac{\exp(-\beta a_m) - \exp(-\beta b_m)}{\beta},
+
+        where :math:`a_m = \max(t_0 - t_m, 0)` and :math:`b_m = T - t_m`, and their first two derivatives with
+        respect to :math:`\beta`.
+        The terms :math:`\exp(-\beta b_m)` are only computed for the events close to :math:`T`, the others are
+        below the machine precision.
+
+        :type decay_coefficients: 3D numpy array
+        :param decay_coefficients: the decay coefficients :math:`\beta_{e'xe}`.
+        :type elapsed_times_start: list of 1D numpy arrays
+        :param elapsed_times_start: `elapsed_times_start[e'*number_of_states+x]` contains the positive :math:`a_m` of
+                                    the events of mark :math:`(e', x)`, i.e., those of the events that occurred
+                                    before :math:`t_0`.
+        :type elapsed_times_end: list of 1D numpy arrays
+        :param elapsed_times_end: `elapsed_times_end[e'*number_of_states+x]` contains the :math:`b_m` of all the events
+                                  of mark :math:`(e', x)`, in increasing order.
+        :type derivatives: boolean
+        :param derivatives: set to False to compute only :math:`G`.
+        :rtype: 3D numpy array, 3D numpy array, 3D numpy array
+        :return: :math:`G`, its first and its second derivatives (None if `derivatives` is False).
+        """
+        number_of_event_types_1, number_of_states, number_of_event_types_2 = np.shape(decay_coefficients)
+        g = np.zeros(np.shape(decay_coefficients))
+        g_1 = None
+        g_2 = None
+        if derivatives:
+            g_1 = np.zeros(np.shape(decay_coefficients))
+            g_2 = np.zeros(np.shape(decay_coefficients))
+        for e1 in range(number_of_event_types_1):
+            for x in range(number_of_states):
+                a = elapsed_times_start[e1 * number_of_states + x]
+                b = elapsed_times_end[e1 * number_of_states + x]
+                beta = decay_coefficients[e1, x, :, np.newaxis]
+                'Only the events such that beta*b_m < 50 contribute'
+                b = b[:np.searchsorted(b, 50 / np.min(beta))]
+                exp_a = np.exp(- beta * a)
+                exp_b = np.exp(- beta * b)
+                # the events that occurred after the start of the sample have a_m = 0
+                d = len(elapsed_times_end[e1 * number_of_states + x]) - len(a)
+                d += np.sum(exp_a, axis=1) - np.sum(exp_b, axis=1)
+                g[e1, x, :] = d / beta[:, 0]
+                if derivatives:
+                    d_1 = np.sum(b * exp_b, axis=1) - np.sum(a * exp_a, axis=1)
+                    d_2 = np.sum(a**2 * exp_a, axis=1) - np.sum(b**2 * exp_b, axis=1)
+                    g_1[e1, x, :] = (d_1 - g[e1, x, :]) / beta[:, 0]
+                    g_2[e1, x, :] = (d_2 - 2 * g_1[e1, x, :]) / beta[:, 0]
+        return g, g_1, g_2
+
+    @staticmethod
+    def reparametrise(parameters, number_of_base_rates, reparametrisation='log'):
+        r"""
+        Maps the parameters :math:`(\nu, \alpha, \beta)`, which must be positive, to unconstrained variables.
+        With 'log', the variables are :math:`(\log \nu, \log \alpha, \log \beta)`.
+        With 'log_ratio', they are :math:`(\log \nu, \log (\alpha / \beta), \log \beta)`, which decouples the
+        branching ratios :math:`\alpha / \beta` from the time scales :math:`1 / \beta` of the kernels.
+
+        :type parameters: 1D numpy array
+        :param parameters: the parameters :math:`(\nu, \alpha, \beta)` put into a single array, see
+                           :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.parameters_to_array`.
+                           They can also be restricted to the parameters of one event type.
+        :type number_of_base_rates: int
+        :param number_of_base_rates: the number of base rates in `parameters`.
+        :type reparametrisation: string
+        :param reparametrisation: 'log' or 'log_ratio'.
+        :rtype: 1D numpy array
+        :return: the variables, ordered as `parameters`.
+        """
+        variables = np.log(np.array(parameters, dtype=float))
+        number_of_kernels = (len(variables) - number_of_base_rates) // 2
+        if reparametrisation == 'log_ratio':
+            variables[number_of_base_rates:number_of_base_rates + number_of_kernels] -= \
+                variables[number_of_base_rates + number_of_kernels:]
+        elif reparametrisation != 'log':
+            raise ValueError('unknown reparametrisation ' + str(reparametrisation))
+        return variables
+
+    @staticmethod
+    def parameters_from_reparametrisation(variables, number_of_base_rates, reparametrisation='log'):
+        r"""
+        Inverse of :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.reparametrise`.
+
+        :type variables: 1D numpy array
+        :param variables: the unconstrained variables.
+        :type number_of_base_rates: int
+        :param number_of_base_rates: the number of base rates.
+        :type reparametrisation: string
+        :param reparametrisation: 'log' or 'log_ratio'.
+        :rtype: 1D numpy array
+        :return: the parameters :math:`(\nu, \alpha, \beta)` put into a single array.
+        """
+        log_parameters = np.array(variables, dtype=float)
+        number_of_kernels = (len(log_parameters) - number_of_base_rates) // 2
+        if reparametrisation == 'log_ratio':
+            log_parameters[number_of_base_rates:number_of_base_rates + number_of_kernels] += \
+                log_parameters[number_of_base_rates + number_of_kernels:]
+        elif reparametrisation != 'log':
+            raise ValueError('unknown reparametrisation ' + str(reparametrisation))
+        return np.exp(log_parameters)
+
+    @staticmethod
+    def reparametrise_derivatives(parameters, gradient, hessian, number_of_base_rates, reparametrisation='log'):
+        r"""
+        Computes the gradient and the Hessian of a function with respect to the variables of
+        :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.reparametrise`, given its gradient and Hessian with
+        respect to the parameters :math:`(\nu, \alpha, \beta)`.
+        Since :math:`\partial \theta / \partial \log \theta = \theta`, the derivatives with respect to the
+        log-parameters are :math:`\theta \odot g` and :math:`D_\theta H D_\theta + D_{\theta \odot g}`
+        (:math:`D_v` being the diagonal matrix of `v`). With 'log_ratio', :math:`\log \alpha` is the sum of the
+        variables :math:`\log (\alpha / \beta)` and :math:`\log \beta`, so the derivatives with respect to
+        :math:`\log \beta` gain those with respect to :math:`\log \alpha`.
+
+        :type parameters: 1D numpy array
+        :param parameters: the parameters :math:`\theta = (\nu, \alpha, \beta)`.
+        :type gradient: 1D numpy array
+        :param gradient: the gradient :math:`g` of the function with respect to :math:`\theta`.
+        :type hessian: 2D numpy array
+        :param hessian: the Hessian :math:`H` of the function with respect to :math:`\theta`, or None.
+        :type number_of_base_rates: int
+        :param number_of_base_rates: the number of base rates.
+        :type reparametrisation: string
+        :param reparametrisation: 'log' or 'log_ratio'.
+        :rtype: 1D numpy array, 2D numpy array
+        :return: the gradient and the Hessian (None if `hessian` is None) with respect to the variables.
+        """
+        parameters = np.asarray(parameters, dtype=float)
+        g = parameters * gradient
+        h = None
+        if hessian is not None:
+            h = parameters[:, np.newaxis] * hessian * parameters[np.newaxis, :] + np.diag(g)
+        if reparametrisation == 'log_ratio':
+            number_of_kernels = (len(parameters) - number_of_base_rates) // 2
+            impact_slice = slice(number_of_base_rates, number_of_base_rates + number_of_kernels)
+            decay_slice = slice(number_of_base_rates + number_of_kernels, len(parameters))
+            g[decay_slice] += g[impact_slice]
+            if h is not None:
+                h[decay_slice, :] += h[impact_slice, :]
+                h[:, decay_slice] += h[:, impact_slice]
+        elif reparametrisation != 'log':
+            raise ValueError('unknown reparametrisation ' + str(reparametrisation))
+        return g, h
+
+    @staticmethod
+    def standard_errors(fisher_information):
+        r"""
+        Computes the asymptotic standard errors of the maximum likelihood estimates, i.e., the square roots of the
+        diagonal of the inverse of the observed Fisher information.
+
+        :type fisher_information: 2D numpy array
+        :param fisher_information: the observed Fisher information, minus the Hessian of the log-likelihood at the
+                                   estimate.
+        :rtype: 1D numpy array
+        :return: the standard errors, NaN if the Fisher information is singular (for instance, when a parameter
+                 has no effect on the likelihood) or if a diagonal term of its inverse is negative (which happens
+                 when the estimate is not a local maximum, for instance on the boundary).
+        """
+        try:
+            covariance = np.linalg.inv(fisher_information)
+        except np.linalg.LinAlgError:
+            return np.full(len(fisher_information), np.nan)
+        variances = np.diag(covariance)
+        return np.sqrt(np.where(variances >= 0, variances, np.nan))
+
+    @staticmethod
+    def checkpoint_digest(*arrays):
+        """
+        Computes a digest of the data and settings of an estimation, which identifies the estimation problem of a
+        checkpoint (see :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.save_checkpoint`).
+        The integer and float arrays are hashed as int64 and float64 arrays, so that the digest does not depend
+        on the storage types.
+
+        :param arrays: numpy arrays, scalars or None.
+        :rtype: string
+        :return: the SHA-1 digest of the arrays.
+        """
+        import hashlib
+        digest = hashlib.sha1()
+        for array in arrays:
+            if array is None:
+                digest.update(b'None')
+                continue
+            array = np.asarray(array)
+            if np.issubdtype(array.dtype, np.integer) or array.dtype == bool:
+                array = array.astype(np.int64)
+            else:
+                array = array.astype(np.float64)
+            digest.update(str(array.shape).encode())
+            digest.update(np.ascontiguousarray(array).tobytes())
+        return digest.hexdigest()
+
+    @staticmethod
+    def save_checkpoint(path, checkpoint):
+        """
+        Saves the checkpoint of an estimation (see the `checkpoint_file` argument of
+        :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.estimate_hawkes_parameters`) with pickle.
+        The checkpoint is first written to a temporary file that then replaces `path`, so that an interruption
+        during the write never leaves a corrupted checkpoint.
+
+        :type path: string
+        :param path: path of the checkpoint file.
+        :type checkpoint: dict
+        :param checkpoint: the checkpoint.
+        """
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'wb') as f:
+            pickle.dump(checkpoint, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, path)
+
+    @staticmethod
+    def load_checkpoint(path):
+        """
+        Loads the checkpoint of an estimation saved by
+        :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.save_checkpoint`.
+
+        :type path: string
+        :param path: path of the checkpoint file.
+        :rtype: dict
+        :return: the checkpoint, None if the file does not exist.
+            The key 'completed' maps every completed sub-problem (event type, index of the guess) to its
+            scipy.optimize.OptimizeResult and the key 'iterates' maps the running sub-problems to their current
+            iterate. The event type is None when the estimation is not parallel.
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+
     'Specification testing and simulation'
 
-    def compute_events_residuals(self, times, events, states, time_start, initial_partial_sums=0):
+    def compute_events_residuals(self, times, events, states, time_start, initial_partial_sums=0, compact=False,
+                                 block_size=64):
         r"""
         Computes the events residuals :math:`r^e_n` defined by
 
@@ -392,6 +1505,9 @@ class HybridHawkesExp:
 
         where :math:`t^e_n` is the time when the `n` th event of type `e` occurred.
         The methods wraps a C implementation that was obtained via Cython.
+        The residuals of all event types are computed into a single array of size the number of events after
+        `time_start`, see :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.iterate_events_residuals`
+        to process long sample paths by chunks.
 
         :type times: 1D numpy array of float
         :param times: the times at which events occur.
@@ -405,27 +1521,107 @@ class HybridHawkesExp:
         :type initial_partial_sums: 3D numpy array
         :param initial_partial_sums: the initial condition can also be given implicitly via the partial sums
                                      :math:`S_{e',x,e}(-\infty, \mbox{time_start}]`.
-        :rtype: list of 1D numpy arrays
+        :type compact: boolean
+        :param compact: set to True to get the residuals in the compact format `(values, offsets)`.
+        :type block_size: int
+        :param block_size: when positive, the exponential decays of the kernels between consecutive events are computed
+                           by blocks of `block_size` events in a single vectorised loop before the recursion runs over
+                           the block; set to 0 to compute them event by event.
+        :rtype: list of 1D numpy arrays, or tuple of two 1D numpy arrays if `compact` is True
         :return: the `e` th element of the list is the sequence :math:`(r^e_n)` corresponding to the event type `e`.
+                 In the compact format, this sequence is `values[offsets[e]:offsets[e+1]]`;
+                 the elements of the list are views of `values`.
         """
-        # Check if no initial partial sums if given
-        s = np.zeros((self.number_of_event_types, self.number_of_states, self.number_of_event_types))
+        values, offsets = next(self.iterate_events_residuals(times, events, states, time_start, initial_partial_sums,
+                                                             chunk_size=None, block_size=block_size))
+        if compact:
+            return values, offsets
+        return np.split(values, offsets[1:-1])
+
+    def iterate_events_residuals(self, times, events, states, time_start, initial_partial_sums=0, chunk_size=10**6,
+                                 block_size=64):
+        r"""
+        Iterates over the events residuals :math:`r^e_n`
+        (see :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.compute_events_residuals`) by chunks of events,
+        so that the memory used by the output does not grow with the length of the sample path.
+        A residual belongs to the chunk that contains the event that completes it.
+
+        :type times: 1D numpy array of float
+        :param times: the times at which events occur.
+        :type events: 1D numpy array of int
+        :param events: the sequence of event types, `events[n]` is the event type of the `n` th event.
+        :type states: 1D numpy array of int
+        :param states: the sequence of states, `states[n]` is the new state of the system following the `n` th event.
+        :type time_start: float
+        :param time_start: the time at which we consider that the process started, prior times are treated as an
+                           initial condition.
+        :type initial_partial_sums: 3D numpy array
+        :param initial_partial_sums: the initial condition can also be given implicitly via the partial sums
+                                     :math:`S_{e',x,e}(-\infty, \mbox{time_start}]`.
+        :type chunk_size: int
+        :param chunk_size: the number of events per chunk. If None, all the events are processed in a single chunk.
+        :type block_size: int
+        :param block_size: when positive, the exponential decays of the kernels between consecutive events are computed
+                           by blocks of `block_size` events in a single vectorised loop before the recursion runs over
+                           the block; set to 0 to compute them event by event.
+        :rtype: generator of tuples of two 1D numpy arrays
+        :return: for each chunk, `(values, offsets)` where `values[offsets[e]:offsets[e+1]]` are the residuals
+                 of type `e` completed in this chunk.
+        """
+        times, events, states = self.kernel_arrays(times, events, states)
+        'Find the start index'
+        index_start = bisect.bisect_right(times, time_start)  # events at and before this time are treated as an initial condition
+        '''Initialise the partial sums S_{e',x',e} that will allow us to compute the residuals recursively.
+        Note that, here, we work with (alpha_{e',x',e'}/beta_{e',x',e'})*S_{e',x',e'} instead of S_{e',x',e}'''
+        impact_decay_ratios = np.divide(self.impact_coefficients, self.decay_coefficients)
+        partial_sums = cy.compute_partial_sums(impact_decay_ratios, self.decay_coefficients,
+                                               self.number_of_event_types, self.number_of_states,
+                                               times, events, states, index_start, time_start)
+        # Check if initial partial sums are given
         if len(np.shape(initial_partial_sums)) != 0:
-            s = initial_partial_sums
-            s = np.divide(s, self.decay_coefficients)
-        return cy.compute_events_residuals(self.base_rates,
-                                           self.impact_coefficients,
-                                           self.decay_coefficients,
-                                           self.number_of_event_types,
-                                           self.number_of_states,
-                                           times,
-                                           events,
-                                           states,
-                                           time_start,
-                                           s)
+            partial_sums += np.divide(initial_partial_sums, self.decay_coefficients)
+        'Only the kernels with non-zero impact coefficients or initial partial sums are visited'
+        kernels, source_indptr, source_kernels, target_indptr = \
+            self.active_kernels((self.impact_coefficients != 0) | (partial_sums != 0))
+        partial_sums = partial_sums[kernels]
+        sums_old = np.bincount(kernels[2], weights=partial_sums, minlength=self.number_of_event_types)
+        impact_coefficients = self.impact_coefficients[kernels]
+        decay_coefficients = self.decay_coefficients[kernels]
+        open_residuals = np.zeros(self.number_of_event_types)
+        'Compute residuals chunk by chunk, the partial sums and open residuals are updated in place'
+        number_of_events = len(times)
+        if chunk_size is None:
+            chunk_size = max(number_of_events - index_start, 1)
+        index = index_start
+        time_last = time_start
+        while True:
+            index_end = min(index + chunk_size, number_of_events)
+            yield cy.compute_events_residuals(self.base_rates,
+                                              impact_coefficients,
+                                              decay_coefficients,
+                                              kernels[2],
+                                              source_indptr,
+                                              source_kernels,
+                                              target_indptr,
+                                              self.number_of_event_types,
+                                              self.number_of_states,
+                                              times,
+                                              events,
+                                              states,
+                                              index,
+                                              index_end,
+                                              time_last,
+                                              partial_sums,
+                                              sums_old,
+                                              open_residuals,
+                                              block_size)
+            if index_end >= number_of_events:
+                break
+            index = index_end
+            time_last = times[index_end - 1]
 
     def compute_total_residuals(self, times, events, states, time_start, initial_partial_sums=0,
-                                initial_state = 0):
+                                initial_state = 0, compact=False, block_size=64):
         r"""
 
         Computes the total residuals :math:`r^{ex}_n` defined by
@@ -436,6 +1632,9 @@ class HybridHawkesExp:
 
         where :math:`t^{ex}_n` is the time when the `n` th event of type `e` after which the state is `x` occurred.
         The methods wraps a C implementation that was obtained via Cython.
+        The residuals of all marks are computed into a single array of size the number of events after
+        `time_start`, see :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.iterate_total_residuals`
+        to process long sample paths by chunks.
 
         :type times: 1D numpy array of float
         :param times: the times at which events occur.
@@ -451,30 +1650,114 @@ class HybridHawkesExp:
                                      :math:`S_{e',x,e}(-\infty, \mbox{time_start}]`.
         :type initial_state: int
         :param initial_state: if there are no event times before `time_start`, this is used as the initial state.
-        :rtype: list of 1D numpy arrays
+        :type compact: boolean
+        :param compact: set to True to get the residuals in the compact format `(values, offsets)`.
+        :type block_size: int
+        :param block_size: when positive, the exponential decays of the kernels between consecutive events are computed
+                           by blocks of `block_size` events in a single vectorised loop before the recursion runs over
+                           the block; set to 0 to compute them event by event.
+        :rtype: list of 1D numpy arrays, or tuple of two 1D numpy arrays if `compact` is True
         :return: the sequence :math:`(r^{ex}_n)` is the `x` + `e` * `number_of_states` th element in the list.
+                 In the compact format, this sequence is `values[offsets[m]:offsets[m+1]]`
+                 with `m` = `x` + `e` * `number_of_states`; the elements of the list are views of `values`.
         """
-        # Check if no initial partial sums if given
-        s = np.zeros((self.number_of_event_types, self.number_of_states, self.number_of_event_types))
+        values, offsets = next(self.iterate_total_residuals(times, events, states, time_start, initial_partial_sums,
+                                                            initial_state, chunk_size=None, block_size=block_size))
+        if compact:
+            return values, offsets
+        return np.split(values, offsets[1:-1])
+
+    def iterate_total_residuals(self, times, events, states, time_start, initial_partial_sums=0, initial_state=0,
+                                chunk_size=10**6, block_size=64):
+        r"""
+        Iterates over the total residuals :math:`r^{ex}_n`
+        (see :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.compute_total_residuals`) by chunks of events,
+        so that the memory used by the output does not grow with the length of the sample path.
+        A residual belongs to the chunk that contains the event that completes it.
+
+        :type times: 1D numpy array of float
+        :param times: the times at which events occur.
+        :type events: 1D numpy array of int
+        :param events: the sequence of event types, `events[n]` is the event type of the `n` th event.
+        :type states: 1D numpy array of int
+        :param states: the sequence of states, `states[n]` is the new state of the system following the `n` th event.
+        :type time_start: float
+        :param time_start: the time at which we consider that the process started, prior times are treated as an
+                           initial condition.
+        :type initial_partial_sums: 3D numpy array
+        :param initial_partial_sums: the initial condition can also be given implicitly via the partial sums
+                                     :math:`S_{e',x,e}(-\infty, \mbox{time_start}]`.
+        :type initial_state: int
+        :param initial_state: if there are no event times before `time_start`, this is used as the initial state.
+        :type chunk_size: int
+        :param chunk_size: the number of events per chunk. If None, all the events are processed in a single chunk.
+        :type block_size: int
+        :param block_size: when positive, the exponential decays of the kernels between consecutive events are computed
+                           by blocks of `block_size` events in a single vectorised loop before the recursion runs over
+                           the block; set to 0 to compute them event by event.
+        :rtype: generator of tuples of two 1D numpy arrays
+        :return: for each chunk, `(values, offsets)` where `values[offsets[m]:offsets[m+1]]` are the residuals
+                 of the mark `m` = `x` + `e` * `number_of_states` completed in this chunk.
+        """
+        times, events, states = self.kernel_arrays(times, events, states)
+        'Find the start index'
+        index_start = bisect.bisect_right(times, time_start)  # events at and before this time are treated as an initial condition
+        '''Initialise the partial sums S_{e',x',e} that will allow us to compute the residuals recursively.
+        Note that, here, we work with (alpha_{e',x',e'}/beta_{e',x',e'})*S_{e',x',e'} instead of S_{e',x',e}'''
+        impact_decay_ratios = np.divide(self.impact_coefficients, self.decay_coefficients)
+        partial_sums = cy.compute_partial_sums(impact_decay_ratios, self.decay_coefficients,
+                                               self.number_of_event_types, self.number_of_states,
+                                               times, events, states, index_start, time_start)
+        # Check if initial partial sums are given
         if len(np.shape(initial_partial_sums)) != 0:
-            s = initial_partial_sums
-            s = np.divide(s, self.decay_coefficients)
-        return cy.compute_total_residuals(self.transition_probabilities,
-                                          self.base_rates,
-                                          self.impact_coefficients,
-                                          self.decay_coefficients,
-                                          self.number_of_event_types,
-                                          self.number_of_states,
-                                          times,
-                                          events,
-                                          states,
-                                          time_start,
-                                          s,
-                                          initial_state)
+            partial_sums += np.divide(initial_partial_sums, self.decay_coefficients)
+        'Only the kernels with non-zero impact coefficients or initial partial sums are visited'
+        kernels, source_indptr, source_kernels, target_indptr = \
+            self.active_kernels((self.impact_coefficients != 0) | (partial_sums != 0))
+        partial_sums = partial_sums[kernels]
+        sums_old = np.bincount(kernels[2], weights=partial_sums, minlength=self.number_of_event_types)
+        impact_coefficients = self.impact_coefficients[kernels]
+        decay_coefficients = self.decay_coefficients[kernels]
+        open_residuals = np.zeros((self.number_of_event_types, self.number_of_states))
+        transition_indptr, transition_indices, transition_data = self.transition_probabilities_csr()
+        'Compute residuals chunk by chunk, the partial sums and open residuals are updated in place'
+        number_of_events = len(times)
+        if chunk_size is None:
+            chunk_size = max(number_of_events - index_start, 1)
+        index = index_start
+        time_last = time_start
+        while True:
+            index_end = min(index + chunk_size, number_of_events)
+            yield cy.compute_total_residuals(transition_indptr, transition_indices, transition_data,
+                                             self.base_rates,
+                                             impact_coefficients,
+                                             decay_coefficients,
+                                             kernels[2],
+                                             source_indptr,
+                                             source_kernels,
+                                             target_indptr,
+                                             self.number_of_event_types,
+                                             self.number_of_states,
+                                             times,
+                                             events,
+                                             states,
+                                             index,
+                                             index_end,
+                                             time_last,
+                                             initial_state,
+                                             partial_sums,
+                                             sums_old,
+                                             open_residuals,
+                                             block_size)
+            if index_end >= number_of_events:
+                break
+            index = index_end
+            time_last = times[index_end - 1]
 
     def simulate(self, time_start, time_end, initial_condition_times=[], initial_condition_events=[],
-                 initial_condition_states=[], initial_partial_sums=0, initial_state=0, max_number_of_events=10**6):
-        """
+                 initial_condition_states=[], initial_partial_sums=0, initial_state=0, max_number_of_events=10**6,
+                 check_stability=True, record_intensities=False):
+        r"""
         Simulates a sample path of the state-dependent Hawkes process.
         The methods wraps a C implementation that was obtained via Cython.
 
@@ -496,29 +1779,174 @@ class HybridHawkesExp:
         :type max_number_of_events: int
         :param max_number_of_events: the simulation stops when this number of events is reached
                                      (including the initial condition).
+        :type check_stability: boolean
+        :param check_stability: when True, a ValueError is raised before simulating if the
+                                :py:attr:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.branching_ratio` of the model
+                                is greater than or equal to one, since the number of events of a supercritical process
+                                explodes.
+        :type record_intensities: boolean
+        :param record_intensities: when True, the intensities and compensators at the event times are computed in
+                                   the same pass as the simulation and returned as well.
         :rtype: array, array of int, array of int
         :return: the times at which the events occur, their types and the values of the state process right after
                  each event. Note that these include the initial condition as well.
+                 When `record_intensities` is True, two 2D arrays are also returned:
+                 `array1[e, n]` is the intensity :math:`\lambda_e(t_n-)` right before the `n` th event and
+                 `array2[e, n]` is the compensator :math:`\int_{\mbox{time_start}}^{t_n}\lambda_e(t)dt`.
+                 Their entries that correspond to the initial condition are respectively NaN and zero.
         """
+        'Raise ValueError if the process is supercritical'
+        if check_stability:
+            branching_ratio = self.branching_ratio
+            if branching_ratio >= 1:
+                raise ValueError('the process is supercritical (branching ratio ' + str(branching_ratio) + ' >= 1), '
+                                 'set check_stability to False to simulate it anyway')
         # Check if no initial partial sums if given
         s = np.zeros((self.number_of_event_types, self.number_of_states, self.number_of_event_types))
         if len(np.shape(initial_partial_sums))!=0:
             s = initial_partial_sums
         # Convert the initial condition to np.arrays if required
         if type(initial_condition_times)!=np.ndarray:
-            initial_condition_times = np.asarray(initial_condition_times, dtype=np.float)
+            initial_condition_times = np.asarray(initial_condition_times, dtype=np.float64)
         if type(initial_condition_events)!=np.ndarray:
-            initial_condition_events = np.asarray(initial_condition_events, dtype=np.int)
+            initial_condition_events = np.asarray(initial_condition_events, dtype=np.int64)
         if type(initial_condition_states)!=np.ndarray:
-            initial_condition_states = np.asarray(initial_condition_states, dtype=np.int)
-        return cy.simulate(self.number_of_event_types, self.number_of_states, self.base_rates, self.impact_coefficients,
-                           self.decay_coefficients, self.transition_probabilities, initial_condition_times,
-                           initial_condition_events, initial_condition_states, s, initial_state,
-                           time_start, time_end, max_number_of_events)
+            initial_condition_states = np.asarray(initial_condition_states, dtype=np.int64)
+        'Only the kernels with non-zero impact coefficients or initial partial sums are visited'
+        kernels, source_indptr, source_kernels, target_indptr = \
+            self.active_kernels((self.impact_coefficients != 0) | (np.asarray(s) != 0))
+        transition_indptr, transition_indices, transition_data = self.transition_probabilities_csr()
+        return cy.simulate(self.number_of_event_types, self.number_of_states, self.base_rates,
+                           self.impact_coefficients[kernels], self.decay_coefficients[kernels], kernels[2],
+                           source_indptr, source_kernels, target_indptr, transition_indptr, transition_indices, transition_data,
+                           initial_condition_times,
+                           initial_condition_events, initial_condition_states,
+                           np.asarray(s, dtype=np.float64)[kernels], initial_state,
+                           time_start, time_end, max_number_of_events, int(record_intensities))
+
+    def simulate_first_passage_times(self, target_states, time_start, time_horizon, number_of_paths=1000,
+                                     initial_condition_times=[], initial_condition_events=[],
+                                     initial_condition_states=[], initial_partial_sums=0, initial_state=0,
+                                     max_number_of_events=10**6, quantile_levels=(0.1, 0.5, 0.9),
+                                     number_of_processes=1):
+        r"""
+        Simulates the first time at which the state process enters a target set of states.
+        Each sample path is stopped as soon as it hits the target set, so that only the hitting time and the number of
+        events are recorded. Paths that do not hit the target set within `time_horizon` are censored.
+        The paths are simulated by a C implementation that was obtained via Cython, in a single call or split
+        among worker processes.
+
+        :type target_states: list of int
+        :param target_states: the states that make up the target set.
+        :type time_start: float
+        :param time_start: time at which the simulation starts.
+        :type time_horizon: float
+        :param time_horizon: paths are censored if they do not hit the target set before `time_start` +
+                             `time_horizon`.
+        :type number_of_paths: int
+        :param number_of_paths: number of independent sample paths.
+        :type initial_condition_times: array
+        :param initial_condition_times: times of events before and including `time_start`.
+        :type initial_condition_events: array of int
+        :param initial_condition_events: types of the events that occurred at `initial_condition_times`.
+        :type initial_condition_states: array of int
+        :param initial_condition_states: values of the state process just after the `initial_condition_times`.
+        :type initial_partial_sums: 3D numpy array
+        :param initial_partial_sums: the initial condition can also be given implicitly via the partial sums
+                                     :math:`S_{e',x,e}(-\infty, \mbox{time_start}]`.
+        :type initial_state: int
+        :param initial_state: if there are no event times before `time_start`, this is used as the initial state.
+        :type max_number_of_events: int
+        :param max_number_of_events: a path is also censored when this number of events is reached.
+        :type quantile_levels: list of float
+        :param quantile_levels: levels of the quantiles of the hitting time that are reported in the summary.
+        :type number_of_processes: int
+        :param number_of_processes: the number of worker processes among which the paths are split; each worker
+                                    draws its random numbers from its own seed, which is drawn from `numpy.random`
+                                    so that the simulation can be reproduced with `numpy.random.seed`.
+                                    If 1, all the paths are simulated in the current process.
+        :rtype: 1D numpy array of float, 1D numpy array of int, 1D numpy array of bool, dict
+        :return: the hitting times measured from `time_start` (equal to `time_horizon` for censored paths), the
+                 number of events until the hitting time, whether each path hit the target set and a dictionary of
+                 summary statistics. The quantiles of the hitting time are infinite when their level exceeds the
+                 proportion of paths that hit the target set.
+        """
+        'Compute the partial sums and the state at time_start'
+        s = np.zeros((self.number_of_event_types, self.number_of_states, self.number_of_event_types))
+        if len(np.shape(initial_partial_sums)) != 0:
+            s = s + initial_partial_sums
+        state = initial_state
+        if len(initial_condition_times) > 0:
+            s = s + self.compute_partial_sums(np.asarray(initial_condition_times, dtype=np.float64),
+                                              initial_condition_events, initial_condition_states, time_start)
+            state = initial_condition_states[-1]
+        is_target_state = np.zeros(self.number_of_states, dtype=np.int64)
+        is_target_state[np.asarray(target_states, dtype=np.int64)] = 1
+        'Only the kernels with non-zero impact coefficients or initial partial sums are visited'
+        kernels, source_indptr, source_kernels, target_indptr = \
+            self.active_kernels((self.impact_coefficients != 0) | (s != 0))
+        transition_indptr, transition_indices, transition_data = self.transition_probabilities_csr()
+        simulation_arguments = (self.number_of_event_types, self.number_of_states, self.base_rates,
+                                self.impact_coefficients[kernels], self.decay_coefficients[kernels], kernels[2],
+                                source_indptr, source_kernels, target_indptr, transition_indptr, transition_indices,
+                                transition_data, s[kernels], state, is_target_state, time_horizon)
+        if number_of_processes == 1:
+            hitting_times, numbers_of_events, hits = \
+                cy.simulate_first_passage(*simulation_arguments, number_of_paths, max_number_of_events)
+        else:
+            'Split the paths among the workers, each of them with its own seed'
+            numbers_of_paths = [len(p) for p in np.array_split(np.arange(number_of_paths), number_of_processes)]
+            numbers_of_paths = [n for n in numbers_of_paths if n > 0]
+            seeds = np.random.randint(2**31 - 1, size=len(numbers_of_paths))
+            with ProcessPoolExecutor(max_workers=number_of_processes) as executor:
+                results = list(executor.map(HybridHawkesExp.simulate_first_passage_paths, seeds, numbers_of_paths,
+                                            [max_number_of_events] * len(numbers_of_paths),
+                                            [simulation_arguments] * len(numbers_of_paths)))
+            hitting_times, numbers_of_events, hits = [np.concatenate(r) for r in zip(*results)]
+        hits = hits.astype(bool)
+        'Summary statistics, censored hitting times are treated as infinite'
+        summary = {}
+        summary['hitting_probability'] = np.mean(hits)
+        summary['hitting_probability_standard_error'] = np.sqrt(summary['hitting_probability'] *
+                                                                (1 - summary['hitting_probability']) /
+                                                                number_of_paths)
+        summary['mean_number_of_events'] = np.mean(numbers_of_events)
+        summary['mean_hitting_time_given_hit'] = np.nan
+        summary['std_hitting_time_given_hit'] = np.nan
+        if np.any(hits):
+            summary['mean_hitting_time_given_hit'] = np.mean(hitting_times[hits])
+            summary['std_hitting_time_given_hit'] = np.std(hitting_times[hits])
+        sorted_times = np.sort(np.where(hits, hitting_times, np.inf))
+        indices = np.ceil(np.multiply(quantile_levels, number_of_paths)).astype(int) - 1
+        summary['quantile_levels'] = np.asarray(quantile_levels)
+        summary['hitting_time_quantiles'] = sorted_times[np.clip(indices, 0, number_of_paths - 1)]
+        return hitting_times, numbers_of_events, hits, summary
+
+    @staticmethod
+    def simulate_first_passage_paths(seed, number_of_paths, max_number_of_events, simulation_arguments):
+        r"""
+        Simulates a batch of paths of
+        :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.simulate_first_passage_times` in a worker process.
+
+        :type seed: int
+        :param seed: the seed of `numpy.random` in the worker, from which the random numbers of the batch are drawn.
+        :type number_of_paths: int
+        :param number_of_paths: number of independent sample paths of the batch.
+        :type max_number_of_events: int
+        :param max_number_of_events: a path is also censored when this number of events is reached.
+        :type simulation_arguments: tuple
+        :param simulation_arguments: the model, the active kernels, the initial condition, the target set and the
+                                     time horizon, as passed to the C implementation.
+        :rtype: 1D numpy array of float, 1D numpy array of int, 1D numpy array of int
+        :return: the hitting times, the numbers of events and whether each path hit the target set.
+        """
+        np.random.seed(seed)
+        return cy.simulate_first_passage(*simulation_arguments, number_of_paths, max_number_of_events)
 
     'Likelihood and gradient'
 
-    def log_likelihood_of_events(self, parameters, times, events, states, time_start, time_end):
+    def log_likelihood_of_events(self, parameters, times, events, states, time_start, time_end, structure=None,
+                                 time_scale=None, block_size=64):
         r"""
         Computes the log-likelihood of the observed times and event types under the assumption that they
         are the realisation of a state-dependent Hawkes process with the given parameters.
@@ -547,17 +1975,37 @@ class HybridHawkesExp:
                            initial condition.
         :type time_end: float
         :param time_end: :math:`T`, the time at which we stopped to record the process.
+        :type structure: :py:class:`~mpoints.parameter_structure.ParameterStructure`
+        :param structure: when given, `parameters` contains only the free parameters of this structure.
+        :type time_scale: float
+        :param time_scale: when given, the times are integer numbers of ticks (e.g., nanoseconds since an epoch) and
+                           `time_scale` is the duration of a tick, see
+                           :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.tick_times`.
+        :type block_size: int
+        :param block_size: when positive, the exponential decays between consecutive events are computed by blocks of
+                           `block_size` events in a single vectorised loop before the recursion runs over the block;
+                           set to 0 to compute them event by event. This does not apply in tick mode.
         :rtype: float
         :return: the log-likelihood :math:`l`.
         """
         number_of_event_types = self.number_of_event_types
         number_of_states = self.number_of_states
         base_rates, impact_coefficients, decay_coefficients = \
-            HybridHawkesExp.array_to_parameters(parameters, self.number_of_event_types, self.number_of_states)
-        return cy.log_likelihood_of_events(base_rates, impact_coefficients, decay_coefficients, number_of_event_types,
-                             number_of_states, times, events, states, np.float(time_start), np.float(time_end))
-
-    def gradient(self, parameters, times, events, states, time_start, time_end):
+            HybridHawkesExp.array_to_parameters(parameters, self.number_of_event_types, self.number_of_states,
+                                                structure=structure)
+        kernels, source_indptr, source_kernels, target_indptr = self.active_kernels(self.impact_mask(structure,
+                                                                                                    impact_coefficients))
+        decay_indices, number_of_decays = self.decay_indices(structure, kernels)
+        times, time_start, time_end, gaps, number_of_cached_gaps = self.tick_times(times, time_start, time_end,
+                                                                                   time_scale)
+        times, events, states = self.kernel_arrays(times, events, states)
+        return cy.log_likelihood_of_events(base_rates, impact_coefficients[kernels], decay_coefficients[kernels],
+                             number_of_event_types, number_of_states, times, events, states, float(time_start),
+                             float(time_end), decay_indices, number_of_decays, source_indptr, source_kernels,
+                             target_indptr, gaps, float(time_scale or 0), number_of_cached_gaps, block_size)
+
+    def gradient(self, parameters, times, events, states, time_start, time_end, structure=None, time_scale=None,
+                 block_size=64):
         r"""
         Computes the gradient of the log-likelihood :math:`l` with respect to the
         parameters :math:`(\nu, \alpha, \beta)`.
@@ -579,19 +2027,48 @@ class HybridHawkesExp:
                            initial condition.
         :type time_end: float
         :param time_end: :math:`T`, the time at which we stopped to record the process.
+        :type structure: :py:class:`~mpoints.parameter_structure.ParameterStructure`
+        :param structure: when given, `parameters` contains only the free parameters of this structure and
+                          the gradient is computed with respect to them.
+        :type time_scale: float
+        :param time_scale: when given, the times are integer numbers of ticks (e.g., nanoseconds since an epoch) and
+                           `time_scale` is the duration of a tick, see
+                           :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.tick_times`.
+        :type block_size: int
+        :param block_size: when positive, the exponential decays between consecutive events are computed by blocks of
+                           `block_size` events in a single vectorised loop before the recursion runs over the block;
+                           set to 0 to compute them event by event. This does not apply in tick mode.
         :rtype: float
         :return: the gradient of the log-likelihood :math:`l`.
         """
         number_of_event_types = self.number_of_event_types
         number_of_states = self.number_of_states
         base_rates, impact_coefficients, decay_coefficients = \
-            HybridHawkesExp.array_to_parameters(parameters, self.number_of_event_types, self.number_of_states)
-        g_base_rates, g_impact_coefficients, g_decay_coefficients =\
-            cy.gradient(base_rates, impact_coefficients, decay_coefficients, number_of_event_types,
-                             number_of_states, times, events, states, np.float(time_start), np.float(time_end))
-        return self.parameters_to_array(g_base_rates, g_impact_coefficients, g_decay_coefficients)
+            HybridHawkesExp.array_to_parameters(parameters, self.number_of_event_types, self.number_of_states,
+                                                structure=structure)
+        kernels, source_indptr, source_kernels, target_indptr = self.active_kernels(self.impact_mask(structure,
+                                                                                                    impact_coefficients))
+        decay_indices, number_of_decays = self.decay_indices(structure, kernels)
+        times, time_start, time_end, gaps, number_of_cached_gaps = self.tick_times(times, time_start, time_end,
+                                                                                   time_scale)
+        times, events, states = self.kernel_arrays(times, events, states)
+        g_base_rates, g_active_impact_coefficients, g_active_decay_coefficients =\
+            cy.gradient(base_rates, impact_coefficients[kernels], decay_coefficients[kernels], number_of_event_types,
+                             number_of_states, times, events, states, float(time_start), float(time_end),
+                             decay_indices, number_of_decays, source_indptr, source_kernels, target_indptr,
+                             gaps, float(time_scale or 0), number_of_cached_gaps, block_size)
+        'The derivatives with respect to the coefficients of the inactive kernels are not computed'
+        g_impact_coefficients = np.zeros(impact_coefficients.shape)
+        g_decay_coefficients = np.zeros(decay_coefficients.shape)
+        g_impact_coefficients[kernels] = g_active_impact_coefficients
+        g_decay_coefficients[kernels] = g_active_decay_coefficients
+        result = self.parameters_to_array(g_base_rates, g_impact_coefficients, g_decay_coefficients)
+        if structure is not None:
+            result = structure.gradient_to_free(result)
+        return result
 
-    def log_likelihood_of_events_partial(self, event_type, parameters, times, events, states, time_start, time_end):
+    def log_likelihood_of_events_partial(self, event_type, parameters, times, events, states, time_start, time_end,
+                                         structure=None, time_scale=None, block_size=64):
         r"""
         Computes the log-likelihood of the arrival times of events of the given type under the assumption that they
         are the realisation of a state-dependent Hawkes process with the given parameters.
@@ -625,19 +2102,43 @@ class HybridHawkesExp:
                            initial condition.
         :type time_end: float
         :param time_end: :math:`T`, the time at which we stopped to record the process.
+        :type structure: :py:class:`~mpoints.parameter_structure.ParameterStructure`
+        :param structure: when given, `parameters` contains only the free parameters of the structure
+                          restricted to the event type `e`, see
+                          :py:meth:`~mpoints.parameter_structure.ParameterStructure.partial`.
+        :type time_scale: float
+        :param time_scale: when given, the times are integer numbers of ticks (e.g., nanoseconds since an epoch) and
+                           `time_scale` is the duration of a tick, see
+                           :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.tick_times`.
+        :type block_size: int
+        :param block_size: when positive, the exponential decays between consecutive events are computed by blocks of
+                           `block_size` events in a single vectorised loop before the recursion runs over the block;
+                           set to 0 to compute them event by event. This does not apply in tick mode.
         :rtype: float
         :return: the partial log-likelihood :math:`l_e`.
         """
         number_of_event_types = self.number_of_event_types
         number_of_states = self.number_of_states
+        if structure is not None:
+            structure = structure.partial(event_type)
         base_rate, impact_coefficients, decay_coefficients = \
-            HybridHawkesExp.array_to_parameters(parameters, number_of_event_types, number_of_states, 1)
-        return cy.log_likelihood_of_events_partial(event_type, np.float(base_rate[0]), impact_coefficients[:,:,0],
-                                                   decay_coefficients[:,:,0],
+            HybridHawkesExp.array_to_parameters(parameters, number_of_event_types, number_of_states, 1,
+                                                structure=structure)
+        kernels, source_indptr, source_kernels, target_indptr = self.active_kernels(self.impact_mask(structure,
+                                                                                                    impact_coefficients))
+        decay_indices, number_of_decays = self.decay_indices(structure, kernels)
+        times, time_start, time_end, gaps, number_of_cached_gaps = self.tick_times(times, time_start, time_end,
+                                                                                   time_scale)
+        times, events, states = self.kernel_arrays(times, events, states)
+        return cy.log_likelihood_of_events_partial(event_type, float(base_rate[0]), impact_coefficients[kernels],
+                                                   decay_coefficients[kernels],
                                                    number_of_event_types, number_of_states, times, events, states,
-                                                   np.float(time_start), np.float(time_end))
+                                                   float(time_start), float(time_end), decay_indices,
+                                                   number_of_decays, source_indptr, gaps, float(time_scale or 0),
+                                                   number_of_cached_gaps, block_size)
 
-    def gradient_partial(self, event_type, parameters, times, events, states, time_start, time_end):
+    def gradient_partial(self, event_type, parameters, times, events, states, time_start, time_end,
+                         structure=None, time_scale=None, block_size=64):
         r"""
         Computes the gradient of the partial log-likelihood :math:`l_e` with respect to the
         parameters :math:`(\nu, \alpha, \beta)` that govern :math:`\lambda_e`, the intensity of events of type `e`.
@@ -663,22 +2164,468 @@ class HybridHawkesExp:
                            initial condition.
         :type time_end: float
         :param time_end: :math:`T`, the time at which we stopped to record the process.
+        :type structure: :py:class:`~mpoints.parameter_structure.ParameterStructure`
+        :param structure: when given, `parameters` contains only the free parameters of the structure
+                          restricted to the event type `e`, see
+                          :py:meth:`~mpoints.parameter_structure.ParameterStructure.partial`, and the
+                          gradient is computed with respect to them.
+        :type time_scale: float
+        :param time_scale: when given, the times are integer numbers of ticks (e.g., nanoseconds since an epoch) and
+                           `time_scale` is the duration of a tick, see
+                           :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.tick_times`.
+        :type block_size: int
+        :param block_size: when positive, the exponential decays between consecutive events are computed by blocks of
+                           `block_size` events in a single vectorised loop before the recursion runs over the block;
+                           set to 0 to compute them event by event. This does not apply in tick mode.
         :rtype: float
         :return: the gradient of the partial log-likelihood :math:`l_e`.
         """
         number_of_event_types = self.number_of_event_types
         number_of_states = self.number_of_states
+        if structure is not None:
+            structure = structure.partial(event_type)
         base_rate, impact_coefficients, decay_coefficients = \
-            HybridHawkesExp.array_to_parameters(parameters, number_of_event_types, number_of_states, 1)
+            HybridHawkesExp.array_to_parameters(parameters, number_of_event_types, number_of_states, 1,
+                                                structure=structure)
+        kernels, source_indptr, source_kernels, target_indptr = self.active_kernels(self.impact_mask(structure,
+                                                                                                    impact_coefficients))
+        decay_indices, number_of_decays = self.decay_indices(structure, kernels)
+        times, time_start, time_end, gaps, number_of_cached_gaps = self.tick_times(times, time_start, time_end,
+                                                                                   time_scale)
+        times, events, states = self.kernel_arrays(times, events, states)
         g_base_rate, g_impact_coefficients, g_decay_coefficients = \
-            cy.gradient_partial(event_type, np.float(base_rate[0]), impact_coefficients[:,:,0], decay_coefficients[:,:,0],
-                        number_of_event_types,
-                        number_of_states, times, events, states, np.float(time_start), np.float(time_end))
+            cy.gradient_partial(event_type, float(base_rate[0]), impact_coefficients[kernels],
+                        decay_coefficients[kernels], number_of_event_types,
+                        number_of_states, times, events, states, float(time_start), float(time_end),
+                        decay_indices, number_of_decays, source_indptr, gaps, float(time_scale or 0),
+                        number_of_cached_gaps, block_size)
+        'The derivatives with respect to the coefficients of the inactive kernels are not computed'
         a = np.zeros((number_of_event_types, number_of_states, 1))
         b = np.zeros((number_of_event_types, number_of_states, 1))
-        a[:, :, 0] = g_impact_coefficients
-        b[:, :, 0] = g_decay_coefficients
-        return self.parameters_to_array([g_base_rate], a, b)
+        a[kernels] = g_impact_coefficients
+        b[kernels] = g_decay_coefficients
+        result = self.parameters_to_array([g_base_rate], a, b)
+        if structure is not None:
+            result = structure.gradient_to_free(result)
+        return result
+
+    def hessian_partial(self, event_type, parameters, times, events, states, time_start, time_end,
+                        structure=None, time_scale=None):
+        r"""
+        Computes the Hessian of the partial log-likelihood :math:`l_e` with respect to the
+        parameters :math:`(\nu, \alpha, \beta)` that govern :math:`\lambda_e`, the intensity of events of type `e`.
+        The Hessian is computed exactly, with the same recursion on the partial sums :math:`S_{e'xe}` as the gradient.
+        The method wraps a C implementation that was obtained via Cython.
+
+        :type event_type: int
+        :param event_type: `e`, the event type for which we want to compute the Hessian of the partial
+                            log-likelihood :math:`l_e`.
+        :type parameters: 1D numpy array
+        :param parameters: only the parameters :math:`(\nu, \alpha, \beta)` that govern :math:`\lambda_e`  put into a single
+                           array.
+                           Go from `parameters` to :math:`(\nu, \alpha, \beta)` and vice versa using
+                           :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.array_to_parameters`
+                           and :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.parameters_to_array`.
+        :type times: 1D numpy array of float
+        :param times: the times at which events occur.
+        :type events: 1D numpy array of int
+        :param events: the sequence of event types, `events[n]` is the event type of the `n` th event.
+        :type states: 1D numpy array of int
+        :param states: the sequence of states, `states[n]` is the new state of the system following the `n` th event.
+        :type time_start: float
+        :param time_start: :math:`t_0`, the time at which we consider that the process started, prior times are treated as an
+                           initial condition.
+        :type time_end: float
+        :param time_end: :math:`T`, the time at which we stopped to record the process.
+        :type structure: :py:class:`~mpoints.parameter_structure.ParameterStructure`
+        :param structure: when given, `parameters` contains only the free parameters of the structure
+                          restricted to the event type `e`, see
+                          :py:meth:`~mpoints.parameter_structure.ParameterStructure.partial`, and the
+                          Hessian is computed with respect to them.
+        :type time_scale: float
+        :param time_scale: when given, the times are integer numbers of ticks (e.g., nanoseconds since an epoch) and
+                           `time_scale` is the duration of a tick, see
+                           :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.tick_times`.
+        :rtype: 2D numpy array
+        :return: the Hessian of the partial log-likelihood :math:`l_e`, the rows and columns are ordered as
+                 `parameters`.
+        """
+        number_of_event_types = self.number_of_event_types
+        number_of_states = self.number_of_states
+        if structure is not None:
+            structure = structure.partial(event_type)
+        base_rate, impact_coefficients, decay_coefficients = \
+            HybridHawkesExp.array_to_parameters(parameters, number_of_event_types, number_of_states, 1,
+                                                structure=structure)
+        kernels, source_indptr, source_kernels, target_indptr = self.active_kernels(self.impact_mask(structure,
+                                                                                                    impact_coefficients))
+        'The Hessian is computed on the times converted to floats'
+        times, time_start, time_end = self.tick_times(times, time_start, time_end, time_scale)[0:3]
+        times, events, states = self.kernel_arrays(times, events, states)
+        active_hessian = cy.hessian_partial(event_type, float(base_rate[0]), impact_coefficients[kernels],
+                                            decay_coefficients[kernels], number_of_event_types, number_of_states,
+                                            times, events, states, float(time_start), float(time_end),
+                                            source_indptr)
+        'Locate the coefficients of the active kernels in the array of parameters'
+        dimension = 1 + 2 * number_of_event_types * number_of_states
+        v, a, b = HybridHawkesExp.array_to_parameters(np.arange(dimension), number_of_event_types, number_of_states, 1)
+        indices = np.concatenate([v, a[kernels], b[kernels]]).astype(int)
+        result = np.zeros((dimension, dimension))
+        result[np.ix_(indices, indices)] = active_hessian
+        if structure is not None:
+            result = structure.hessian_to_free(result)
+        return result
+
+    def hessian(self, parameters, times, events, states, time_start, time_end, structure=None, time_scale=None):
+        r"""
+        Computes the Hessian of the log-likelihood :math:`l` with respect to the
+        parameters :math:`(\nu, \alpha, \beta)`.
+        Since :math:`l` is the sum of the partial log-likelihoods :math:`l_e`, which involve disjoint groups of
+        parameters, the Hessian is block diagonal (up to a permutation of the parameters) and the blocks are given by
+        :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.hessian_partial`.
+        The observed Fisher information is minus the Hessian evaluated at the maximum likelihood estimate.
+
+        :type parameters: 1D numpy array
+        :param parameters: the parameters :math:`(\nu, \alpha, \beta)` put into a single array.
+                           Go from `parameters` to :math:`(\nu, \alpha, \beta)` and vice versa using
+                           :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.array_to_parameters`
+                           and :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.parameters_to_array`.
+        :type times: 1D numpy array of float
+        :param times: the times at which events occur.
+        :type events: 1D numpy array of int
+        :param events: the sequence of event types, `events[n]` is the event type of the `n` th event.
+        :type states: 1D numpy array of int
+        :param states: the sequence of states, `states[n]` is the new state of the system following the `n` th event.
+        :type time_start: float
+        :param time_start: :math:`t_0`, the time at which we consider that the process started, prior times are treated as an
+                           initial condition.
+        :type time_end: float
+        :param time_end: :math:`T`, the time at which we stopped to record the process.
+        :type structure: :py:class:`~mpoints.parameter_structure.ParameterStructure`
+        :param structure: when given, `parameters` contains only the free parameters of this structure and
+                          the Hessian is computed with respect to them.
+        :rtype: 2D numpy array
+        :return: the Hessian of the log-likelihood :math:`l`, the rows and columns are ordered as `parameters`.
+        """
+        if structure is not None:
+            parameters = structure.free_to_full(parameters)
+        dimension = self.number_of_event_types * (1 + 2 * self.number_of_event_types * self.number_of_states)
+        result = np.zeros((dimension, dimension))
+        for e in range(self.number_of_event_types):
+            indices = self.partial_parameters_indices(e, self.number_of_event_types, self.number_of_states)
+            result[np.ix_(indices, indices)] = self.hessian_partial(e, parameters[indices], times, events, states,
+                                                                    time_start, time_end, time_scale=time_scale)
+        if structure is not None:
+            result = structure.hessian_to_free(result)
+        return result
+
+    @staticmethod
+    def impact_mask(structure, impact_coefficients):
+        r"""
+        Determines the kernels :math:`(e', x, e)` that the likelihood, gradient and Hessian kernels visit: those whose
+        impact coefficients are free in the structure, or all of them when no structure is given.
+
+        :type structure: :py:class:`~mpoints.parameter_structure.ParameterStructure`
+        :param structure: the structure of the parameters, None if all the parameters are free.
+        :type impact_coefficients: 3D numpy array
+        :param impact_coefficients: the collection :math:`(\alpha_{e'xe})`.
+        :rtype: 3D numpy array of boolean
+        :return: the active kernels.
+        """
+        if structure is not None:
+            return structure.impact_mask
+        return np.ones(np.shape(impact_coefficients), dtype=bool)
+
+    @staticmethod
+    def active_kernels(active):
+        r"""
+        Lists the active kernels :math:`(e', x, e)` in the sparse format used by the Cython engines, which only visit
+        these kernels. Kernels whose impact coefficients vanish do not contribute to the intensities, skipping them
+        makes large models with a sparse excitation structure tractable.
+        Internally, the kernels are stored in target-major order :math:`(e, e', x)`: the kernels that contribute to the
+        intensity of events of type `e` are contiguous, so that computing an intensity is a contiguous sum, while the
+        kernels that jump at an event of type :math:`e'` after which the state is `x` are located through a
+        permutation. The conversion from the :math:`(e', x, e)` arrays of the API is done once, here.
+
+        :type active: 3D numpy array of boolean
+        :param active: `active[e',x,e]` is True when the kernel :math:`(e', x, e)` is visited.
+        :rtype: tuple of three 1D numpy arrays of int, 1D numpy array of int, 1D numpy array of int,
+                1D numpy array of int
+        :return: `kernels`, such that `coefficients[kernels]` are the coefficients of the `K` active kernels in
+                 target-major order; `source_indptr` and `source_kernels`, such that the kernels of the source
+                 :math:`(e', x)` are `source_kernels[source_indptr[m]:source_indptr[m+1]]` where
+                 `m` = `e' * number_of_states + x`; `target_indptr`, such that the kernels of the target `e` are
+                 `target_indptr[e]`, ..., `target_indptr[e+1] - 1`.
+        """
+        active = np.asarray(active, dtype=bool)
+        number_of_event_types_1, number_of_states, number_of_event_types_2 = active.shape
+        targets, event_types, states = np.nonzero(HybridHawkesExp.target_major(active))
+        kernels = (event_types, states, targets)
+        number_of_sources = number_of_event_types_1 * number_of_states
+        sources = event_types * number_of_states + states
+        source_indptr = np.zeros(number_of_sources + 1, dtype=np.int64)
+        source_indptr[1:] = np.cumsum(np.bincount(sources, minlength=number_of_sources))
+        source_kernels = np.argsort(sources, kind='stable').astype(np.int64)
+        target_indptr = np.zeros(number_of_event_types_2 + 1, dtype=np.int64)
+        target_indptr[1:] = np.cumsum(np.bincount(targets, minlength=number_of_event_types_2))
+        return kernels, source_indptr, source_kernels, target_indptr
+
+    @staticmethod
+    def target_major(coefficients):
+        r"""
+        Converts a collection of coefficients :math:`(c_{e'xe})` to the target-major layout, in which
+        `array[e, e', x]` is :math:`c_{e'xe}`. In this layout, the coefficients that govern the intensity of events of
+        type `e` are contiguous.
+
+        :type coefficients: 3D numpy array
+        :param coefficients: `coefficients[e',x,e]` is :math:`c_{e'xe}`.
+        :rtype: 3D numpy array
+        :return: the coefficients in the target-major layout, in C order.
+        """
+        return np.ascontiguousarray(np.transpose(coefficients, (2, 0, 1)))
+
+    @staticmethod
+    def source_major(coefficients):
+        r"""
+        Converts a collection of coefficients in the target-major layout back to the :math:`(e', x, e)` layout of
+        the API, see :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.target_major`.
+
+        :type coefficients: 3D numpy array
+        :param coefficients: `coefficients[e,e',x]` is :math:`c_{e'xe}`.
+        :rtype: 3D numpy array
+        :return: `array[e',x,e]` is :math:`c_{e'xe}`.
+        """
+        return np.ascontiguousarray(np.transpose(coefficients, (1, 2, 0)))
+
+    @staticmethod
+    def decay_indices(structure, kernels):
+        r"""
+        Labels the distinct decay coefficients of the active kernels for the likelihood and gradient kernels, which
+        compute the exponential decays once per distinct decay coefficient.
+
+        :type structure: :py:class:`~mpoints.parameter_structure.ParameterStructure`
+        :param structure: the structure of the parameters, None if all the decay coefficients are free.
+        :type kernels: tuple of three 1D numpy arrays of int
+        :param kernels: the active kernels, see :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.active_kernels`.
+        :rtype: 1D numpy array of int, int
+        :return: the label of the decay coefficient of every active kernel and the number of distinct labels.
+        """
+        if structure is not None:
+            distinct_labels, labels = np.unique(structure.decay_indices[kernels], return_inverse=True)
+            return labels.astype(np.int64), len(distinct_labels)
+        number_of_kernels = len(kernels[0])
+        return np.arange(number_of_kernels), number_of_kernels
+
+    @staticmethod
+    def partial_parameters_indices(event_type, number_of_event_types, number_of_states):
+        r"""
+        Locates the parameters that govern :math:`\lambda_e` in the array of all the parameters.
+
+        :type event_type: int
+        :param event_type: the event type `e`.
+        :type number_of_event_types: int
+        :param number_of_event_types: number of event types.
+        :type number_of_states: int
+        :param number_of_states: number of states.
+        :rtype: 1D numpy array of int
+        :return: `indices` such that `parameters[indices]` are the parameters of the event type `e`, ordered as in
+                 :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.log_likelihood_of_events_partial`.
+        """
+        dimension = number_of_event_types + 2 * number_of_event_types * number_of_event_types * number_of_states
+        v, a, b = HybridHawkesExp.array_to_parameters(np.arange(dimension), number_of_event_types, number_of_states)
+        indices = HybridHawkesExp.parameters_to_array(v[event_type:event_type+1], a[:,:,event_type:event_type+1],
+                                                      b[:,:,event_type:event_type+1])
+        return indices.astype(int)
+
+    @staticmethod
+    def kernel_arrays(times, events, states):
+        r"""
+        Prepares the times, event types and states for the Cython kernels, which read float32 or float64 times and
+        event types and states stored in any signed integer type, e.g., int8 or int16.
+        Arrays of these types are passed without copies, so that compact arrays can be used directly; the event types
+        and states must however share their type and are otherwise converted to a common type.
+
+        :type times: 1D numpy array of float
+        :param times: the times at which events occur.
+        :type events: 1D numpy array of int
+        :param events: the sequence of event types.
+        :type states: 1D numpy array of int
+        :param states: the sequence of states.
+        :rtype: 1D numpy array of float, 1D numpy array of int, 1D numpy array of int
+        :return: the times, event types and states in types that the kernels can read.
+        """
+        times = np.asarray(times)
+        if times.dtype != np.float32:
+            times = times.astype(np.float64, copy=False)
+        events = np.asarray(events)
+        states = np.asarray(states)
+        mark_type = np.result_type(events, states)
+        if mark_type not in [np.int8, np.int16, np.int32, np.int64]:
+            mark_type = np.int64
+        return times, events.astype(mark_type, copy=False), states.astype(mark_type, copy=False)
+
+    @staticmethod
+    def tick_times(times, time_start, time_end, time_scale=None, number_of_cached_gaps=1024):
+        r"""
+        Prepares the times for the likelihood and gradient kernels.
+        In tick mode, the times are integer numbers of ticks, e.g., nanoseconds since an epoch, and a tick lasts
+        `time_scale` units of time. The times are then shifted to :math:`t_0` before they are converted to floats, so
+        that no precision is lost when the epoch is far away, and the kernels read the decay factors
+        :math:`e^{-\beta g \delta}` of the gaps of :math:`g` ticks between events from tables instead of computing
+        exponentials: with :math:`S` = `number_of_cached_gaps`, the factors of the gaps :math:`g = qS + r` are the
+        products of two tabulated factors, for :math:`r < S` and :math:`q \leq S`, and the exponentials are only computed
+        for the rare gaps larger than :math:`S(S+1)` ticks.
+
+        :type times: 1D numpy array of float or int
+        :param times: the times at which events occur, integer numbers of ticks in tick mode.
+        :type time_start: float or int
+        :param time_start: the time at which we consider that the process started.
+        :type time_end: float or int
+        :param time_end: the time at which we stopped to record the process.
+        :type time_scale: float
+        :param time_scale: the duration of a tick, None when the times are floats.
+        :type number_of_cached_gaps: int
+        :param number_of_cached_gaps: the maximum number of tabulated gaps per decay coefficient.
+        :rtype: 1D numpy array of float, float, float, 1D numpy array of int, int
+        :return: the times, `time_start` and `time_end` as floats, the gaps in ticks between every event and the
+                 previous one (or :math:`t_0`) and the number of tabulated gaps, which is 0 when the times are floats.
+        """
+        if time_scale is None:
+            return times, time_start, time_end, np.zeros(0, dtype=np.int64), 0
+        ticks = np.asarray(times)
+        if not np.issubdtype(ticks.dtype, np.integer) or time_start != int(time_start) or time_end != int(time_end):
+            raise ValueError('in tick mode, the times, time_start and time_end must be integer numbers of ticks')
+        ticks = ticks.astype(np.int64)
+        time_start = int(time_start)
+        time_end = int(time_end)
+        'The events at and before time_start are an initial condition, the first gap is counted from time_start'
+        index_start = np.searchsorted(ticks, time_start, side='right')
+        gaps = np.zeros(len(ticks), dtype=np.int64)
+        gaps[index_start:] = np.diff(ticks[index_start:], prepend=time_start)
+        number_of_cached_gaps = int(min(number_of_cached_gaps, np.max(gaps, initial=0) + 1))
+        return (ticks - time_start) * time_scale, 0.0, (time_end - time_start) * time_scale, gaps, \
+               number_of_cached_gaps
+
+    'Forecasting'
+
+    def expected_number_of_events(self, horizons, partial_sums, states):
+        r"""
+        Computes the expected number of events of each type in the next :math:`\Delta` units of time, given the
+        current partial sums :math:`S_{e'xe}` and the current state.
+        No simulation is required: the expectations solve a linear system of ordinary differential equations,
+
+        .. math::
+
+            \frac{d}{dt}\mathbb{E}[S_{e'xe}(t)] = -\beta_{e'xe}\mathbb{E}[S_{e'xe}(t)]
+            + \alpha_{e'xe}\phi_{e'}(x_0, x)\mathbb{E}[\lambda_{e'}(t)], \quad
+            \frac{d}{dt}\mathbb{E}[N_e(t)] = \mathbb{E}[\lambda_e(t)],
+
+        which is evaluated with a matrix exponential.
+        The state :math:`x_0` after which the transition probabilities :math:`\phi` are applied is held fixed over the
+        horizon. The result is exact when :math:`\phi_{e}(x_0, \cdot)` does not depend on :math:`x_0` (for instance
+        when there is a single state) and is otherwise a first-order approximation that is accurate over short
+        horizons.
+
+        :type horizons: 1D numpy array of float
+        :param horizons: the lengths of time :math:`\Delta` over which events are counted.
+        :type partial_sums: 3D or 4D numpy array of float
+        :param partial_sums: the current partial sums :math:`S_{e'xe}`, as returned by
+                             :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.compute_partial_sums`.
+                             Several starting points can be stacked along a first additional dimension.
+        :type states: int or 1D numpy array of int
+        :param states: the current state, one per starting point.
+        :rtype: 2D or 3D numpy array of float
+        :return: `array[n, i, e]` is the expected number of events of type `e` within `horizons[i]` when starting
+                 from `partial_sums[n]` and `states[n]`. The first dimension is dropped when `partial_sums` is 3D.
+        """
+        import scipy.linalg as linalg
+        number_of_event_types = self.number_of_event_types
+        number_of_states = self.number_of_states
+        size = number_of_event_types * number_of_states * number_of_event_types
+        horizons = np.atleast_1d(np.asarray(horizons, dtype=float))
+        single_start = np.ndim(partial_sums) == 3
+        partial_sums = np.reshape(partial_sums, (-1, size))
+        states = np.broadcast_to(np.atleast_1d(states), (len(partial_sums),))
+        'Linear map from the partial sums to the intensities, the index of S_{e1,x,e2} being (e1 * d_x + x) * d_e + e2'
+        to_intensities = np.zeros((number_of_event_types, number_of_event_types, number_of_states,
+                                   number_of_event_types))
+        for e in range(number_of_event_types):
+            to_intensities[e, :, :, e] = 1
+        to_intensities = np.reshape(to_intensities, (number_of_event_types, size))
+        sources = np.repeat(np.arange(number_of_event_types), number_of_states * number_of_event_types)
+        transition_indptr, transition_indices, transition_data = self.transition_probabilities_csr()
+        result = np.zeros((len(partial_sums), len(horizons), number_of_event_types))
+        for state in np.unique(states):
+            starts = np.nonzero(states == state)[0]
+            'Build the generator of the affine system satisfied by (E[S], E[N], 1)'
+            next_states = np.zeros((number_of_event_types, number_of_states))
+            for e in range(number_of_event_types):
+                start = transition_indptr[state * number_of_event_types + e]
+                end = transition_indptr[state * number_of_event_types + e + 1]
+                next_states[e, transition_indices[start:end]] = transition_data[start:end]
+            rates = np.multiply(self.impact_coefficients, next_states[:, :, np.newaxis]).ravel()
+            generator = np.zeros((size + number_of_event_types + 1, size + number_of_event_types + 1))
+            generator[0:size, 0:size] = rates[:, np.newaxis] * to_intensities[sources]
+            generator[0:size, 0:size] -= np.diag(self.decay_coefficients.ravel())
+            generator[0:size, -1] = rates * self.base_rates[sources]
+            generator[size:size + number_of_event_types, 0:size] = to_intensities
+            generator[size:size + number_of_event_types, -1] = self.base_rates
+            initial_values = np.zeros((len(starts), size + number_of_event_types + 1))
+            initial_values[:, 0:size] = partial_sums[starts]
+            initial_values[:, -1] = 1
+            for i in range(len(horizons)):
+                values = np.dot(initial_values, linalg.expm(horizons[i] * generator).T)
+                result[starts, i, :] = values[:, size:size + number_of_event_types]
+        if single_start:
+            return result[0]
+        return result
+
+    def next_event_probabilities(self, horizons, partial_sums, number_of_points=1000):
+        r"""
+        Computes the probability that the next event occurs within :math:`\Delta` units of time and is of type `e`,
+
+        .. math::
+
+            \mathbb{P}(\tau \leq \Delta, e_{next} = e) = \int_0^\Delta \lambda_e(s)
+            \exp\Big(-\sum_{e'}\int_0^s\lambda_{e'}(u)du\Big)ds.
+
+        Until the next event, the intensities decay deterministically from the given partial sums so that the
+        integrand is known in closed form. The integral is evaluated with the trapezoidal rule.
+
+        :type horizons: 1D numpy array of float
+        :param horizons: the lengths of time :math:`\Delta`.
+        :type partial_sums: 3D or 4D numpy array of float
+        :param partial_sums: the current partial sums :math:`S_{e'xe}`, as returned by
+                             :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.compute_partial_sums`.
+                             Several starting points can be stacked along a first additional dimension.
+        :type number_of_points: int
+        :param number_of_points: number of points of the integration grid over :math:`[0, \max \Delta]`.
+        :rtype: 2D or 3D numpy array of float
+        :return: `array[n, i, e]` is the probability that the next event is of type `e` and occurs within
+                 `horizons[i]` when starting from `partial_sums[n]`.
+                 The first dimension is dropped when `partial_sums` is 3D.
+        """
+        number_of_event_types = self.number_of_event_types
+        horizons = np.atleast_1d(np.asarray(horizons, dtype=float))
+        single_start = np.ndim(partial_sums) == 3
+        partial_sums = np.reshape(partial_sums, (-1, number_of_event_types * self.number_of_states,
+                                                 number_of_event_types))
+        betas = np.reshape(self.decay_coefficients, (1, -1, number_of_event_types))
+        'Integration grid that contains the horizons'
+        grid = np.union1d(np.linspace(0, np.max(horizons), number_of_points), horizons)
+        decays = np.exp(- betas * grid[:, np.newaxis, np.newaxis])
+        intensities = self.base_rates + np.einsum('nke,ske->nse', partial_sums, decays)
+        compensators = np.multiply.outer(grid, self.base_rates)
+        compensators = compensators + np.einsum('nke,ske->nse', partial_sums, np.divide(1 - decays, betas))
+        densities = intensities * np.exp(- np.sum(compensators, axis=2))[:, :, np.newaxis]
+        'Cumulative trapezoidal rule'
+        increments = 0.5 * (densities[:, 1:, :] + densities[:, :-1, :]) * np.diff(grid)[np.newaxis, :, np.newaxis]
+        cumulative = np.zeros_like(densities)
+        cumulative[:, 1:, :] = np.cumsum(increments, axis=1)
+        result = cumulative[:, np.searchsorted(grid, horizons), :]
+        if single_start:
+            return result[0]
+        return result
 
     'Miscellaneous tools'
 
@@ -708,16 +2655,17 @@ class HybridHawkesExp:
         next_event_time = time_end + 1  # in case there is no event after 'time_start'
         if next_event_time_index < len(times):  # i.e. there is an event time after
             next_event_time = times[next_event_time_index]
-        '''Initialise the partial sums S_{e',x',e} that will allow use to compute the intensity recursively'''
-        partial_sums = np.zeros((self.number_of_event_types, self.number_of_states, self.number_of_event_types))
+        '''Initialise the partial sums S_{e',x',e} that will allow use to compute the intensity recursively.
+        They are stored in the target-major layout (e,e',x), so that the intensities are contiguous sums'''
+        impact_coefficients = self.target_major(self.impact_coefficients)
+        decay_coefficients = self.target_major(self.decay_coefficients)
+        partial_sums = np.zeros((self.number_of_event_types, self.number_of_event_types, self.number_of_states))
         for n in range(next_event_time_index):
             time = times[n]
             event = events[n]
             state = states[n]
-            for e in range(self.number_of_event_types):
-                alpha = self.impact_coefficients[event, state, e]
-                beta = self.decay_coefficients[event, state, e]
-                partial_sums[event, state, e] += alpha * math.exp(-beta * (time_start - time))
+            partial_sums[:, event, state] += impact_coefficients[:, event, state] * \
+                np.exp(-decay_coefficients[:, event, state] * (time_start - time))
         'Create aggregated sequence of times, events, and states (event times + compute times)'
         times_aggregated = []
         events_aggregated = []
@@ -750,29 +2698,21 @@ class HybridHawkesExp:
         'Compute the intensities at the aggregated times'
         number_of_times = len(times_aggregated)
         result_intensities = np.zeros((self.number_of_event_types, number_of_times))
-        intensities = self.intensities_of_events(partial_sums)
-        for e in range(self.number_of_event_types):
-            result_intensities[e, 0] = intensities[e]
+        partial_sums = partial_sums.reshape((self.number_of_event_types, -1))
+        decay_coefficients = decay_coefficients.reshape((self.number_of_event_types, -1))
+        result_intensities[:, 0] = self.base_rates + np.sum(partial_sums, axis=1)
         for n in range(1, number_of_times):
             time_increment = times_aggregated[n] - times_aggregated[n-1]
             event = events_aggregated[n]
             'Update partial sums: time decay effect'
             if time_increment > 0:
-                for e1 in range(self.number_of_event_types):
-                    for x in range(self.number_of_states):
-                        for e2 in range(self.number_of_event_types):
-                            beta = self.decay_coefficients[e1, x, e2]
-                            partial_sums[e1, x, e2] *= math.exp(-beta * time_increment)
+                partial_sums *= np.exp(-decay_coefficients * time_increment)
             'Update partial sums: impact of new event'
             if event >= 0:
                 state = states_aggregated[n]
-                for e2 in range(self.number_of_event_types):
-                    alpha = self.impact_coefficients[event, state, e2]
-                    partial_sums[event, state, e2] += alpha
+                partial_sums[:, event * self.number_of_states + state] += impact_coefficients[:, event, state]
             'Compute intensities and save'
-            intensities = self.intensities_of_events(partial_sums)
-            for e1 in range(self.number_of_event_types):
-                result_intensities[e1, n] = intensities[e1]
+            result_intensities[:, n] = self.base_rates + np.sum(partial_sums, axis=1)
         return times_aggregated, result_intensities
 
     def compute_partial_sums(self, times, events, states, time_end,
@@ -855,7 +2795,7 @@ class HybridHawkesExp:
         return result
 
     @staticmethod
-    def parameters_to_array(base_rates, impact_coefficients, decay_coefficients):
+    def parameters_to_array(base_rates, impact_coefficients, decay_coefficients, structure=None):
         r"""
         Puts the model parameters :math:`(\nu, \alpha, \beta)` into a one dimensional array.
 
@@ -865,9 +2805,14 @@ class HybridHawkesExp:
         :param impact_coefficients: the collection :math:`(\alpha_{e'xe})`.
         :type decay_coefficients: 3D numpy array
         :param decay_coefficients: the collection :math:`(\beta_{e'xe})`.
+        :type structure: :py:class:`~mpoints.parameter_structure.ParameterStructure`
+        :param structure: when given, only the free parameters of this structure are put into the array, see
+                          :py:meth:`~mpoints.parameter_structure.ParameterStructure.parameters_to_array`.
         :rtype: 1D numpy array
         :return: the parameters put into a single 1D array.
         """
+        if structure is not None:
+            return structure.parameters_to_array(base_rates, impact_coefficients, decay_coefficients)
         s = np.shape(impact_coefficients)
         number_of_event_types_1 = s[0]
         number_of_states = s[1]
@@ -893,7 +2838,8 @@ class HybridHawkesExp:
         return result
 
     @staticmethod
-    def array_to_parameters(array, number_of_event_types_1, number_of_states, number_of_event_types_2=0):
+    def array_to_parameters(array, number_of_event_types_1, number_of_states, number_of_event_types_2=0,
+                            structure=None):
         r"""
         Retrieves the parameters :math:`(\nu, \alpha, \beta)` from a 1D array.
         It is NOT assumed that the length of the 1st and 3rd dimensions of the arrays :math:`(\alpha_{e'xe})` and
@@ -916,9 +2862,14 @@ class HybridHawkesExp:
                                         and not only a subgroup, meaning that
                                         1st and 3rd dimensions of the arrays :math:`(\alpha_{e'xe})` and
                                         :math:`(\beta_{e'xe})` are equal.
+        :type structure: :py:class:`~mpoints.parameter_structure.ParameterStructure`
+        :param structure: when given, `array` contains only the free parameters of this structure, whose dimensions
+                          must match those given.
         :rtype: 1D numpy array, 3D numpy array, 3D numpy array
         :return: the parameters :math:`(\nu, \alpha, \beta)`.
         """
+        if structure is not None:
+            return structure.array_to_parameters(array)
         if number_of_event_types_2 == 0:
             number_of_event_types_2 = number_of_event_types_1
         base_rates = np.zeros(number_of_event_types_2)
@@ -2,51 +2,168 @@
 
 import numpy as np
 cimport numpy as np
-import bisect
 from libc.math cimport exp
 from libc.math cimport log
 # from libc.stdlib cimport rand, RAND_MAX, srand
 
-DTYPEf = np.float
-DTYPEi = np.int
-ctypedef np.float_t DTYPEf_t
-ctypedef np.int_t DTYPEi_t
+DTYPEf = np.float64
+DTYPEi = np.int64
+ctypedef np.float64_t DTYPEf_t
+ctypedef np.int64_t DTYPEi_t
+'''The event times, event types and states are read through typed memoryviews, without copies: the times can be
+float32 or float64 and the event types and states can be stored in any signed integer type, e.g., int8 or int16.
+The memoryviews are const so that read-only arrays, e.g., memory-mapped files, are accepted as well; the fused types
+are listed as C types because Cython 0.29 cannot generate const memoryviews of the numpy typedefs'''
+ctypedef fused TIME_t:
+    float
+    double
+ctypedef fused MARK_t:
+    signed char
+    short
+    int
+    long long
+
+cdef inline int bisect_right(const TIME_t[:] times, DTYPEf_t time):
+    '''Returns the number of times that are smaller than or equal to time, the times being sorted'''
+    cdef int low = 0
+    cdef int high = times.shape[0]
+    cdef int middle
+    while low < high:
+        middle = (low + high) // 2
+        if time < times[middle]:
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+def decay_tables(np.ndarray[DTYPEf_t, ndim=1] decay_coefficients,
+                 DTYPEf_t time_scale,
+                 int number_of_cached_gaps):
+    """
+    Tabulates the decay factors of the gaps between events in tick mode.
+    A gap of g = q*S+r ticks, where S is the number of cached gaps and 0 <= r < S, decays the partial sums by
+    table[d, r]*steps[d, q] when q <= S, so that the exponentials of the gaps smaller than S*(S+1) are not computed.
+    :param decay_coefficients: the distinct decay coefficients beta_d
+    :param time_scale: the duration of a tick
+    :param number_of_cached_gaps: the number S of tabulated gaps
+    :return: table[d, r] = exp(-beta_d*time_scale*r) for r = 0, ..., S-1 and
+    steps[d, q] = exp(-beta_d*time_scale*S*q) for q = 0, ..., S.
+    """
+    cdef int number_of_decays = decay_coefficients.shape[0]
+    cdef np.ndarray[DTYPEf_t, ndim=2] table = np.zeros((number_of_decays, number_of_cached_gaps), dtype=DTYPEf)
+    cdef np.ndarray[DTYPEf_t, ndim=2] steps = np.zeros((number_of_decays, number_of_cached_gaps + 1), dtype=DTYPEf)
+    cdef int d, g
+    for d in range(number_of_decays):
+        for g in range(number_of_cached_gaps):
+            table[d, g] = exp(-decay_coefficients[d] * time_scale * g)
+        for g in range(number_of_cached_gaps + 1):
+            steps[d, g] = exp(-decay_coefficients[d] * time_scale * number_of_cached_gaps * g)
+    return table, steps
+
+cdef inline void tick_decays(int number_of_decays, long gap, int number_of_cached_gaps, DTYPEf_t* table,
+                             DTYPEf_t* steps, DTYPEf_t* decay_coefficients, DTYPEf_t time_scale, DTYPEf_t* decays):
+    '''Computes the decay factors of a gap of the given number of ticks: the gaps smaller than S*(S+1) are read from the
+    tables of decay_tables and the exponentials of the rare larger gaps are computed directly'''
+    cdef int d
+    cdef long quotient = gap // number_of_cached_gaps
+    cdef long remainder = gap - quotient * number_of_cached_gaps
+    cdef long number_of_steps = number_of_cached_gaps + 1
+    if quotient == 0:
+        for d in range(number_of_decays):
+            decays[d] = table[d * number_of_cached_gaps + gap]
+    elif quotient <= number_of_cached_gaps:
+        for d in range(number_of_decays):
+            decays[d] = table[d * number_of_cached_gaps + remainder] * steps[d * number_of_steps + quotient]
+    else:
+        for d in range(number_of_decays):
+            decays[d] = exp(-decay_coefficients[d] * time_scale * gap)
+
+cdef inline void block_decays(const TIME_t[:] times, int index_start, int index_end, DTYPEf_t previous_time,
+                              int number_of_decays, DTYPEf_t* decay_coefficients, DTYPEf_t* block):
+    '''Computes the decay factors of the events index_start, ..., index_end-1 at once, the decay factor of the n-th
+    event for the decay coefficient beta_d being block[(n-index_start)*number_of_decays+d] = exp(-beta_d*(t_n-t_{n-1})).
+    The exponents are written first so that the exponentials are evaluated in a single flat loop, which the compiler
+    vectorises'''
+    cdef int n, d, i
+    cdef DTYPEf_t time_increment
+    for n in range(index_start, index_end):
+        time_increment = times[n] - previous_time
+        previous_time = times[n]
+        i = (n - index_start) * number_of_decays
+        for d in range(number_of_decays):
+            block[i + d] = -decay_coefficients[d] * time_increment
+    for i in range((index_end - index_start) * number_of_decays):
+        block[i] = exp(block[i])
 
 def log_likelihood_of_events(np.ndarray[DTYPEf_t, ndim=1] base_rates,
-                             np.ndarray[DTYPEf_t, ndim=3] impact_coefficients,
-                             np.ndarray[DTYPEf_t, ndim=3] decay_coefficients,
+                             np.ndarray[DTYPEf_t, ndim=1] impact_coefficients,
+                             np.ndarray[DTYPEf_t, ndim=1] decay_coefficients,
                              int number_of_event_types,
                              int number_of_states,
-                             np.ndarray[DTYPEf_t, ndim=1] times,
-                             np.ndarray[DTYPEi_t, ndim=1] events,
-                             np.ndarray[DTYPEi_t, ndim=1] states,
-                             np.float time_start,
-                             np.float time_end):
+                             const TIME_t[:] times,
+                             const MARK_t[:] events,
+                             const MARK_t[:] states,
+                             DTYPEf_t time_start,
+                             DTYPEf_t time_end,
+                             np.ndarray[DTYPEi_t, ndim=1] decay_indices,
+                             int number_of_decays,
+                             np.ndarray[DTYPEi_t, ndim=1] source_indptr,
+                             np.ndarray[DTYPEi_t, ndim=1] source_kernels,
+                             np.ndarray[DTYPEi_t, ndim=1] target_indptr,
+                             np.ndarray[DTYPEi_t, ndim=1] gaps,
+                             DTYPEf_t time_scale,
+                             int number_of_cached_gaps,
+                             int block_size):
     """
     Computes the log-likelihood of events.
+    Only the active kernels (e',x,e) are visited: the coefficients are given for the active kernels only, sorted by
+    target e first, so that the kernels of the target e are target_indptr[e], ..., target_indptr[e+1]-1 and the
+    intensity of an event is a contiguous sum. The kernels of the source (e',x) are source_kernels[j] for
+    j = source_indptr[e'*number_of_states+x], ..., source_indptr[e'*number_of_states+x+1]-1.
     :param parameters: [array] 1-D array of parameters (base rates, impact coefficients, decay coefficients)
     :param times:
     :param events:
     :param states:
     :param time_start:
     :param time_end:
+    :param decay_indices: the decay coefficients of two kernels are tied when they have the same index
+    :param number_of_decays: the number of distinct decay coefficients
+    :param source_indptr:
+    :param source_kernels:
+    :param target_indptr:
+    :param gaps: in tick mode, gaps[n] is the number of ticks between the event n and the previous event (or time_start)
+    :param time_scale: in tick mode, the duration of a tick
+    :param number_of_cached_gaps: 0 in float mode; in tick mode, the decay factors of the gaps smaller than this
+                                  number are read from tables, see decay_tables
+    :param block_size: if positive (and in float mode), the decay factors are computed by blocks of block_size events,
+                       see block_decays
     :return:
     """
     cdef int index_start
-    cdef np.ndarray[DTYPEf_t, ndim=3] partial_sums = np.zeros((number_of_event_types, number_of_states, number_of_event_types), dtype=DTYPEf)
-    cdef int n, event, state, e, e1, x, e2, index_end
+    cdef int number_of_kernels = impact_coefficients.shape[0]
+    cdef np.ndarray[DTYPEf_t, ndim=1] partial_sums = np.zeros(number_of_kernels, dtype=DTYPEf)
+    cdef int n, event, state, e, k, j, source, index_end
     cdef double time, previous_time, intensity_of_the_event
     cdef DTYPEf_t alpha, beta, ratio, time_increment, time_increment_2
+    '''The exponential decays are computed once per distinct decay coefficient'''
+    cdef int d
+    cdef np.ndarray[DTYPEf_t, ndim=1] distinct_decay_coefficients = np.zeros(number_of_decays, dtype=DTYPEf)
+    cdef np.ndarray[DTYPEf_t, ndim=1] decays = np.zeros(number_of_decays, dtype=DTYPEf)
+    for k in range(number_of_kernels):
+        distinct_decay_coefficients[decay_indices[k]] = decay_coefficients[k]
+    '''In blocked mode, decay_factors points to the decay factors of the current event in the block'''
+    cdef np.ndarray[DTYPEf_t, ndim=1] block = np.zeros(max(block_size, 0) * number_of_decays, dtype=DTYPEf)
+    cdef DTYPEf_t* decay_factors = <DTYPEf_t*> decays.data
+    '''In tick mode, the decay factors of the gaps between events are read from tables'''
+    cdef np.ndarray[DTYPEf_t, ndim=2] decay_table
+    cdef np.ndarray[DTYPEf_t, ndim=2] decay_steps
+    decay_table, decay_steps = decay_tables(distinct_decay_coefficients, time_scale, number_of_cached_gaps)
     # events at and before this time are treated as an initial condition
-    index_start = bisect.bisect_right(times, time_start)
+    index_start = bisect_right(times, time_start)
     # saving the ratios of impact and decay coefficients will be useful
-    cdef np.ndarray[DTYPEf_t, ndim=3] impact_decay_ratios = np.zeros((number_of_event_types, number_of_states, number_of_event_types), dtype=DTYPEf)
-    for e1 in range(number_of_event_types):
-        for x in range(number_of_states):
-            for e2 in range(number_of_event_types):
-                alpha = impact_coefficients[e1, x, e2]
-                beta = decay_coefficients[e1, x, e2]
-                impact_decay_ratios[e1, x, e2] = alpha / beta
+    cdef np.ndarray[DTYPEf_t, ndim=1] impact_decay_ratios = np.zeros(number_of_kernels, dtype=DTYPEf)
+    for k in range(number_of_kernels):
+        impact_decay_ratios[k] = impact_coefficients[k] / decay_coefficients[k]
     '''Initialise the partial sums S_{e'x'e} that will allow us to compute the intensity recursively;
     and initialise the log-likelihood taking into account the initial condition'''
     cdef double log_likelihood = 0
@@ -55,20 +172,18 @@ def log_likelihood_of_events(np.ndarray[DTYPEf_t, ndim=1] base_rates,
     log_likelihood *= - (time_end - time_start)
     for n in range(index_start):
         time = times[n]
-        event = events[n]
-        state = states[n]
+        source = events[n] * number_of_states + states[n]
         time_increment = time_start - time
         time_increment_2 = time_end - time
-        for e in range(number_of_event_types):
-                beta = decay_coefficients[event, state, e]
-                ratio = impact_decay_ratios[event, state, e]
-                partial_sums[event, state, e] += exp(-beta * time_increment)
+        for j in range(source_indptr[source], source_indptr[source + 1]):
+                k = source_kernels[j]
+                beta = decay_coefficients[k]
+                ratio = impact_decay_ratios[k]
+                partial_sums[k] += exp(-beta * time_increment)
                 log_likelihood -= ratio * (exp(-beta * time_increment)- exp(-beta * time_increment_2))
     # By doing so, multiplying the partial sums by the impact coefficients needs to be done only once
-    for event in range(number_of_event_types):
-        for state in range(number_of_states):
-            for e in range(number_of_event_types):
-                partial_sums[event, state, e] = partial_sums[event, state, e] * impact_coefficients[event, state, e]
+    for k in range(number_of_kernels):
+        partial_sums[k] = partial_sums[k] * impact_coefficients[k]
     'Go through event times and update likelihood'
     previous_time = time_start
     index_end = times.shape[0]
@@ -76,67 +191,108 @@ def log_likelihood_of_events(np.ndarray[DTYPEf_t, ndim=1] base_rates,
         time = times[n]
         event = events[n]
         state = states[n]
+        source = event * number_of_states + state
         'Update the partial sums: time-decay effect'
         time_increment = time - previous_time
-        for e1 in range(number_of_event_types):
-                for x in range(number_of_states):
-                    for e2 in range(number_of_event_types):
-                        beta = decay_coefficients[e1, x, e2]
-                        partial_sums[e1, x, e2] *= exp(-beta * time_increment)
+        if number_of_cached_gaps > 0:
+            tick_decays(number_of_decays, gaps[n], number_of_cached_gaps, <DTYPEf_t*> decay_table.data,
+                        <DTYPEf_t*> decay_steps.data, <DTYPEf_t*> distinct_decay_coefficients.data, time_scale,
+                        <DTYPEf_t*> decays.data)
+        elif block_size > 0:
+            if (n - index_start) % block_size == 0:
+                block_decays(times, n, min(n + block_size, index_end), previous_time, number_of_decays,
+                             <DTYPEf_t*> distinct_decay_coefficients.data, <DTYPEf_t*> block.data)
+            decay_factors = <DTYPEf_t*> block.data + ((n - index_start) % block_size) * number_of_decays
+        else:
+            for d in range(number_of_decays):
+                decays[d] = exp(-distinct_decay_coefficients[d] * time_increment)
+        for k in range(number_of_kernels):
+            partial_sums[k] *= decay_factors[decay_indices[k]]
         'Update the first term of the log-likelihood (l_{+})'
         intensity_of_the_event = base_rates[event]
-        for e in range(number_of_event_types):
-                for x in range(number_of_states):
-                    intensity_of_the_event += partial_sums[e, x, event]
+        for k in range(target_indptr[event], target_indptr[event + 1]):
+            intensity_of_the_event += partial_sums[k]
         log_likelihood += log(intensity_of_the_event)
         'Update the partial sums: impact of the new event'
-        for e in range(number_of_event_types):
-                alpha = impact_coefficients[event, state, e]
-                partial_sums[event, state, e] += alpha
+        for j in range(source_indptr[source], source_indptr[source + 1]):
+                k = source_kernels[j]
+                alpha = impact_coefficients[k]
+                partial_sums[k] += alpha
         previous_time = time
         'Compute the second term of the likelihood (l_{-})'
         time_increment = time_end - time
-        for e in range(number_of_event_types):
-                beta = decay_coefficients[event, state, e]
-                ratio = impact_decay_ratios[event, state, e]
+        for j in range(source_indptr[source], source_indptr[source + 1]):
+                k = source_kernels[j]
+                beta = decay_coefficients[k]
+                ratio = impact_decay_ratios[k]
                 log_likelihood -= ratio * (1 - exp(-beta * time_increment))
     return log_likelihood
 
 def log_likelihood_of_events_partial(int event_type,
-                             np.float base_rate,
-                             np.ndarray[DTYPEf_t, ndim=2] impact_coefficients,
-                             np.ndarray[DTYPEf_t, ndim=2] decay_coefficients,
+                             DTYPEf_t base_rate,
+                             np.ndarray[DTYPEf_t, ndim=1] impact_coefficients,
+                             np.ndarray[DTYPEf_t, ndim=1] decay_coefficients,
                              int number_of_event_types,
                              int number_of_states,
-                             np.ndarray[DTYPEf_t, ndim=1] times,
-                             np.ndarray[DTYPEi_t, ndim=1] events,
-                             np.ndarray[DTYPEi_t, ndim=1] states,
-                             np.float time_start,
-                             np.float time_end):
+                             const TIME_t[:] times,
+                             const MARK_t[:] events,
+                             const MARK_t[:] states,
+                             DTYPEf_t time_start,
+                             DTYPEf_t time_end,
+                             np.ndarray[DTYPEi_t, ndim=1] decay_indices,
+                             int number_of_decays,
+                             np.ndarray[DTYPEi_t, ndim=1] source_indptr,
+                             np.ndarray[DTYPEi_t, ndim=1] gaps,
+                             DTYPEf_t time_scale,
+                             int number_of_cached_gaps,
+                             int block_size):
     """
     Computes the log-likelihood associated to a single event type (the full log-likelihood is the sum of the partial log-likelihoods).
+    Only the active kernels (e',x) of the event type are visited, see log_likelihood_of_events. Since they share their
+    target, they are sorted by source and the kernels of the source (e',x) are source_indptr[e'*number_of_states+x],
+    ..., source_indptr[e'*number_of_states+x+1]-1.
     :param parameters: [array] 1-D array of parameters (base rate, impact coefficients, decay coefficients)
     :param times:
     :param events:
     :param states:
     :param time_start:
     :param time_end:
+    :param decay_indices: the decay coefficients of two kernels are tied when they have the same index
+    :param number_of_decays: the number of distinct decay coefficients
+    :param source_indptr:
+    :param gaps: in tick mode, gaps[n] is the number of ticks between the event n and the previous event (or time_start)
+    :param time_scale: in tick mode, the duration of a tick
+    :param number_of_cached_gaps: 0 in float mode; in tick mode, the decay factors of the gaps smaller than this
+                                  number are read from tables, see decay_tables
+    :param block_size: if positive (and in float mode), the decay factors are computed by blocks of block_size events,
+                       see block_decays
     :return:
     """
     cdef int index_start
-    cdef np.ndarray[DTYPEf_t, ndim=2] partial_sums = np.zeros((number_of_event_types, number_of_states), dtype=DTYPEf)
-    cdef int n, event, state, e, e1, x, index_end
+    cdef int number_of_kernels = impact_coefficients.shape[0]
+    cdef np.ndarray[DTYPEf_t, ndim=1] partial_sums = np.zeros(number_of_kernels, dtype=DTYPEf)
+    cdef int n, event, k, source, index_end
     cdef double time, previous_time, intensity_of_the_event
     cdef DTYPEf_t alpha, beta, ratio, time_increment, time_increment_2
+    '''The exponential decays are computed once per distinct decay coefficient'''
+    cdef int d
+    cdef np.ndarray[DTYPEf_t, ndim=1] distinct_decay_coefficients = np.zeros(number_of_decays, dtype=DTYPEf)
+    cdef np.ndarray[DTYPEf_t, ndim=1] decays = np.zeros(number_of_decays, dtype=DTYPEf)
+    for k in range(number_of_kernels):
+        distinct_decay_coefficients[decay_indices[k]] = decay_coefficients[k]
+    '''In blocked mode, decay_factors points to the decay factors of the current event in the block'''
+    cdef np.ndarray[DTYPEf_t, ndim=1] block = np.zeros(max(block_size, 0) * number_of_decays, dtype=DTYPEf)
+    cdef DTYPEf_t* decay_factors = <DTYPEf_t*> decays.data
+    '''In tick mode, the decay factors of the gaps between events are read from tables'''
+    cdef np.ndarray[DTYPEf_t, ndim=2] decay_table
+    cdef np.ndarray[DTYPEf_t, ndim=2] decay_steps
+    decay_table, decay_steps = decay_tables(distinct_decay_coefficients, time_scale, number_of_cached_gaps)
     # events at and before this time are treated as an initial condition
-    index_start = bisect.bisect_right(times, time_start)
+    index_start = bisect_right(times, time_start)
     # saving the ratios of impact and decay coefficients will be useful
-    cdef np.ndarray[DTYPEf_t, ndim=2] impact_decay_ratios = np.zeros((number_of_event_types, number_of_states), dtype=DTYPEf)
-    for e1 in range(number_of_event_types):
-        for x in range(number_of_states):
-            alpha = impact_coefficients[e1, x]
-            beta = decay_coefficients[e1, x]
-            impact_decay_ratios[e1, x] = alpha / beta
+    cdef np.ndarray[DTYPEf_t, ndim=1] impact_decay_ratios = np.zeros(number_of_kernels, dtype=DTYPEf)
+    for k in range(number_of_kernels):
+        impact_decay_ratios[k] = impact_coefficients[k] / decay_coefficients[k]
     '''Initialise the partial sums S_{e'x'} that will allow us to compute the intensity recursively;
     and initialise the log-likelihood taking into account the initial condition'''
     cdef double log_likelihood = 0
@@ -144,71 +300,104 @@ def log_likelihood_of_events_partial(int event_type,
     log_likelihood *= - (time_end - time_start)
     for n in range(index_start):
         time = times[n]
-        event = events[n]
-        state = states[n]
+        source = events[n] * number_of_states + states[n]
         time_increment = time_start - time
         time_increment_2 = time_end - time
-        beta = decay_coefficients[event, state]
-        ratio = impact_decay_ratios[event, state]
-        partial_sums[event, state] += exp(-beta * time_increment)
-        log_likelihood -= ratio * (exp(-beta * time_increment)- exp(-beta * time_increment_2))
+        for k in range(source_indptr[source], source_indptr[source + 1]):
+            beta = decay_coefficients[k]
+            ratio = impact_decay_ratios[k]
+            partial_sums[k] += exp(-beta * time_increment)
+            log_likelihood -= ratio * (exp(-beta * time_increment)- exp(-beta * time_increment_2))
     # By doing so, multiplying the partial sums by the impact coefficients needs to be done only once
-    for event in range(number_of_event_types):
-        for state in range(number_of_states):
-            partial_sums[event, state] = partial_sums[event, state] * impact_coefficients[event, state]
+    for k in range(number_of_kernels):
+        partial_sums[k] = partial_sums[k] * impact_coefficients[k]
     'Go through event times and update likelihood'
     previous_time = time_start
     index_end = times.shape[0]
     for n in range(index_start, index_end):
         time = times[n]
         event = events[n]
-        state = states[n]
+        source = event * number_of_states + states[n]
         'Update the partial sums: time-decay effect'
         time_increment = time - previous_time
-        for e1 in range(number_of_event_types):
-                for x in range(number_of_states):
-                    beta = decay_coefficients[e1, x]
-                    partial_sums[e1, x] *= exp(-beta * time_increment)
+        if number_of_cached_gaps > 0:
+            tick_decays(number_of_decays, gaps[n], number_of_cached_gaps, <DTYPEf_t*> decay_table.data,
+                        <DTYPEf_t*> decay_steps.data, <DTYPEf_t*> distinct_decay_coefficients.data, time_scale,
+                        <DTYPEf_t*> decays.data)
+        elif block_size > 0:
+            if (n - index_start) % block_size == 0:
+                block_decays(times, n, min(n + block_size, index_end), previous_time, number_of_decays,
+                             <DTYPEf_t*> distinct_decay_coefficients.data, <DTYPEf_t*> block.data)
+            decay_factors = <DTYPEf_t*> block.data + ((n - index_start) % block_size) * number_of_decays
+        else:
+            for d in range(number_of_decays):
+                decays[d] = exp(-distinct_decay_coefficients[d] * time_increment)
+        for k in range(number_of_kernels):
+            partial_sums[k] *= decay_factors[decay_indices[k]]
         'Update the first term of the log-likelihood (l_{+})'
         if event == event_type:
             intensity_of_the_event = base_rate
-            for e in range(number_of_event_types):
-                    for x in range(number_of_states):
-                        intensity_of_the_event += partial_sums[e, x]
+            for k in range(number_of_kernels):
+                intensity_of_the_event += partial_sums[k]
             log_likelihood += log(intensity_of_the_event)
         'Update the partial sums: impact of the new event'
-        alpha = impact_coefficients[event, state]
-        partial_sums[event, state] += alpha
+        for k in range(source_indptr[source], source_indptr[source + 1]):
+            alpha = impact_coefficients[k]
+            partial_sums[k] += alpha
         previous_time = time
         'Compute the second term of the likelihood (l_{-})'
         time_increment = time_end - time
-        beta = decay_coefficients[event, state]
-        ratio = impact_decay_ratios[event, state]
-        log_likelihood -= ratio * (1 - exp(-beta * time_increment))
+        for k in range(source_indptr[source], source_indptr[source + 1]):
+            beta = decay_coefficients[k]
+            ratio = impact_decay_ratios[k]
+            log_likelihood -= ratio * (1 - exp(-beta * time_increment))
     return log_likelihood
 
 def gradient(np.ndarray[DTYPEf_t, ndim=1] base_rates,
-             np.ndarray[DTYPEf_t, ndim=3] impact_coefficients,
-             np.ndarray[DTYPEf_t, ndim=3] decay_coefficients,
+             np.ndarray[DTYPEf_t, ndim=1] impact_coefficients,
+             np.ndarray[DTYPEf_t, ndim=1] decay_coefficients,
              int number_of_event_types,
              int number_of_states,
-             np.ndarray[DTYPEf_t, ndim=1] times,
-             np.ndarray[DTYPEi_t, ndim=1] events,
-             np.ndarray[DTYPEi_t, ndim=1] states,
-             np.float time_start,
-             np.float time_end):
+             const TIME_t[:] times,
+             const MARK_t[:] events,
+             const MARK_t[:] states,
+             DTYPEf_t time_start,
+             DTYPEf_t time_end,
+             np.ndarray[DTYPEi_t, ndim=1] decay_indices,
+             int number_of_decays,
+             np.ndarray[DTYPEi_t, ndim=1] source_indptr,
+             np.ndarray[DTYPEi_t, ndim=1] source_kernels,
+             np.ndarray[DTYPEi_t, ndim=1] target_indptr,
+             np.ndarray[DTYPEi_t, ndim=1] gaps,
+             DTYPEf_t time_scale,
+             int number_of_cached_gaps,
+             int block_size):
     """
     Computes the gradient of the log-likelihood of events.
+    Only the active kernels are visited (see log_likelihood_of_events) and the gradient is computed with respect to their
+    coefficients only.
     :param parameters:
     :param times:
     :param events:
     :param states:
     :param time_start:
     :param time_end:
+    :param decay_indices: the decay coefficients of two kernels are tied when they have the same index
+    :param number_of_decays: the number of distinct decay coefficients
+    :param source_indptr:
+    :param source_kernels:
+    :param target_indptr:
+    :param gaps: in tick mode, gaps[n] is the number of ticks between the event n and the previous event (or time_start)
+    :param time_scale: in tick mode, the duration of a tick
+    :param number_of_cached_gaps: 0 in float mode; in tick mode, the decay factors of the gaps smaller than this
+                                  number are read from tables, see decay_tables
+    :param block_size: if positive (and in float mode), the decay factors are computed by blocks of block_size events,
+                       see block_decays
     :return:
     """
     cdef int index_start
-    cdef int n, event, state, e, e1, x, e2, index_end
+    cdef int number_of_kernels = impact_coefficients.shape[0]
+    cdef int n, event, e, k, j, source, index_end
     cdef double time, previous_time
     cdef DTYPEf_t alpha, beta, ratio, time_increment, time_increment_2, sample_duration, a, b, c, decay, intensity_of_the_event
     # initialise the gradient vectors
@@ -216,252 +405,523 @@ def gradient(np.ndarray[DTYPEf_t, ndim=1] base_rates,
     cdef np.ndarray[DTYPEf_t, ndim=1] gradient_base_rates = np.zeros(number_of_event_types)
     for e in range(number_of_event_types):
         gradient_base_rates[e] = - sample_duration
-    cdef np.ndarray[DTYPEf_t, ndim=3] gradient_impact_coefficients =\
-        np.zeros((number_of_event_types, number_of_states, number_of_event_types))
-    cdef np.ndarray[DTYPEf_t, ndim=3] gradient_decay_coefficients =\
-        np.zeros((number_of_event_types, number_of_states, number_of_event_types))
+    cdef np.ndarray[DTYPEf_t, ndim=1] gradient_impact_coefficients = np.zeros(number_of_kernels)
+    cdef np.ndarray[DTYPEf_t, ndim=1] gradient_decay_coefficients = np.zeros(number_of_kernels)
+    '''The exponential decays are computed once per distinct decay coefficient'''
+    cdef int d
+    cdef np.ndarray[DTYPEf_t, ndim=1] distinct_decay_coefficients = np.zeros(number_of_decays, dtype=DTYPEf)
+    cdef np.ndarray[DTYPEf_t, ndim=1] decays = np.zeros(number_of_decays, dtype=DTYPEf)
+    for k in range(number_of_kernels):
+        distinct_decay_coefficients[decay_indices[k]] = decay_coefficients[k]
+    '''In blocked mode, decay_factors points to the decay factors of the current event in the block'''
+    cdef np.ndarray[DTYPEf_t, ndim=1] block = np.zeros(max(block_size, 0) * number_of_decays, dtype=DTYPEf)
+    cdef DTYPEf_t* decay_factors = <DTYPEf_t*> decays.data
+    '''In tick mode, the decay factors of the gaps between events are read from tables'''
+    cdef np.ndarray[DTYPEf_t, ndim=2] decay_table
+    cdef np.ndarray[DTYPEf_t, ndim=2] decay_steps
+    decay_table, decay_steps = decay_tables(distinct_decay_coefficients, time_scale, number_of_cached_gaps)
     # events at and before this time are treated as an initial condition
-    index_start = bisect.bisect_right(times, time_start)
+    index_start = bisect_right(times, time_start)
     # compute the ratios impact/decay coefficients once as they will be used a lot
-    cdef np.ndarray[DTYPEf_t, ndim=3] impact_decay_ratios = np.zeros((number_of_event_types, number_of_states, number_of_event_types), dtype=DTYPEf)
-    for e1 in range(number_of_event_types):
-        for x in range(number_of_states):
-            for e2 in range(number_of_event_types):
-                alpha = impact_coefficients[e1, x, e2]
-                beta = decay_coefficients[e1, x, e2]
-                impact_decay_ratios[e1, x, e2] = alpha / beta
+    cdef np.ndarray[DTYPEf_t, ndim=1] impact_decay_ratios = np.zeros(number_of_kernels, dtype=DTYPEf)
+    for k in range(number_of_kernels):
+        impact_decay_ratios[k] = impact_coefficients[k] / decay_coefficients[k]
     '''Initialise the partial sums S_{e'x'e} and S^{(1)}_{e'x'e}
     that will allow us to compute the intensity and the gradient recursively;
-    and compute contribution of initial condition on gradient.'''
-    cdef np.ndarray[DTYPEf_t, ndim=3] partial_sums = np.zeros((number_of_event_types, number_of_states, number_of_event_types), dtype=DTYPEf)
-    cdef np.ndarray[DTYPEf_t, ndim=3] partial_sums_1 = np.zeros((number_of_event_types, number_of_states, number_of_event_types), dtype=DTYPEf)
+    and compute contribution of initial condition on gradient.
+    The partial sums are kept without the impact coefficients, so that the derivatives with respect to the impact
+    coefficients are well defined even when they vanish'''
+    cdef np.ndarray[DTYPEf_t, ndim=1] partial_sums = np.zeros(number_of_kernels, dtype=DTYPEf)
+    cdef np.ndarray[DTYPEf_t, ndim=1] partial_sums_1 = np.zeros(number_of_kernels, dtype=DTYPEf)
     for n in range(index_start):
         time = times[n]
-        event = events[n]
-        state = states[n]
+        source = events[n] * number_of_states + states[n]
         time_increment = time_start - time
         time_increment_2 = time_end - time
-        for e in range(number_of_event_types):
-            beta = decay_coefficients[event, state, e]
-            ratio = impact_decay_ratios[event, state, e]
+        for j in range(source_indptr[source], source_indptr[source + 1]):
+            k = source_kernels[j]
+            beta = decay_coefficients[k]
+            ratio = impact_decay_ratios[k]
             a = exp(- beta * time_increment)
-            partial_sums[event, state, e] += a
-            partial_sums_1[event, state, e] += a * time_increment
+            partial_sums[k] += a
+            partial_sums_1[k] += a * time_increment
             b = exp(- beta * time_increment_2)
-            gradient_impact_coefficients[event, state, e] -= (a - b) / beta
-            gradient_decay_coefficients[event, state, e] -= ratio * (time_increment_2*b - time_increment*a)
-            gradient_decay_coefficients[event, state, e] -= - ratio * (a - b) / beta
-    # By doing so, we multiply by the impact coefficients only once
-    for event in range(number_of_event_types):
-        for state in range(number_of_states):
-            for e in range(number_of_event_types):
-                alpha = impact_coefficients[event, state, e]
-                partial_sums[event, state, e] = partial_sums[event, state, e] * alpha
-                partial_sums_1[event, state, e] = partial_sums_1[event, state, e] * alpha
+            gradient_impact_coefficients[k] -= (a - b) / beta
+            gradient_decay_coefficients[k] -= ratio * (time_increment_2*b - time_increment*a)
+            gradient_decay_coefficients[k] -= - ratio * (a - b) / beta
     'Go through event times and update likelihood'
     previous_time = time_start
     index_end = times.shape[0]
     for n in range(index_start, index_end):
         time = times[n]
         event = events[n]
-        state = states[n]
+        source = event * number_of_states + states[n]
         'Update the partial sums: time-decay effect'
         time_increment = time - previous_time
-        for e1 in range(number_of_event_types):
-            for x in range(number_of_states):
-                for e2 in range(number_of_event_types):
-                    beta = decay_coefficients[e1, x, e2]
-                    partial_sums_1[e1, x, e2] += time_increment * partial_sums[e1, x, e2]
-                    decay = exp(-beta * time_increment)
-                    partial_sums_1[e1, x, e2] *= decay
-                    partial_sums[e1, x, e2] *= decay
+        if number_of_cached_gaps > 0:
+            tick_decays(number_of_decays, gaps[n], number_of_cached_gaps, <DTYPEf_t*> decay_table.data,
+                        <DTYPEf_t*> decay_steps.data, <DTYPEf_t*> distinct_decay_coefficients.data, time_scale,
+                        <DTYPEf_t*> decays.data)
+        elif block_size > 0:
+            if (n - index_start) % block_size == 0:
+                block_decays(times, n, min(n + block_size, index_end), previous_time, number_of_decays,
+                             <DTYPEf_t*> distinct_decay_coefficients.data, <DTYPEf_t*> block.data)
+            decay_factors = <DTYPEf_t*> block.data + ((n - index_start) % block_size) * number_of_decays
+        else:
+            for d in range(number_of_decays):
+                decays[d] = exp(-distinct_decay_coefficients[d] * time_increment)
+        for k in range(number_of_kernels):
+            partial_sums_1[k] += time_increment * partial_sums[k]
+            decay = decay_factors[decay_indices[k]]
+            partial_sums_1[k] *= decay
+            partial_sums[k] *= decay
         'Update the gradient'
         intensity_of_the_event = base_rates[event]
-        for e in range(number_of_event_types):
-            for x in range(number_of_states):
-                intensity_of_the_event += partial_sums[e, x, event]
+        for k in range(target_indptr[event], target_indptr[event + 1]):
+            intensity_of_the_event += impact_coefficients[k] * partial_sums[k]
         gradient_base_rates[event] += 1 / intensity_of_the_event
-        for e in range(number_of_event_types):
-            for x in range(number_of_states):
-                alpha = impact_coefficients[e, x, event]
-                gradient_impact_coefficients[e, x, event] += (partial_sums[e, x, event] / alpha) / intensity_of_the_event
-                gradient_decay_coefficients[e, x, event] -= partial_sums_1[e, x, event] / intensity_of_the_event
+        for k in range(target_indptr[event], target_indptr[event + 1]):
+            alpha = impact_coefficients[k]
+            gradient_impact_coefficients[k] += partial_sums[k] / intensity_of_the_event
+            gradient_decay_coefficients[k] -= alpha * partial_sums_1[k] / intensity_of_the_event
         'Update the partial sums: impact of the new event'
-        for e in range(number_of_event_types):
-            alpha = impact_coefficients[event, state, e]
-            partial_sums[event, state, e] += alpha
+        for j in range(source_indptr[source], source_indptr[source + 1]):
+            k = source_kernels[j]
+            partial_sums[k] += 1
         previous_time = time
         'Subtract gradient of second term of log-likelihood'
         time_increment = time_end - time
-        for e in range(number_of_event_types):
-            beta = decay_coefficients[event, state, e]
-            ratio = impact_decay_ratios[event, state, e]
+        for j in range(source_indptr[source], source_indptr[source + 1]):
+            k = source_kernels[j]
+            beta = decay_coefficients[k]
+            ratio = impact_decay_ratios[k]
             c = 1 - exp(-beta * time_increment)
-            gradient_impact_coefficients[event, state, e] -= c / beta
-            gradient_decay_coefficients[event, state, e] -= ratio * time_increment * (1 - c)
-            gradient_decay_coefficients[event, state, e] -= - ratio * c / beta
+            gradient_impact_coefficients[k] -= c / beta
+            gradient_decay_coefficients[k] -= ratio * time_increment * (1 - c)
+            gradient_decay_coefficients[k] -= - ratio * c / beta
     'Return the result, i.e., the gradient'
     return gradient_base_rates, gradient_impact_coefficients, gradient_decay_coefficients
 
 def gradient_partial(int event_type,
-             np.float base_rate,
-             np.ndarray[DTYPEf_t, ndim=2] impact_coefficients,
-             np.ndarray[DTYPEf_t, ndim=2] decay_coefficients,
+             DTYPEf_t base_rate,
+             np.ndarray[DTYPEf_t, ndim=1] impact_coefficients,
+             np.ndarray[DTYPEf_t, ndim=1] decay_coefficients,
              int number_of_event_types,
              int number_of_states,
-             np.ndarray[DTYPEf_t, ndim=1] times,
-             np.ndarray[DTYPEi_t, ndim=1] events,
-             np.ndarray[DTYPEi_t, ndim=1] states,
-             np.float time_start,
-             np.float time_end):
+             const TIME_t[:] times,
+             const MARK_t[:] events,
+             const MARK_t[:] states,
+             DTYPEf_t time_start,
+             DTYPEf_t time_end,
+             np.ndarray[DTYPEi_t, ndim=1] decay_indices,
+             int number_of_decays,
+             np.ndarray[DTYPEi_t, ndim=1] source_indptr,
+             np.ndarray[DTYPEi_t, ndim=1] gaps,
+             DTYPEf_t time_scale,
+             int number_of_cached_gaps,
+             int block_size):
     """
     Computes the gradient of the log-likelihood of events, only with respect to the parameters that contribute to the intensity of the given event type.
+    Only the active kernels are visited (see log_likelihood_of_events_partial) and the gradient is computed with respect to
+    their coefficients only.
     :param parameters:
     :param times:
     :param events:
     :param states:
     :param time_start:
     :param time_end:
+    :param decay_indices: the decay coefficients of two kernels are tied when they have the same index
+    :param number_of_decays: the number of distinct decay coefficients
+    :param source_indptr:
+    :param gaps: in tick mode, gaps[n] is the number of ticks between the event n and the previous event (or time_start)
+    :param time_scale: in tick mode, the duration of a tick
+    :param number_of_cached_gaps: 0 in float mode; in tick mode, the decay factors of the gaps smaller than this
+                                  number are read from tables, see decay_tables
+    :param block_size: if positive (and in float mode), the decay factors are computed by blocks of block_size events,
+                       see block_decays
     :return:
     """
     cdef int index_start
-    cdef int n, event, state, e, e1, x, e2, index_end
+    cdef int number_of_kernels = impact_coefficients.shape[0]
+    cdef int n, event, k, source, index_end
     cdef double time, previous_time
     cdef DTYPEf_t alpha, beta, ratio, time_increment, time_increment_2, sample_duration, a, b, c, decay, intensity_of_the_event
     # initialise the gradient vectors
     sample_duration = time_end - time_start
-    cdef np.float gradient_base_rate
+    cdef DTYPEf_t gradient_base_rate
     gradient_base_rate = - sample_duration
-    cdef np.ndarray[DTYPEf_t, ndim=2] gradient_impact_coefficients =\
-        np.zeros((number_of_event_types, number_of_states))
-    cdef np.ndarray[DTYPEf_t, ndim=2] gradient_decay_coefficients =\
-        np.zeros((number_of_event_types, number_of_states))
+    cdef np.ndarray[DTYPEf_t, ndim=1] gradient_impact_coefficients = np.zeros(number_of_kernels)
+    cdef np.ndarray[DTYPEf_t, ndim=1] gradient_decay_coefficients = np.zeros(number_of_kernels)
+    '''The exponential decays are computed once per distinct decay coefficient'''
+    cdef int d
+    cdef np.ndarray[DTYPEf_t, ndim=1] distinct_decay_coefficients = np.zeros(number_of_decays, dtype=DTYPEf)
+    cdef np.ndarray[DTYPEf_t, ndim=1] decays = np.zeros(number_of_decays, dtype=DTYPEf)
+    for k in range(number_of_kernels):
+        distinct_decay_coefficients[decay_indices[k]] = decay_coefficients[k]
+    '''In blocked mode, decay_factors points to the decay factors of the current event in the block'''
+    cdef np.ndarray[DTYPEf_t, ndim=1] block = np.zeros(max(block_size, 0) * number_of_decays, dtype=DTYPEf)
+    cdef DTYPEf_t* decay_factors = <DTYPEf_t*> decays.data
+    '''In tick mode, the decay factors of the gaps between events are read from tables'''
+    cdef np.ndarray[DTYPEf_t, ndim=2] decay_table
+    cdef np.ndarray[DTYPEf_t, ndim=2] decay_steps
+    decay_table, decay_steps = decay_tables(distinct_decay_coefficients, time_scale, number_of_cached_gaps)
     # events at and before this time are treated as an initial condition
-    index_start = bisect.bisect_right(times, time_start)
+    index_start = bisect_right(times, time_start)
     # compute the ratios impact/decay coefficients once as they will be used a lot
-    cdef np.ndarray[DTYPEf_t, ndim=2] impact_decay_ratios = np.zeros((number_of_event_types, number_of_states), dtype=DTYPEf)
-    for e1 in range(number_of_event_types):
-        for x in range(number_of_states):
-            alpha = impact_coefficients[e1, x]
-            beta = decay_coefficients[e1, x]
-            impact_decay_ratios[e1, x] = alpha / beta
+    cdef np.ndarray[DTYPEf_t, ndim=1] impact_decay_ratios = np.zeros(number_of_kernels, dtype=DTYPEf)
+    for k in range(number_of_kernels):
+        impact_decay_ratios[k] = impact_coefficients[k] / decay_coefficients[k]
     '''Initialise the partial sums S_{e'x'} and S^{(1)}_{e'x'}
     that will allow us to compute the intensity and the gradient recursively;
-    and compute contribution of initial condition on gradient.'''
-    cdef np.ndarray[DTYPEf_t, ndim=2] partial_sums = np.zeros((number_of_event_types, number_of_states), dtype=DTYPEf)
-    cdef np.ndarray[DTYPEf_t, ndim=2] partial_sums_1 = np.zeros((number_of_event_types, number_of_states), dtype=DTYPEf)
+    and compute contribution of initial condition on gradient.
+    The partial sums are kept without the impact coefficients, see gradient'''
+    cdef np.ndarray[DTYPEf_t, ndim=1] partial_sums = np.zeros(number_of_kernels, dtype=DTYPEf)
+    cdef np.ndarray[DTYPEf_t, ndim=1] partial_sums_1 = np.zeros(number_of_kernels, dtype=DTYPEf)
     for n in range(index_start):
         time = times[n]
-        event = events[n]
-        state = states[n]
+        source = events[n] * number_of_states + states[n]
         time_increment = time_start - time
         time_increment_2 = time_end - time
-        beta = decay_coefficients[event, state]
-        ratio = impact_decay_ratios[event, state]
-        a = exp(- beta * time_increment)
-        partial_sums[event, state] += a
-        partial_sums_1[event, state] += a * time_increment
-        b = exp(- beta * time_increment_2)
-        gradient_impact_coefficients[event, state] -= (a - b) / beta
-        gradient_decay_coefficients[event, state] -= ratio * (time_increment_2*b - time_increment*a)
-        gradient_decay_coefficients[event, state] -= - ratio * (a - b) / beta
-    # By doing so, we multiply by the impact coefficients only once
-    for event in range(number_of_event_types):
-        for state in range(number_of_states):
-            alpha = impact_coefficients[event, state]
-            partial_sums[event, state] = partial_sums[event, state] * alpha
-            partial_sums_1[event, state] = partial_sums_1[event, state] * alpha
+        for k in range(source_indptr[source], source_indptr[source + 1]):
+            beta = decay_coefficients[k]
+            ratio = impact_decay_ratios[k]
+            a = exp(- beta * time_increment)
+            partial_sums[k] += a
+            partial_sums_1[k] += a * time_increment
+            b = exp(- beta * time_increment_2)
+            gradient_impact_coefficients[k] -= (a - b) / beta
+            gradient_decay_coefficients[k] -= ratio * (time_increment_2*b - time_increment*a)
+            gradient_decay_coefficients[k] -= - ratio * (a - b) / beta
     'Go through event times and update likelihood'
     previous_time = time_start
     index_end = times.shape[0]
     for n in range(index_start, index_end):
         time = times[n]
         event = events[n]
-        state = states[n]
+        source = event * number_of_states + states[n]
         'Update the partial sums: time-decay effect'
         time_increment = time - previous_time
-        for e1 in range(number_of_event_types):
-            for x in range(number_of_states):
-                beta = decay_coefficients[e1, x]
-                partial_sums_1[e1, x] += time_increment * partial_sums[e1, x]
-                decay = exp(-beta * time_increment)
-                partial_sums_1[e1, x] *= decay
-                partial_sums[e1, x] *= decay
+        if number_of_cached_gaps > 0:
+            tick_decays(number_of_decays, gaps[n], number_of_cached_gaps, <DTYPEf_t*> decay_table.data,
+                        <DTYPEf_t*> decay_steps.data, <DTYPEf_t*> distinct_decay_coefficients.data, time_scale,
+                        <DTYPEf_t*> decays.data)
+        elif block_size > 0:
+            if (n - index_start) % block_size == 0:
+                block_decays(times, n, min(n + block_size, index_end), previous_time, number_of_decays,
+                             <DTYPEf_t*> distinct_decay_coefficients.data, <DTYPEf_t*> block.data)
+            decay_factors = <DTYPEf_t*> block.data + ((n - index_start) % block_size) * number_of_decays
+        else:
+            for d in range(number_of_decays):
+                decays[d] = exp(-distinct_decay_coefficients[d] * time_increment)
+        for k in range(number_of_kernels):
+            partial_sums_1[k] += time_increment * partial_sums[k]
+            decay = decay_factors[decay_indices[k]]
+            partial_sums_1[k] *= decay
+            partial_sums[k] *= decay
         'Update the gradient'
         if event == event_type:
             intensity_of_the_event = base_rate
-            for e in range(number_of_event_types):
-                for x in range(number_of_states):
-                    intensity_of_the_event += partial_sums[e, x]
+            for k in range(number_of_kernels):
+                intensity_of_the_event += impact_coefficients[k] * partial_sums[k]
             gradient_base_rate += 1 / intensity_of_the_event
-            for e in range(number_of_event_types):
-                for x in range(number_of_states):
-                    alpha = impact_coefficients[e, x]
-                    gradient_impact_coefficients[e, x] += (partial_sums[e, x] / alpha) / intensity_of_the_event
-                    gradient_decay_coefficients[e, x] -= partial_sums_1[e, x] / intensity_of_the_event
+            for k in range(number_of_kernels):
+                alpha = impact_coefficients[k]
+                gradient_impact_coefficients[k] += partial_sums[k] / intensity_of_the_event
+                gradient_decay_coefficients[k] -= alpha * partial_sums_1[k] / intensity_of_the_event
         'Update the partial sums: impact of the new event'
-        alpha = impact_coefficients[event, state]
-        partial_sums[event, state] += alpha
+        for k in range(source_indptr[source], source_indptr[source + 1]):
+            partial_sums[k] += 1
         previous_time = time
         'Subtract gradient of second term of log-likelihood'
         time_increment = time_end - time
-        beta = decay_coefficients[event, state]
-        ratio = impact_decay_ratios[event, state]
-        c = 1 - exp(-beta * time_increment)
-        gradient_impact_coefficients[event, state] -= c / beta
-        gradient_decay_coefficients[event, state] -= ratio * time_increment * (1 - c)
-        gradient_decay_coefficients[event, state] -= - ratio * c / beta
+        for k in range(source_indptr[source], source_indptr[source + 1]):
+            beta = decay_coefficients[k]
+            ratio = impact_decay_ratios[k]
+            c = 1 - exp(-beta * time_increment)
+            gradient_impact_coefficients[k] -= c / beta
+            gradient_decay_coefficients[k] -= ratio * time_increment * (1 - c)
+            gradient_decay_coefficients[k] -= - ratio * c / beta
     'Return the result, i.e., the gradient'
     return gradient_base_rate, gradient_impact_coefficients, gradient_decay_coefficients
 
+def hessian_partial(int event_type,
+             DTYPEf_t base_rate,
+             np.ndarray[DTYPEf_t, ndim=1] impact_coefficients,
+             np.ndarray[DTYPEf_t, ndim=1] decay_coefficients,
+             int number_of_event_types,
+             int number_of_states,
+             const TIME_t[:] times,
+             const MARK_t[:] events,
+             const MARK_t[:] states,
+             DTYPEf_t time_start,
+             DTYPEf_t time_end,
+             np.ndarray[DTYPEi_t, ndim=1] source_indptr):
+    """
+    Computes the Hessian of the log-likelihood of events, only with respect to the parameters that contribute to the intensity of the given event type.
+    Only the active kernels are visited (see log_likelihood_of_events_partial). The parameters are ordered as follows:
+    the base rate, the impact coefficients and the decay coefficients of the active kernels.
+    :param parameters:
+    :param times:
+    :param events:
+    :param states:
+    :param time_start:
+    :param time_end:
+    :param source_indptr:
+    :return:
+    """
+    cdef int index_start
+    cdef int n, event, source, i, j, k, index_end
+    cdef int number_of_kernels = impact_coefficients.shape[0]
+    cdef int dimension = 1 + 2 * number_of_kernels
+    cdef double time, previous_time
+    cdef DTYPEf_t alpha, beta, ratio, time_increment, time_increment_2, a, b, decay, intensity_of_the_event, g
+    cdef DTYPEf_t first_derivative, second_derivative
+    cdef np.ndarray[DTYPEf_t, ndim=2] hessian = np.zeros((dimension, dimension), dtype=DTYPEf)
+    # gradient of the intensity of the event with respect to the parameters
+    cdef np.ndarray[DTYPEf_t, ndim=1] gradient_of_intensity = np.zeros(dimension, dtype=DTYPEf)
+    gradient_of_intensity[0] = 1
+    # events at and before this time are treated as an initial condition
+    index_start = bisect_right(times, time_start)
+    '''Initialise the partial sums S_{e'x'}, S^{(1)}_{e'x'} and S^{(2)}_{e'x'}, where S^{(p)} weighs each exponential by
+    the p-th power of the time elapsed since the event, and compute the contribution of the initial condition.
+    The partial sums are kept without the impact coefficients, see gradient.
+    The second term of the log-likelihood (l_{-}) is a sum of terms alpha*h(beta), with
+    h(beta) = (exp(-beta*a) - exp(-beta*b)) / beta, whose only non-zero second derivatives are h'(beta) and alpha*h''(beta)'''
+    cdef np.ndarray[DTYPEf_t, ndim=1] partial_sums = np.zeros(number_of_kernels, dtype=DTYPEf)
+    cdef np.ndarray[DTYPEf_t, ndim=1] partial_sums_1 = np.zeros(number_of_kernels, dtype=DTYPEf)
+    cdef np.ndarray[DTYPEf_t, ndim=1] partial_sums_2 = np.zeros(number_of_kernels, dtype=DTYPEf)
+    for n in range(index_start):
+        time = times[n]
+        source = events[n] * number_of_states + states[n]
+        time_increment = time_start - time
+        time_increment_2 = time_end - time
+        for k in range(source_indptr[source], source_indptr[source + 1]):
+            alpha = impact_coefficients[k]
+            beta = decay_coefficients[k]
+            a = exp(- beta * time_increment)
+            b = exp(- beta * time_increment_2)
+            partial_sums[k] += a
+            partial_sums_1[k] += a * time_increment
+            partial_sums_2[k] += a * time_increment * time_increment
+            first_derivative = (time_increment_2 * b - time_increment * a) / beta - (a - b) / (beta * beta)
+            second_derivative = (time_increment * time_increment * a - time_increment_2 * time_increment_2 * b) / beta
+            second_derivative -= 2 * (time_increment_2 * b - time_increment * a) / (beta * beta)
+            second_derivative += 2 * (a - b) / (beta * beta * beta)
+            hessian[1 + k, 1 + number_of_kernels + k] -= first_derivative
+            hessian[1 + number_of_kernels + k, 1 + number_of_kernels + k] -= alpha * second_derivative
+    'Go through event times and update the Hessian'
+    previous_time = time_start
+    index_end = times.shape[0]
+    for n in range(index_start, index_end):
+        time = times[n]
+        event = events[n]
+        source = event * number_of_states + states[n]
+        'Update the partial sums: time-decay effect'
+        time_increment = time - previous_time
+        for k in range(number_of_kernels):
+            beta = decay_coefficients[k]
+            partial_sums_2[k] += time_increment * (2 * partial_sums_1[k] + time_increment * partial_sums[k])
+            partial_sums_1[k] += time_increment * partial_sums[k]
+            decay = exp(-beta * time_increment)
+            partial_sums_2[k] *= decay
+            partial_sums_1[k] *= decay
+            partial_sums[k] *= decay
+        '''Update the Hessian of the first term of the log-likelihood (l_{+}):
+        the Hessian of log(lambda) is H/lambda - g g^T/lambda^2, where g and H are the gradient and the Hessian of lambda'''
+        if event == event_type:
+            intensity_of_the_event = base_rate
+            for k in range(number_of_kernels):
+                intensity_of_the_event += impact_coefficients[k] * partial_sums[k]
+            for k in range(number_of_kernels):
+                alpha = impact_coefficients[k]
+                gradient_of_intensity[1 + k] = partial_sums[k]
+                gradient_of_intensity[1 + number_of_kernels + k] = - alpha * partial_sums_1[k]
+                hessian[1 + k, 1 + number_of_kernels + k] -= partial_sums_1[k] / intensity_of_the_event
+                hessian[1 + number_of_kernels + k, 1 + number_of_kernels + k] += alpha * partial_sums_2[k] / intensity_of_the_event
+            for i in range(dimension):
+                g = gradient_of_intensity[i] / (intensity_of_the_event * intensity_of_the_event)
+                for j in range(i, dimension):
+                    hessian[i, j] -= g * gradient_of_intensity[j]
+        'Update the partial sums: impact of the new event'
+        for k in range(source_indptr[source], source_indptr[source + 1]):
+            partial_sums[k] += 1
+        previous_time = time
+        'Subtract Hessian of second term of log-likelihood'
+        time_increment = time_end - time
+        for k in range(source_indptr[source], source_indptr[source + 1]):
+            alpha = impact_coefficients[k]
+            beta = decay_coefficients[k]
+            b = exp(-beta * time_increment)
+            first_derivative = time_increment * b / beta - (1 - b) / (beta * beta)
+            second_derivative = - time_increment * time_increment * b / beta - 2 * time_increment * b / (beta * beta)
+            second_derivative += 2 * (1 - b) / (beta * beta * beta)
+            hessian[1 + k, 1 + number_of_kernels + k] -= first_derivative
+            hessian[1 + number_of_kernels + k, 1 + number_of_kernels + k] -= alpha * second_derivative
+    'Only the upper triangle has been computed, copy it to the lower triangle'
+    for i in range(dimension):
+        for j in range(i + 1, dimension):
+            hessian[j, i] = hessian[i, j]
+    return hessian
+
+def expectation_step(np.ndarray[DTYPEf_t, ndim=1] base_rates,
+                     np.ndarray[DTYPEf_t, ndim=1] impact_coefficients,
+                     np.ndarray[DTYPEf_t, ndim=1] decay_coefficients,
+                     int number_of_event_types,
+                     int number_of_states,
+                     const TIME_t[:] times,
+                     const MARK_t[:] events,
+                     const MARK_t[:] states,
+                     DTYPEf_t time_start,
+                     DTYPEf_t time_end,
+                     np.ndarray[DTYPEi_t, ndim=1] source_indptr,
+                     np.ndarray[DTYPEi_t, ndim=1] source_kernels,
+                     np.ndarray[DTYPEi_t, ndim=1] target_indptr):
+    """
+    Computes the expectation step of the EM algorithm, i.e., the expected sufficient statistics of the branching structure
+    given the events, along with the log-likelihood of events.
+    Each event of type e is either an immigrant, with probability nu_e/lambda_e, or it was triggered by a previous event m,
+    with probability alpha_{e_m x_m e} exp(-beta_{e_m x_m e} (t - t_m))/lambda_e.
+    Only the active kernels are visited, see log_likelihood_of_events.
+    :param parameters:
+    :param times:
+    :param events:
+    :param states:
+    :param time_start:
+    :param time_end:
+    :param source_indptr:
+    :param source_kernels:
+    :param target_indptr:
+    :return: the expected number of immigrants of each event type, the expected number of events triggered through each
+    active kernel, the expected sum of the corresponding time lags, and the log-likelihood.
+    """
+    cdef int index_start
+    cdef int number_of_kernels = impact_coefficients.shape[0]
+    cdef np.ndarray[DTYPEf_t, ndim=1] partial_sums = np.zeros(number_of_kernels, dtype=DTYPEf)
+    cdef np.ndarray[DTYPEf_t, ndim=1] partial_sums_1 = np.zeros(number_of_kernels, dtype=DTYPEf)
+    cdef np.ndarray[DTYPEf_t, ndim=1] expected_immigrants = np.zeros(number_of_event_types, dtype=DTYPEf)
+    cdef np.ndarray[DTYPEf_t, ndim=1] expected_children = np.zeros(number_of_kernels, dtype=DTYPEf)
+    cdef np.ndarray[DTYPEf_t, ndim=1] expected_lags = np.zeros(number_of_kernels, dtype=DTYPEf)
+    cdef int n, event, e, k, j, source, index_end
+    cdef double time, previous_time, intensity_of_the_event
+    cdef DTYPEf_t alpha, beta, ratio, time_increment, time_increment_2, decay
+    # events at and before this time are treated as an initial condition
+    index_start = bisect_right(times, time_start)
+    '''Initialise the partial sums S_{e'x'e} and S^{(1)}_{e'x'e}, where S^{(1)} weighs each exponential by the time elapsed since
+    the event, and initialise the log-likelihood taking into account the initial condition'''
+    cdef double log_likelihood = 0
+    for e in range(number_of_event_types):
+        log_likelihood += base_rates[e]
+    log_likelihood *= - (time_end - time_start)
+    for n in range(index_start):
+        time = times[n]
+        source = events[n] * number_of_states + states[n]
+        time_increment = time_start - time
+        time_increment_2 = time_end - time
+        for j in range(source_indptr[source], source_indptr[source + 1]):
+            k = source_kernels[j]
+            alpha = impact_coefficients[k]
+            beta = decay_coefficients[k]
+            decay = exp(-beta * time_increment)
+            partial_sums[k] += alpha * decay
+            partial_sums_1[k] += alpha * decay * time_increment
+            log_likelihood -= alpha / beta * (decay - exp(-beta * time_increment_2))
+    'Go through event times, update the expected sufficient statistics and the likelihood'
+    previous_time = time_start
+    index_end = times.shape[0]
+    for n in range(index_start, index_end):
+        time = times[n]
+        event = events[n]
+        source = event * number_of_states + states[n]
+        'Update the partial sums: time-decay effect'
+        time_increment = time - previous_time
+        for k in range(number_of_kernels):
+            beta = decay_coefficients[k]
+            decay = exp(-beta * time_increment)
+            partial_sums_1[k] = (partial_sums_1[k] + time_increment * partial_sums[k]) * decay
+            partial_sums[k] *= decay
+        'Distribute the event between the immigrants and the children of previous events'
+        intensity_of_the_event = base_rates[event]
+        for k in range(target_indptr[event], target_indptr[event + 1]):
+            intensity_of_the_event += partial_sums[k]
+        log_likelihood += log(intensity_of_the_event)
+        expected_immigrants[event] += base_rates[event] / intensity_of_the_event
+        for k in range(target_indptr[event], target_indptr[event + 1]):
+            expected_children[k] += partial_sums[k] / intensity_of_the_event
+            expected_lags[k] += partial_sums_1[k] / intensity_of_the_event
+        'Update the partial sums: impact of the new event'
+        for j in range(source_indptr[source], source_indptr[source + 1]):
+            k = source_kernels[j]
+            partial_sums[k] += impact_coefficients[k]
+        previous_time = time
+        'Compute the second term of the likelihood (l_{-})'
+        time_increment = time_end - time
+        for j in range(source_indptr[source], source_indptr[source + 1]):
+            k = source_kernels[j]
+            beta = decay_coefficients[k]
+            ratio = impact_coefficients[k] / beta
+            log_likelihood -= ratio * (1 - exp(-beta * time_increment))
+    return expected_immigrants, expected_children, expected_lags, log_likelihood
+
 def simulate(int number_of_event_types,
              int number_of_states,
              np.ndarray[DTYPEf_t, ndim=1] base_rates,
-             np.ndarray[DTYPEf_t, ndim=3] impact_coefficients,
-             np.ndarray[DTYPEf_t, ndim=3] decay_coefficients,
-             np.ndarray[DTYPEf_t, ndim=3] transition_probabilities,
+             np.ndarray[DTYPEf_t, ndim=1] impact_coefficients,
+             np.ndarray[DTYPEf_t, ndim=1] decay_coefficients,
+             np.ndarray[DTYPEi_t, ndim=1] kernel_targets,
+             np.ndarray[DTYPEi_t, ndim=1] source_indptr,
+             np.ndarray[DTYPEi_t, ndim=1] source_kernels,
+             np.ndarray[DTYPEi_t, ndim=1] target_indptr,
+             np.ndarray[DTYPEi_t, ndim=1] transition_indptr,
+             np.ndarray[DTYPEi_t, ndim=1] transition_indices,
+             np.ndarray[DTYPEf_t, ndim=1] transition_data,
              np.ndarray[DTYPEf_t, ndim=1] initial_condition_times,
              np.ndarray[DTYPEi_t, ndim=1] initial_condition_events,
              np.ndarray[DTYPEi_t, ndim=1] initial_condition_states,
-             np.ndarray[DTYPEf_t, ndim=3] initial_partial_sums,
+             np.ndarray[DTYPEf_t, ndim=1] initial_partial_sums,
              int initial_state,
              DTYPEf_t time_start,
              DTYPEf_t time_end,
-             int max_number_of_events):
+             int max_number_of_events,
+             int record_intensities=0):
     """
     Simulates a state-dependent Hawkes process with exponential kernels.
+    Only the active kernels (e',x,e) are visited: the coefficients and the initial partial sums are given for the active
+    kernels only, sorted by target as in log_likelihood_of_events, and kernel_targets[k] is the event type e of the
+    kernel k.
     :param number_of_event_types:
     :param number_of_states:
+    :param transition_indptr: the transition probabilities are given in compressed sparse row format,
+                              the row x * number_of_event_types + e contains phi_e(x, .).
+    :param record_intensities: if 1, the intensities right before each event and the compensators since time_start
+                               are also returned.
     :return:
     """
     '''Initialise the partial sums S_{e',x',e} that will allow us to compute the intensity recursively'''
     cdef int number_of_initial_events = initial_condition_times.shape[0]
-    cdef np.ndarray[DTYPEf_t, ndim=3] partial_sums = np.zeros((number_of_event_types, number_of_states, number_of_event_types), dtype=DTYPEf)
+    cdef int number_of_kernels = impact_coefficients.shape[0]
+    cdef np.ndarray[DTYPEf_t, ndim=1] partial_sums = np.zeros(number_of_kernels, dtype=DTYPEf)
     cdef DTYPEf_t time, alpha, beta
-    cdef int n, event, state, e, e1, e2, x
+    cdef int n, event, state, e, k, j, source
     for n in range(number_of_initial_events):
         time = initial_condition_times[n]
-        event = initial_condition_events[n]
-        state = initial_condition_states[n]
-        for e in range(number_of_event_types):
-            alpha = impact_coefficients[event, state, e]
-            beta = decay_coefficients[event, state, e]
-            partial_sums[event, state, e] += alpha * exp(-beta * (time_start - time))
+        source = initial_condition_events[n] * number_of_states + initial_condition_states[n]
+        for j in range(source_indptr[source], source_indptr[source + 1]):
+            k = source_kernels[j]
+            alpha = impact_coefficients[k]
+            beta = decay_coefficients[k]
+            partial_sums[k] += alpha * exp(-beta * (time_start - time))
     'Users can also pass directly the initial_partial_sums'
-    for e1 in range(number_of_event_types):
-        for x in range(number_of_states):
-            for e2 in range(number_of_event_types):
-                partial_sums[e1, x, e2] += initial_partial_sums[e1, x, e2]
-    
+    for k in range(number_of_kernels):
+        partial_sums[k] += initial_partial_sums[k]
+
     'Compute the initial intensities of events and the total intensity'
     cdef np.ndarray[DTYPEf_t, ndim=1] intensities = np.zeros(number_of_event_types, dtype=DTYPEf)
     cdef DTYPEf_t intensity_max = 0
-    for e2 in range(number_of_event_types):
-        intensities[e2] = base_rates[e2]
-        for e1 in range(number_of_event_types):
-            for x in range(number_of_states):
-                intensities[e2] += partial_sums[e1, x, e2]
-        intensity_max += intensities[e2]
+    for e in range(number_of_event_types):
+        intensities[e] = base_rates[e]
+        for k in range(target_indptr[e], target_indptr[e + 1]):
+            intensities[e] += partial_sums[k]
+        intensity_max += intensities[e]
 
     'Set initial state'
     if number_of_initial_events > 0:
@@ -482,7 +942,14 @@ def simulate(int number_of_event_types,
     time = time_start
     cdef DTYPEf_t random_exponential, random_uniform, intensity_total
     cdef np.ndarray[DTYPEf_t, ndim=1] probabilities_state
-    cdef DTYPEf_t r
+    cdef DTYPEf_t r, decay
+    cdef int row_start, row_end
+    'The compensators are integrated along the path when the intensities are recorded'
+    cdef np.ndarray[DTYPEf_t, ndim=2] result_intensities = np.zeros((number_of_event_types, record_intensities * max_size), dtype=DTYPEf)
+    cdef np.ndarray[DTYPEf_t, ndim=2] result_compensators = np.zeros((number_of_event_types, record_intensities * max_size), dtype=DTYPEf)
+    cdef np.ndarray[DTYPEf_t, ndim=1] compensators = np.zeros(number_of_event_types, dtype=DTYPEf)
+    if record_intensities:
+        result_intensities[:, 0:number_of_initial_events] = np.nan
     n = number_of_initial_events
     while time < time_end and n < max_size:
         'Generate an exponential random variable with rate parameter intensity_max'
@@ -491,39 +958,53 @@ def simulate(int number_of_event_types,
         time += random_exponential
         if time <= time_end:  # if we are not out of the considered time window
             'Update the partial sums at the current time using the recursive structure of the intensity'
-            for e1 in range(number_of_event_types):
-                for x in range(number_of_states):
-                    for e2 in range(number_of_event_types):
-                        beta = decay_coefficients[e1, x, e2]
-                        partial_sums[e1, x, e2] *= exp(-beta * random_exponential)
+            if record_intensities:
+                for e in range(number_of_event_types):
+                    compensators[e] += base_rates[e] * random_exponential
             'Update the intensities of events and compute the total intensity'
             intensity_total = 0
-            for e2 in range(number_of_event_types):
-                intensities[e2] = base_rates[e2]
-                for e1 in range(number_of_event_types):
-                    for x in range(number_of_states):
-                        intensities[e2] += partial_sums[e1, x, e2]
-                intensity_total += intensities[e2]
+            for e in range(number_of_event_types):
+                intensities[e] = base_rates[e]
+                for k in range(target_indptr[e], target_indptr[e + 1]):
+                    beta = decay_coefficients[k]
+                    decay = exp(-beta * random_exponential)
+                    if record_intensities:
+                        compensators[e] += partial_sums[k] * (1 - decay) / beta
+                    partial_sums[k] *= decay
+                    intensities[e] += partial_sums[k]
+                intensity_total += intensities[e]
             'Determine if this is an event time'
             random_uniform =  np.random.uniform(0, intensity_max)
             if random_uniform < intensity_total:  # then yes, it is an event time
                 'Determine what event occurs'
                 event = random_choice(intensities)
                 'Determine the new state of the system'
-                probabilities_state = transition_probabilities[state, event, :]
-                state = random_choice(probabilities_state)
+                row_start = transition_indptr[state * number_of_event_types + event]
+                row_end = transition_indptr[state * number_of_event_types + event + 1]
+                if row_end > row_start:
+                    probabilities_state = transition_data[row_start:row_end]
+                    state = transition_indices[row_start + random_choice(probabilities_state)]
                 'Update the result'
                 result_times[n] = time  # add the event time to the result
                 result_events[n] = event  # add the new event to the result
                 result_states[n] = state  # add the new state to the result
+                if record_intensities:
+                    for e in range(number_of_event_types):
+                        result_intensities[e, n] = intensities[e]
+                        result_compensators[e, n] = compensators[e]
                 n += 1  # increment counter of number of events
                 'Update the partial sums, the intensities of events and the total intensity'
-                for e in range(number_of_event_types):  # only the partial sums S_{event, state, . } change
-                    alpha = impact_coefficients[event, state, e]
-                    partial_sums[event, state, e] += alpha
-                    intensities[e] += alpha
+                source = event * number_of_states + state
+                for j in range(source_indptr[source], source_indptr[source + 1]):  # only the partial sums S_{event, state, . } change
+                    k = source_kernels[j]
+                    alpha = impact_coefficients[k]
+                    partial_sums[k] += alpha
+                    intensities[kernel_targets[k]] += alpha
                     intensity_total += alpha
             intensity_max = intensity_total  # the maximum total intensity until the next event
+    if record_intensities:
+        return result_times[0:n], result_events[0:n], result_states[0:n], result_intensities[:, 0:n],\
+               result_compensators[:, 0:n]
     return result_times[0:n], result_events[0:n], result_states[0:n]
 
 def random_choice(np.ndarray[DTYPEf_t, ndim=1] weights):
@@ -546,206 +1027,356 @@ def random_choice(np.ndarray[DTYPEf_t, ndim=1] weights):
             done = 1
     return result
 
-def compute_events_residuals(np.ndarray[DTYPEf_t, ndim=1] base_rates,
-                             np.ndarray[DTYPEf_t, ndim=3] impact_coefficients,
-                             np.ndarray[DTYPEf_t, ndim=3] decay_coefficients,
-                             int number_of_event_types,
-                             int number_of_states,
-                             np.ndarray[DTYPEf_t, ndim=1] times,
-                             np.ndarray[DTYPEi_t, ndim=1] events,
-                             np.ndarray[DTYPEi_t, ndim=1] states,
-                             DTYPEf_t time_start,
-                             np.ndarray[DTYPEf_t, ndim=3] initial_partial_sums):
-    
-    'Find the start index'
-    cdef int index_start = bisect.bisect_right(times, time_start)  # events at and before this time are treated as an initial condition
-    
-    'Initialise'
-    cdef int length = times.shape[0]
-    cdef np.ndarray[DTYPEf_t, ndim=2] residuals = np.zeros((number_of_event_types, length - index_start + 1), dtype=DTYPEf)
-    # at most length-index_start residuals per event type, the +1 is to deal with boundary effect in main loop
-    cdef np.ndarray[DTYPEi_t, ndim=1] residuals_lengths = np.zeros(number_of_event_types, dtype=DTYPEi)
-    cdef np.ndarray[DTYPEf_t, ndim=1] previous_times = time_start*np.ones(number_of_event_types, dtype=DTYPEf)
-    cdef np.ndarray[DTYPEf_t, ndim=3] partial_sums = np.zeros((number_of_event_types, number_of_states, number_of_event_types), dtype=DTYPEf)
-    cdef np.ndarray[DTYPEf_t, ndim=3] partial_sums_old = np.zeros((number_of_event_types, number_of_states, number_of_event_types), dtype=DTYPEf)
-    cdef np.ndarray[DTYPEf_t, ndim=3] impact_decay_ratios = np.zeros((number_of_event_types, number_of_states, number_of_event_types), dtype=DTYPEf)
-    cdef int e1, x, e2, n, e, event, state, i, pos
-    cdef DTYPEf_t alpha, beta, time, time_last
 
-    'Compute ratios alpha/beta just once'
-    for e1 in range(number_of_event_types):
-        for x in range(number_of_states):
-            for e2 in range(number_of_event_types):
-                alpha = impact_coefficients[e1, x, e2]
-                beta = decay_coefficients[e1, x, e2]
-                impact_decay_ratios[e1, x, e2] = alpha / beta
+def simulate_first_passage(int number_of_event_types,
+                           int number_of_states,
+                           np.ndarray[DTYPEf_t, ndim=1] base_rates,
+                           np.ndarray[DTYPEf_t, ndim=1] impact_coefficients,
+                           np.ndarray[DTYPEf_t, ndim=1] decay_coefficients,
+                           np.ndarray[DTYPEi_t, ndim=1] kernel_targets,
+                           np.ndarray[DTYPEi_t, ndim=1] source_indptr,
+                           np.ndarray[DTYPEi_t, ndim=1] source_kernels,
+                           np.ndarray[DTYPEi_t, ndim=1] target_indptr,
+                           np.ndarray[DTYPEi_t, ndim=1] transition_indptr,
+                           np.ndarray[DTYPEi_t, ndim=1] transition_indices,
+                           np.ndarray[DTYPEf_t, ndim=1] transition_data,
+                           np.ndarray[DTYPEf_t, ndim=1] initial_partial_sums,
+                           int initial_state,
+                           np.ndarray[DTYPEi_t, ndim=1] is_target_state,
+                           DTYPEf_t time_horizon,
+                           int number_of_paths,
+                           int max_number_of_events):
+    """
+    Simulates independent paths of a state-dependent Hawkes process, each one until the state process enters the
+    target set or until the time horizon is reached. Only the hitting time and the number of events are kept.
+    Only the active kernels are visited, see simulate.
+    :param is_target_state: is_target_state[x] is 1 if x belongs to the target set and 0 otherwise.
+    :param time_horizon: paths that do not hit the target set before this duration are censored.
+    :return:
+    """
+    cdef int number_of_kernels = impact_coefficients.shape[0]
+    cdef np.ndarray[DTYPEf_t, ndim=1] hitting_times = np.zeros(number_of_paths, dtype=DTYPEf)
+    cdef np.ndarray[DTYPEi_t, ndim=1] numbers_of_events = np.zeros(number_of_paths, dtype=DTYPEi)
+    cdef np.ndarray[DTYPEi_t, ndim=1] hits = np.zeros(number_of_paths, dtype=DTYPEi)
+    cdef np.ndarray[DTYPEf_t, ndim=1] partial_sums = np.zeros(number_of_kernels, dtype=DTYPEf)
+    cdef np.ndarray[DTYPEf_t, ndim=1] intensities = np.zeros(number_of_event_types, dtype=DTYPEf)
+    'Uniform random numbers are drawn by batches, at most 4 of them are used per candidate time'
+    cdef int buffer_size = 4096
+    cdef np.ndarray[DTYPEf_t, ndim=1] uniforms = np.random.uniform(size=buffer_size)
+    cdef int u = 0
+    cdef int p, n, event, state, e, k, source, hit, j, row_start, row_end
+    cdef DTYPEf_t time, alpha, beta, random_exponential, intensity_max, intensity_total, threshold, cumulative_sum
+    for p in range(number_of_paths):
+        'Reset the partial sums, the intensities and the state'
+        intensity_max = 0
+        for e in range(number_of_event_types):
+            intensities[e] = base_rates[e]
+            for k in range(target_indptr[e], target_indptr[e + 1]):
+                partial_sums[k] = initial_partial_sums[k]
+                intensities[e] += partial_sums[k]
+            intensity_max += intensities[e]
+        state = initial_state
+        time = 0
+        n = 0
+        hit = is_target_state[state]
+        while hit == 0 and n < max_number_of_events and intensity_max > 0:
+            if u + 4 > buffer_size:
+                uniforms = np.random.uniform(size=buffer_size)
+                u = 0
+            'Generate an exponential random variable with rate parameter intensity_max'
+            random_exponential = - log(1 - uniforms[u]) / intensity_max
+            u += 1
+            time += random_exponential
+            if time > time_horizon:
+                break
+            'Update the partial sums, the intensities of events and the total intensity'
+            intensity_total = 0
+            for e in range(number_of_event_types):
+                intensities[e] = base_rates[e]
+                for k in range(target_indptr[e], target_indptr[e + 1]):
+                    beta = decay_coefficients[k]
+                    partial_sums[k] *= exp(-beta * random_exponential)
+                    intensities[e] += partial_sums[k]
+                intensity_total += intensities[e]
+            'Determine if this is an event time'
+            if uniforms[u] * intensity_max < intensity_total:
+                'Determine what event occurs'
+                threshold = uniforms[u + 1] * intensity_total
+                event = 0
+                cumulative_sum = intensities[0]
+                while cumulative_sum < threshold and event < number_of_event_types - 1:
+                    event += 1
+                    cumulative_sum += intensities[event]
+                'Determine the new state of the system'
+                row_start = transition_indptr[state * number_of_event_types + event]
+                row_end = transition_indptr[state * number_of_event_types + event + 1]
+                if row_end > row_start:
+                    threshold = 0
+                    for j in range(row_start, row_end):
+                        threshold += transition_data[j]
+                    threshold *= uniforms[u + 2]
+                    j = row_start
+                    cumulative_sum = transition_data[j]
+                    while cumulative_sum < threshold and j < row_end - 1:
+                        j += 1
+                        cumulative_sum += transition_data[j]
+                    state = transition_indices[j]
+                n += 1
+                'Update the partial sums, the intensities of events and the total intensity'
+                source = event * number_of_states + state
+                for j in range(source_indptr[source], source_indptr[source + 1]):
+                    k = source_kernels[j]
+                    alpha = impact_coefficients[k]
+                    partial_sums[k] += alpha
+                    intensities[kernel_targets[k]] += alpha
+                    intensity_total += alpha
+                hit = is_target_state[state]
+            u += 3
+            intensity_max = intensity_total  # the maximum total intensity until the next event
+        hits[p] = hit
+        numbers_of_events[p] = n
+        if hit == 1:
+            hitting_times[p] = time
+        else:
+            hitting_times[p] = time_horizon
+    return hitting_times, numbers_of_events, hits
 
-    '''Initialise the partial sums S_{e',x',e} that will allow us to compute the residuals recursively.
-    Note that, here, we work with (alpha_{e',x',e'}/beta_{e',x',e'})*S_{e',x',e'} instead of S_{e',x',e}'''
-    for n in range(index_start):
-        time = times[n]
+def compute_partial_sums(np.ndarray[DTYPEf_t, ndim=3] coefficients,
+                         np.ndarray[DTYPEf_t, ndim=3] decay_coefficients,
+                         int number_of_event_types,
+                         int number_of_states,
+                         const TIME_t[:] times,
+                         const MARK_t[:] events,
+                         const MARK_t[:] states,
+                         int index_end,
+                         DTYPEf_t time):
+    '''Computes coefficients_{e',x',e}*S_{e',x',e} at the given time, where the partial sums only run over the
+    first index_end events'''
+    cdef np.ndarray[DTYPEf_t, ndim=3] partial_sums = np.zeros((number_of_event_types, number_of_states, number_of_event_types), dtype=DTYPEf)
+    cdef int n, e, event, state
+    for n in range(index_end):
         event = events[n]
         state = states[n]
         for e in range(number_of_event_types):
-            beta = decay_coefficients[event, state, e]
-            partial_sums[event, state, e] += exp(-beta * (time_start - time))
-    # By doing so, multiplying the partial sums by the impact/decay coefficients needs to be done only once
-    for event in range(number_of_event_types):
-        for state in range(number_of_states):
-            for e in range(number_of_event_types):
-                partial_sums[event, state, e] = partial_sums[event, state, e] * impact_decay_ratios[event, state, e]
-    'Users can also pass directly the initial_partial_sums'
-    for e1 in range(number_of_event_types):
-        for x in range(number_of_states):
-            for e2 in range(number_of_event_types):
-                partial_sums[e1, x, e2] += initial_partial_sums[e1, x, e2]
-                partial_sums_old[e1, x, e2] = partial_sums[e1, x, e2]
+            partial_sums[event, state, e] += coefficients[event, state, e] * exp(-decay_coefficients[event, state, e] * (time - times[n]))
+    return partial_sums
+
+
+def compute_events_residuals(np.ndarray[DTYPEf_t, ndim=1] base_rates,
+                             np.ndarray[DTYPEf_t, ndim=1] impact_coefficients,
+                             np.ndarray[DTYPEf_t, ndim=1] decay_coefficients,
+                             np.ndarray[DTYPEi_t, ndim=1] kernel_targets,
+                             np.ndarray[DTYPEi_t, ndim=1] source_indptr,
+                             np.ndarray[DTYPEi_t, ndim=1] source_kernels,
+                             np.ndarray[DTYPEi_t, ndim=1] target_indptr,
+                             int number_of_event_types,
+                             int number_of_states,
+                             const TIME_t[:] times,
+                             const MARK_t[:] events,
+                             const MARK_t[:] states,
+                             int index_start,
+                             int index_end,
+                             DTYPEf_t time_last,
+                             np.ndarray[DTYPEf_t, ndim=1] partial_sums,
+                             np.ndarray[DTYPEf_t, ndim=1] sums_old,
+                             np.ndarray[DTYPEf_t, ndim=1] open_residuals,
+                             int block_size=0):
+    '''Computes the events residuals that are completed by the events index_start, ..., index_end-1.
+    Only the active kernels are visited, see simulate.
+    The residuals are returned in a compact ragged format: the residuals of the event type e are
+    values[offsets[e]:offsets[e+1]].
+    The state of the recursion is updated in place so that the computation can be resumed at index_end:
+    partial_sums contains (alpha_{e',x',e}/beta_{e',x',e})*S_{e',x',e} right after the event at time_last,
+    sums_old[e] is the sum over (e',x') of these partial sums right before the jump at time_last
+    and open_residuals[e] is the part of the next residual of type e that has already been computed.
+    If block_size is positive, the decay factors of the kernels are computed by blocks of block_size events, see
+    block_decays'''
+    'Initialise'
+    cdef int number_of_kernels = impact_coefficients.shape[0]
+    cdef np.ndarray[DTYPEi_t, ndim=1] offsets = np.zeros(number_of_event_types + 1, dtype=DTYPEi)
+    cdef np.ndarray[DTYPEi_t, ndim=1] positions = np.zeros(number_of_event_types, dtype=DTYPEi)
+    cdef np.ndarray[DTYPEf_t, ndim=1] values = np.zeros(index_end - index_start, dtype=DTYPEf)
+    # compensators[e] is the integral of the intensity of events of type e over [time_last, time), this does not
+    # include the constant terms due to the jump at time_last, which are added to the residuals separately
+    cdef np.ndarray[DTYPEf_t, ndim=1] compensators = np.zeros(number_of_event_types, dtype=DTYPEf)
+    cdef np.ndarray[DTYPEf_t, ndim=1] impact_decay_ratios = np.zeros(number_of_kernels, dtype=DTYPEf)
+    # jumps[e] is the ratio alpha/beta of the kernel from the mark of the current event to e (zero if it is inactive)
+    cdef np.ndarray[DTYPEf_t, ndim=1] jumps = np.zeros(number_of_event_types, dtype=DTYPEf)
+    # decay_factors[k] is the decay factor of the kernel k between time_last and the current event
+    cdef np.ndarray[DTYPEf_t, ndim=1] decays = np.zeros(number_of_kernels, dtype=DTYPEf)
+    cdef np.ndarray[DTYPEf_t, ndim=1] block = np.zeros(max(block_size, 0) * number_of_kernels, dtype=DTYPEf)
+    cdef DTYPEf_t* decay_factors = <DTYPEf_t*> decays.data
+    cdef int k, j, n, e, event, state, source
+    cdef DTYPEf_t time
+    'Compute ratios alpha/beta just once'
+    for k in range(number_of_kernels):
+        impact_decay_ratios[k] = impact_coefficients[k] / decay_coefficients[k]
+    'Count the residuals of each event type so that they can be stored contiguously'
+    for n in range(index_start, index_end):
+        offsets[events[n] + 1] += 1
+    for e in range(number_of_event_types):
+        offsets[e + 1] += offsets[e]
+        positions[e] = offsets[e]
     'Compute residuals'
-    time_last = time_start
-    for n in range(index_start, length):
+    for n in range(index_start, index_end):
         time = times[n]
         event = events[n]
         state = states[n]
-        pos = residuals_lengths[event]
-        'Contribution of the base rate'
-        residuals[event, pos] += (time - previous_times[event])*base_rates[event]
-        'Contribution of the constant terms to residuals of all event types'
-        for e in range(number_of_event_types):
-            if e != event:
-                i = residuals_lengths[e]
-                residuals[e, i] += impact_decay_ratios[event, state, e]
-            if e == event:  # in this case, this event contributes to the next residual
-                residuals[e, pos+1] += impact_decay_ratios[event, state, e]
+        source = event * number_of_states + state
         'Update partial sums up to current time but excluding the current time: decay effect'
-        for e1 in range(number_of_event_types):
-            for x in range(number_of_states):
-                for e2 in range(number_of_event_types):
-                    partial_sums[e1, x, e2] *= exp(-decay_coefficients[e1, x, e2] * (time - time_last))
-        'Contribution of the partial sums'
+        if block_size > 0:
+            if (n - index_start) % block_size == 0:
+                block_decays(times, n, min(n + block_size, index_end), time_last, number_of_kernels,
+                             <DTYPEf_t*> decay_coefficients.data, <DTYPEf_t*> block.data)
+            decay_factors = <DTYPEf_t*> block.data + ((n - index_start) % block_size) * number_of_kernels
+        else:
+            for k in range(number_of_kernels):
+                decays[k] = exp(-decay_coefficients[k] * (time - time_last))
         for e in range(number_of_event_types):
-            for x in range(number_of_states):
-                residuals[event, pos] += partial_sums_old[e, x, event] - partial_sums[e, x, event]
-                # save new partial sums to compute the next residual for this event type
-                partial_sums_old[e, x, event] = partial_sums[e, x, event]
-        'Update partial sums: jump effect due to current event'
+            compensators[e] = (time - time_last)*base_rates[e] + sums_old[e]
+            sums_old[e] = 0
+            for k in range(target_indptr[e], target_indptr[e + 1]):
+                partial_sums[k] *= decay_factors[k]
+                sums_old[e] += partial_sums[k]
+        for j in range(source_indptr[source], source_indptr[source + 1]):
+            k = source_kernels[j]
+            jumps[kernel_targets[k]] = impact_decay_ratios[k]
+        'Contribution of [time_last, time) and of the constant terms to the open residuals'
         for e in range(number_of_event_types):
-            partial_sums[event, state, e] += impact_decay_ratios[event, state, e]
-        'Update variables that keep track of current position'
+            open_residuals[e] += compensators[e] - sums_old[e]
+            if e != event:
+                open_residuals[e] += jumps[e]
+        'The current event completes the open residual of its type and contributes to the next one'
+        values[positions[event]] = open_residuals[event]
+        positions[event] += 1
+        open_residuals[event] = jumps[event]
+        'Update partial sums: jump effect due to current event'
+        for j in range(source_indptr[source], source_indptr[source + 1]):
+            k = source_kernels[j]
+            partial_sums[k] += impact_decay_ratios[k]
+            jumps[kernel_targets[k]] = 0
         time_last = time
-        previous_times[event] = time
-        residuals_lengths[event] += 1
-    'Return result'
-    result = []
-    for e in range(number_of_event_types):
-        length = residuals_lengths[e]
-        result.append(residuals[e, 0:length])
-    return result
+    return values, offsets
 
-def compute_total_residuals(np.ndarray[DTYPEf_t, ndim=3] transition_probabilities,
+def compute_total_residuals(np.ndarray[DTYPEi_t, ndim=1] transition_indptr,
+                            np.ndarray[DTYPEi_t, ndim=1] transition_indices,
+                            np.ndarray[DTYPEf_t, ndim=1] transition_data,
                             np.ndarray[DTYPEf_t, ndim=1] base_rates,
-                            np.ndarray[DTYPEf_t, ndim=3] impact_coefficients,
-                            np.ndarray[DTYPEf_t, ndim=3] decay_coefficients,
+                            np.ndarray[DTYPEf_t, ndim=1] impact_coefficients,
+                            np.ndarray[DTYPEf_t, ndim=1] decay_coefficients,
+                            np.ndarray[DTYPEi_t, ndim=1] kernel_targets,
+                            np.ndarray[DTYPEi_t, ndim=1] source_indptr,
+                            np.ndarray[DTYPEi_t, ndim=1] source_kernels,
+                            np.ndarray[DTYPEi_t, ndim=1] target_indptr,
                             int number_of_event_types,
                             int number_of_states,
-                            np.ndarray[DTYPEf_t, ndim=1] times,
-                            np.ndarray[DTYPEi_t, ndim=1] events,
-                            np.ndarray[DTYPEi_t, ndim=1] states,
-                            DTYPEf_t time_start,
-                            np.ndarray[DTYPEf_t, ndim=3] initial_partial_sums,
-                            int initial_state):
-    'Find the start index'
-    cdef int index_start = bisect.bisect_right(times, time_start)  # events at and before this time are treated as an initial condition  
+                            const TIME_t[:] times,
+                            const MARK_t[:] events,
+                            const MARK_t[:] states,
+                            int index_start,
+                            int index_end,
+                            DTYPEf_t time_last,
+                            int initial_state,
+                            np.ndarray[DTYPEf_t, ndim=1] partial_sums,
+                            np.ndarray[DTYPEf_t, ndim=1] sums_old,
+                            np.ndarray[DTYPEf_t, ndim=2] open_residuals,
+                            int block_size=0):
+    '''Computes the total residuals that are completed by the events index_start, ..., index_end-1.
+    The residuals are returned in a compact ragged format: the residuals of the mark (e,x) are
+    values[offsets[e*number_of_states+x]:offsets[e*number_of_states+x+1]].
+    The state of the recursion is updated in place so that the computation can be resumed at index_end,
+    see compute_events_residuals; here open_residuals has one entry per mark (e,x)'''
     'Initialise'
-    cdef int length = times.shape[0]
-    cdef np.ndarray[DTYPEf_t, ndim=3] residuals = np.zeros((number_of_event_types, number_of_states, length - index_start + 1), dtype=DTYPEf)
-    # at most length-index_start residuals per event type, the +1 is to deal with boundary effect in main loop
-    cdef np.ndarray[DTYPEi_t, ndim=2] residuals_lengths = np.zeros((number_of_event_types, number_of_states), dtype=DTYPEi)
-    cdef np.ndarray[DTYPEf_t, ndim=3] partial_sums = np.zeros((number_of_event_types, number_of_states, number_of_event_types), dtype=DTYPEf)
-    cdef np.ndarray[DTYPEf_t, ndim=3] partial_sums_old = np.zeros((number_of_event_types, number_of_states, number_of_event_types), dtype=DTYPEf)
-    cdef np.ndarray[DTYPEf_t, ndim=3] impact_decay_ratios = np.zeros((number_of_event_types, number_of_states, number_of_event_types), dtype=DTYPEf)
-    cdef int e1, x, e2, n, e, event, state, i, pos, previous_state, x2
-    cdef DTYPEf_t alpha, beta, time, time_last, phi
+    cdef int number_of_kernels = impact_coefficients.shape[0]
+    cdef int number_of_marks = number_of_event_types * number_of_states
+    cdef np.ndarray[DTYPEi_t, ndim=1] offsets = np.zeros(number_of_marks + 1, dtype=DTYPEi)
+    cdef np.ndarray[DTYPEi_t, ndim=1] positions = np.zeros(number_of_marks, dtype=DTYPEi)
+    cdef np.ndarray[DTYPEf_t, ndim=1] values = np.zeros(index_end - index_start, dtype=DTYPEf)
+    # compensators[e] is the integral of the intensity of events of type e over [time_last, time), this does not
+    # include the constant terms due to the jump at time_last, which are added to the residuals separately
+    cdef np.ndarray[DTYPEf_t, ndim=1] compensators = np.zeros(number_of_event_types, dtype=DTYPEf)
+    cdef np.ndarray[DTYPEf_t, ndim=1] impact_decay_ratios = np.zeros(number_of_kernels, dtype=DTYPEf)
+    # jumps[e] is the ratio alpha/beta of the kernel from the mark of the current event to e (zero if it is inactive)
+    cdef np.ndarray[DTYPEf_t, ndim=1] jumps = np.zeros(number_of_event_types, dtype=DTYPEf)
+    # decay_factors[k] is the decay factor of the kernel k between time_last and the current event
+    cdef np.ndarray[DTYPEf_t, ndim=1] decays = np.zeros(number_of_kernels, dtype=DTYPEf)
+    cdef np.ndarray[DTYPEf_t, ndim=1] block = np.zeros(max(block_size, 0) * number_of_kernels, dtype=DTYPEf)
+    cdef DTYPEf_t* decay_factors = <DTYPEf_t*> decays.data
+    cdef int k, x, n, e, event, state, source, previous_state, j, row, mark
+    cdef DTYPEf_t time, phi
     'Compute ratios alpha/beta just once'
-    for e1 in range(number_of_event_types):
-        for x in range(number_of_states):
-            for e2 in range(number_of_event_types):
-                alpha = impact_coefficients[e1, x, e2]
-                beta = decay_coefficients[e1, x, e2]
-                impact_decay_ratios[e1, x, e2] = alpha / beta
-    '''Initialise the partial sums S_{e',x',e} that will allow us to compute the residuals recursively.
-    Note that, here, we work with (alpha_{e',x',e'}/beta_{e',x',e'})*S_{e',x',e'} instead of S_{e',x',e}'''
-    for n in range(index_start):
-        time = times[n]
-        event = events[n]
-        state = states[n]
-        for e in range(number_of_event_types):
-            beta = decay_coefficients[event, state, e]
-            partial_sums[event, state, e] += exp(-beta * (time_start - time))
-    # By doing so, multiplying the partial sums by the impact/decay coefficients needs to be done only once
-    for event in range(number_of_event_types):
-        for state in range(number_of_states):
-            for e in range(number_of_event_types):
-                partial_sums[event, state, e] = partial_sums[event, state, e] * impact_decay_ratios[event, state, e]
-    'Users can also pass directly the initial_partial_sums'
-    for e1 in range(number_of_event_types):
-        for x in range(number_of_states):
-            for e2 in range(number_of_event_types):
-                partial_sums[e1, x, e2] += initial_partial_sums[e1, x, e2]
-                partial_sums_old[e1, x, e2] = partial_sums[e1, x, e2]
+    for k in range(number_of_kernels):
+        impact_decay_ratios[k] = impact_coefficients[k] / decay_coefficients[k]
+    'Count the residuals of each mark so that they can be stored contiguously'
+    for n in range(index_start, index_end):
+        offsets[events[n] * number_of_states + states[n] + 1] += 1
+    for mark in range(number_of_marks):
+        offsets[mark + 1] += offsets[mark]
+        positions[mark] = offsets[mark]
     'Set initial state'
     if index_start > 0:
-        # if the initial condition is not empty (there are events before time_start)
+        # if there are events before index_start (initial condition or previous chunk)
         previous_state = states[index_start-1]
-        # the state at time_start is the state coordinate of the most recent mark
+        # the current state is the state coordinate of the most recent mark
     else:  # if no initial condition is given, use the given initial state
         previous_state = initial_state
     'Compute residuals'
-    time_last = time_start
-    for n in range(index_start, length):
+    for n in range(index_start, index_end):
         time = times[n]
         event = events[n]
         state = states[n]
-        'Update partial sums up to current time but excluding the current time: decay effect'
-        for e1 in range(number_of_event_types):
-            for x in range(number_of_states):
-                for e2 in range(number_of_event_types):
-                    partial_sums[e1, x, e2] *= exp(-decay_coefficients[e1, x, e2] * (time - time_last))
-        'Compute contribution of [time_last, time) to residuals'
+        source = event * number_of_states + state
+        '''Update partial sums up to current time but excluding the current time: decay effect.
+        The contribution of [time_last, time) does not depend on the mark (e,x), it is computed once per event type:
+        it is the contribution of the base rate plus the decrease of the partial sums'''
+        if block_size > 0:
+            if (n - index_start) % block_size == 0:
+                block_decays(times, n, min(n + block_size, index_end), time_last, number_of_kernels,
+                             <DTYPEf_t*> decay_coefficients.data, <DTYPEf_t*> block.data)
+            decay_factors = <DTYPEf_t*> block.data + ((n - index_start) % block_size) * number_of_kernels
+        else:
+            for k in range(number_of_kernels):
+                decays[k] = exp(-decay_coefficients[k] * (time - time_last))
+        for e in range(number_of_event_types):
+            compensators[e] = (time - time_last)*base_rates[e] + sums_old[e]
+            sums_old[e] = 0
+            for k in range(target_indptr[e], target_indptr[e + 1]):
+                partial_sums[k] *= decay_factors[k]
+                sums_old[e] += partial_sums[k]
+        for e in range(number_of_event_types):
+            compensators[e] -= sums_old[e]
+        for j in range(source_indptr[source], source_indptr[source + 1]):
+            k = source_kernels[j]
+            jumps[kernel_targets[k]] = impact_decay_ratios[k]
+        'Compute contribution of [time_last, time) to residuals, only the marks (e,x) reachable from previous_state'
         for e in range(number_of_event_types):
-            for x in range(number_of_states):
-                phi = transition_probabilities[previous_state, e, x]
-                pos = residuals_lengths[e, x]
-                'Contribution of the base rate'
-                residuals[e, x, pos] += (time - time_last)*base_rates[e]*phi
-                'Contribution of the partial sums'
-                for e2 in range(number_of_event_types):
-                    for x2 in range(number_of_states):
-                        residuals[e, x, pos] += phi*(partial_sums_old[e2, x2, e] - partial_sums[e2, x2, e])
+            row = previous_state * number_of_event_types + e
+            for j in range(transition_indptr[row], transition_indptr[row + 1]):
+                x = transition_indices[j]
+                phi = transition_data[j]
+                'Contribution of the base rate and of the partial sums'
+                open_residuals[e, x] += compensators[e]*phi
                 'Contribuion of the constant terms'
                 if e != event:
-                    residuals[e, x, pos] += impact_decay_ratios[event, state, e]*phi
-                if e == event:  # in this case, this event contributes to the residual betwen time and next_time; hence the new current state must be used
-                    phi = transition_probabilities[state, e, x]
-                    if x != state:
-                        residuals[e, x, pos] += impact_decay_ratios[event, state, e]*phi
-                    if x == state:  # in this case, this event contributs to the next residual of the mark (e,x)
-                        residuals[e, x, pos+1] += impact_decay_ratios[event, state, e]*phi
-        'Save current partials sums for the computation of the residuals over the next time increment'
-        for e1 in range(number_of_event_types):
-            for x in range(number_of_states):
-                for e2 in range(number_of_event_types):
-                    partial_sums_old[e1, x, e2] = partial_sums[e1, x, e2]
+                    open_residuals[e, x] += jumps[e]*phi
+            if e == event:
+                'The current event completes the open residual of the mark (event,state)'
+                mark = event * number_of_states + state
+                values[positions[mark]] = open_residuals[event, state]
+                positions[mark] += 1
+                open_residuals[event, state] = 0
+                # this event contributes to the residuals betwen time and next_time; hence the new current state must be used
+                row = state * number_of_event_types + e
+                for j in range(transition_indptr[row], transition_indptr[row + 1]):
+                    x = transition_indices[j]
+                    phi = transition_data[j]
+                    open_residuals[e, x] += jumps[e]*phi
         'Update partial sums: jump effect due to current event'
-        for e in range(number_of_event_types):
-            partial_sums[event, state, e] += impact_decay_ratios[event, state, e]
+        for j in range(source_indptr[source], source_indptr[source + 1]):
+            k = source_kernels[j]
+            partial_sums[k] += impact_decay_ratios[k]
+            jumps[kernel_targets[k]] = 0
         'Update variables that keep track of current position'
         time_last = time
         previous_state = state
-        residuals_lengths[event, state] += 1
-    'Return result'
-    result = []
-    for e in range(number_of_event_types):
-        for x in range(number_of_states):
-            length = residuals_lengths[e, x]
-            result.append(residuals[e, x, 0:length])
-    return result
\ No newline at end of file
+    return values, offsets
@@ -0,0 +1,186 @@
+import numpy as np
+import json
+import time
+
+
+class EstimationMonitor:
+    """
+    Instruments :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.estimate_hawkes_parameters`.
+
+    The monitor counts and times the evaluations of the likelihood and of its gradient, and reports the progress of
+    the optimiser at every iteration of every sub-problem, a sub-problem being an (event type, initial guess) pair
+    when the estimation is parallel and an initial guess otherwise.
+    Every report is a dictionary (a record) with a 'record' key equal to 'start', 'iteration', 'end' or 'summary'.
+    Records can be appended to a JSON lines file, passed to a Python callback and kept in memory.
+
+    :type log_file: string
+    :param log_file: path of the JSON lines file to which the records are appended, one JSON object per line.
+    :type callback: function
+    :param callback: function that is called with every record.
+    :type keep_records: boolean
+    :param keep_records: set to True to keep the records in the attribute `records`.
+    """
+    def __init__(self, log_file=None, callback=None, keep_records=True):
+        self.log_file = log_file
+        self.callback = callback
+        self.keep_records = keep_records
+        self.records = []
+        'Counters and timers of the whole estimation'
+        self.number_of_likelihood_evaluations = 0
+        self.number_of_gradient_evaluations = 0
+        self.likelihood_time = 0.
+        self.gradient_time = 0.
+        self.time_start = time.perf_counter()
+        'State of the current sub-problem'
+        self.event_type = None
+        self.start = None
+        self.iteration = 0
+        self.subproblem_time_start = self.time_start
+        self.subproblem_counters = np.zeros(2, dtype=int)
+        self.subproblem_timers = np.zeros(2)
+        self.recent_evaluations = []  # (x, objective, gradient) of the last evaluations
+
+    def emit(self, record):
+        """
+        Reports a record: it is time-stamped (seconds since the creation of the monitor) and sent to the sinks.
+
+        :type record: dict
+        :param record: the record.
+        """
+        record['elapsed'] = time.perf_counter() - self.time_start
+        if self.keep_records:
+            self.records.append(record)
+        if self.log_file is not None:
+            with open(self.log_file, 'a') as f:
+                f.write(json.dumps(record, default=EstimationMonitor.to_json) + '\n')
+        if self.callback is not None:
+            self.callback(record)
+
+    def start_subproblem(self, event_type, start, kind, guess):
+        """
+        Reports the beginning of the optimisation of a sub-problem.
+
+        :type event_type: int
+        :param event_type: the event type of the sub-problem, None if all the parameters are estimated jointly.
+        :type start: int
+        :param start: the index of the initial guess.
+        :type kind: string
+        :param kind: 'given' or 'random'.
+        :type guess: 1D numpy array
+        :param guess: the initial guess.
+        """
+        self.event_type = event_type
+        self.start = start
+        self.iteration = 0
+        self.subproblem_time_start = time.perf_counter()
+        self.subproblem_counters[:] = 0
+        self.subproblem_timers[:] = 0
+        self.recent_evaluations = []
+        self.emit({'record': 'start', 'event_type': event_type, 'start': start, 'kind': kind,
+                   'dimension': len(guess)})
+
+    def instrument(self, objective, gradient):
+        """
+        Wraps the objective function and its gradient so that their evaluations are counted and timed, and creates
+        the callback that reports the progress of the optimiser.
+
+        :type objective: function
+        :param objective: the function that is minimised.
+        :type gradient: function
+        :param gradient: its gradient.
+        :rtype: function, function, function
+        :return: the instrumented objective, the instrumented gradient and the callback to pass to `scipy.minimize`.
+        """
+        def instrumented_objective(x):
+            t = time.perf_counter()
+            value = objective(x)
+            duration = time.perf_counter() - t
+            self.number_of_likelihood_evaluations += 1
+            self.likelihood_time += duration
+            self.subproblem_counters[0] += 1
+            self.subproblem_timers[0] += duration
+            self.remember(x, objective=value)
+            return value
+        def instrumented_gradient(x):
+            t = time.perf_counter()
+            value = gradient(x)
+            duration = time.perf_counter() - t
+            self.number_of_gradient_evaluations += 1
+            self.gradient_time += duration
+            self.subproblem_counters[1] += 1
+            self.subproblem_timers[1] += duration
+            self.remember(x, gradient=value)
+            return value
+        def callback(x, *args):
+            'The optimiser does not pass the objective, we use the evaluations at x if there are any'
+            self.iteration += 1
+            value, g = self.recall(x)
+            if value is None:
+                value = instrumented_objective(x)
+            if g is None:
+                g = instrumented_gradient(x)
+            self.emit({'record': 'iteration', 'event_type': self.event_type, 'start': self.start,
+                       'iteration': self.iteration, 'objective': value, 'gradient_norm': np.linalg.norm(g)})
+        return instrumented_objective, instrumented_gradient, callback
+
+    def remember(self, x, objective=None, gradient=None, size=8):
+        'Caches the evaluations at the last `size` points'
+        for evaluation in self.recent_evaluations:
+            if np.array_equal(evaluation[0], x):
+                if objective is not None:
+                    evaluation[1] = objective
+                if gradient is not None:
+                    evaluation[2] = gradient
+                return
+        self.recent_evaluations.append([np.array(x, copy=True), objective, gradient])
+        if len(self.recent_evaluations) > size:
+            self.recent_evaluations.pop(0)
+
+    def recall(self, x):
+        'Returns the cached objective and gradient at x (None when not evaluated)'
+        for evaluation in self.recent_evaluations:
+            if np.array_equal(evaluation[0], x):
+                return evaluation[1], evaluation[2]
+        return None, None
+
+    def end_subproblem(self, result):
+        """
+        Reports the end of the optimisation of the current sub-problem.
+
+        :type result: scipy.optimize.OptimizeResult
+        :param result: the result of the optimisation.
+        """
+        self.emit({'record': 'end', 'event_type': self.event_type, 'start': self.start,
+                   'objective': result.fun, 'success': result.success, 'message': result.message,
+                   'nit': result.get('nit'), 'nfev': result.get('nfev'),
+                   'wall_time': time.perf_counter() - self.subproblem_time_start,
+                   'likelihood_evaluations': self.subproblem_counters[0],
+                   'gradient_evaluations': self.subproblem_counters[1],
+                   'likelihood_time': self.subproblem_timers[0], 'gradient_time': self.subproblem_timers[1]})
+
+    def summary(self):
+        """
+        Reports and returns the counters and timers of the whole estimation.
+
+        :rtype: dict
+        :return: the 'summary' record.
+        """
+        record = {'record': 'summary',
+                  'likelihood_evaluations': self.number_of_likelihood_evaluations,
+                  'gradient_evaluations': self.number_of_gradient_evaluations,
+                  'likelihood_time': self.likelihood_time, 'gradient_time': self.gradient_time,
+                  'time_per_likelihood_evaluation': self.likelihood_time / max(self.number_of_likelihood_evaluations, 1),
+                  'time_per_gradient_evaluation': self.gradient_time / max(self.number_of_gradient_evaluations, 1)}
+        self.emit(record)
+        return record
+
+    @staticmethod
+    def to_json(value):
+        'Converts numpy scalars and arrays to JSON serialisable objects'
+        if isinstance(value, np.generic):
+            return value.item()
+        if isinstance(value, np.ndarray):
+            return value.tolist()
+        if isinstance(value, bytes):
+            return value.decode()
+        return str(value)
@@ -0,0 +1,222 @@
+import numpy as np
+from .hybrid_hawkes_exp import HybridHawkesExp
+
+
+class ParameterStructure:
+    r"""
+    Describes a structured state-dependent Hawkes model, in which some decay coefficients :math:`\beta_{e'xe}` are
+    tied (they are equal) and some impact coefficients :math:`\alpha_{e'xe}` are fixed at zero.
+    Only the free parameters are estimated: the base rates :math:`\nu_e`, the impact coefficients that are not
+    masked and one decay coefficient per group of tied decay coefficients.
+
+    The free parameters are put into a single array in this order; the impact coefficients are ordered as in
+    :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.parameters_to_array` and the decay coefficients by group.
+    The methods of :py:class:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp` that compute the likelihood, its gradient
+    and its Hessian, as well as
+    :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.estimate_hawkes_parameters`, accept a `structure` argument,
+    in which case they work with the array of free parameters.
+    The likelihood, gradient and Hessian kernels then only visit the kernels :math:`(e', x, e)` whose impact
+    coefficients are free, and compute the exponential decays once per group of tied decay coefficients instead of
+    once per :math:`(e', x, e)`. In particular, a sparse impact mask, e.g., the non-negligible impact coefficients of
+    a first fit, makes models with many event types tractable.
+
+    :type number_of_event_types: int
+    :param number_of_event_types: number of event types :math:`d_e`.
+    :type number_of_states: int
+    :param number_of_states: number of states :math:`d_x`.
+    :type decay_structure: string or 3D numpy array of int
+    :param decay_structure: 'full' when all the decay coefficients are free, 'shared_across_states' when
+                            :math:`\beta_{e'xe}` does not depend on `x`, 'by_target' when it depends only on `e`.
+                            Any other tying can be given as an array of labels: :math:`\beta_{e'xe}` and
+                            :math:`\beta_{f'yf}` are tied when `decay_structure[e',x,e]` equals
+                            `decay_structure[f',y,f]`.
+    :type impact_mask: 3D numpy array of boolean
+    :param impact_mask: `impact_mask[e',x,e]` is False when :math:`\alpha_{e'xe}` is fixed at zero.
+                        By default, all the impact coefficients are free.
+                        The decay coefficients that only affect kernels whose impact coefficients are all fixed at
+                        zero have no effect on the likelihood, they are not estimated and are set to one.
+    :type number_of_target_event_types: int
+    :param number_of_target_event_types: length of the third dimension of the coefficients, it is smaller than
+                                         :math:`d_e` when the structure only describes the parameters that govern
+                                         the intensities of some event types, see
+                                         :py:meth:`~mpoints.parameter_structure.ParameterStructure.partial`.
+    """
+    def __init__(self, number_of_event_types, number_of_states, decay_structure='full', impact_mask=None,
+                 number_of_target_event_types=None):
+        if number_of_target_event_types is None:
+            number_of_target_event_types = number_of_event_types
+        shape = (number_of_event_types, number_of_states, number_of_target_event_types)
+        self.number_of_event_types = number_of_event_types
+        self.number_of_states = number_of_states
+        self.number_of_target_event_types = number_of_target_event_types
+        'Labels of the groups of tied decay coefficients'
+        if isinstance(decay_structure, str):
+            e1, x, e2 = np.indices(shape)
+            if decay_structure == 'full':
+                labels = (e1 * number_of_states + x) * number_of_target_event_types + e2
+            elif decay_structure == 'shared_across_states':
+                labels = e1 * number_of_target_event_types + e2
+            elif decay_structure == 'by_target':
+                labels = e2
+            else:
+                raise ValueError('unknown decay structure ' + decay_structure)
+        else:
+            labels = np.asarray(decay_structure)
+            if labels.shape != shape:
+                raise ValueError('the decay structure must have the shape ' + str(shape))
+        if impact_mask is None:
+            impact_mask = np.ones(shape, dtype=bool)
+        impact_mask = np.asarray(impact_mask, dtype=bool)
+        if impact_mask.shape != shape:
+            raise ValueError('the impact mask must have the shape ' + str(shape))
+        self.impact_mask = impact_mask
+        # the groups are numbered 0, 1, ... in the order of their first appearance in the array of all the parameters,
+        # where the coefficients are ordered by state first (see HybridHawkesExp.parameters_to_array)
+        unique_labels, first_appearances, inverse = np.unique(np.transpose(labels, (1, 0, 2)).ravel(),
+                                                              return_index=True, return_inverse=True)
+        order = np.argsort(np.argsort(first_appearances))
+        decay_indices = order[inverse].reshape((number_of_states, number_of_event_types, number_of_target_event_types))
+        self.decay_indices = np.ascontiguousarray(np.transpose(decay_indices, (1, 0, 2)))
+        self.number_of_decays = len(unique_labels)
+        'Map every entry of the array of all the parameters to a free parameter (-1 for the fixed ones)'
+        dimension = number_of_target_event_types + 2 * np.prod(shape)
+        base_rates_positions, impact_positions, decay_positions = \
+            HybridHawkesExp.array_to_parameters(np.arange(dimension), number_of_event_types, number_of_states,
+                                                number_of_target_event_types)
+        self.free_indices = -np.ones(dimension, dtype=int)
+        self.free_indices[base_rates_positions.astype(int)] = np.arange(number_of_target_event_types)
+        impact_positions = np.sort(impact_positions[impact_mask].astype(int))
+        self.number_of_free_impact_coefficients = len(impact_positions)
+        self.free_indices[impact_positions] = number_of_target_event_types + np.arange(len(impact_positions))
+        # only the groups that contain a kernel with a free impact coefficient are estimated
+        free_decays = np.unique(self.decay_indices[impact_mask])
+        self.free_decay_indices = -np.ones(self.number_of_decays, dtype=int)
+        self.free_decay_indices[free_decays] = np.arange(len(free_decays))
+        offset = number_of_target_event_types + self.number_of_free_impact_coefficients
+        free_decay_positions = self.free_decay_indices[self.decay_indices]
+        self.free_indices[decay_positions.astype(int)[free_decay_positions >= 0]] = \
+            offset + free_decay_positions[free_decay_positions >= 0]
+        self.number_of_free_parameters = offset + len(free_decays)
+        'Values of the fixed parameters'
+        self.fixed_values = np.zeros(dimension)
+        self.fixed_values[decay_positions.astype(int)[free_decay_positions < 0]] = 1
+        self.partial_structures = {}
+
+    @property
+    def ties_event_types(self):
+        """
+        True when some tied decay coefficients govern the intensities of different event types, in which case the
+        estimation cannot be split into one problem per event type.
+
+        :rtype: boolean
+        """
+        targets = np.broadcast_to(np.arange(self.number_of_target_event_types), self.decay_indices.shape)
+        for d in range(self.number_of_decays):
+            if len(np.unique(targets[self.decay_indices == d])) > 1:
+                return True
+        return False
+
+    def partial(self, event_type):
+        r"""
+        Restricts the structure to the parameters that govern the intensity of the given event type, as in
+        :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.log_likelihood_of_events_partial`.
+
+        :type event_type: int
+        :param event_type: the event type `e`.
+        :rtype: :py:class:`~mpoints.parameter_structure.ParameterStructure`
+        :return: the structure of the parameters :math:`(\nu_e, \alpha_{\cdot\cdot e}, \beta_{\cdot\cdot e})`.
+        """
+        if event_type not in self.partial_structures:
+            self.partial_structures[event_type] = \
+                ParameterStructure(self.number_of_event_types, self.number_of_states,
+                                   self.decay_indices[:, :, event_type:event_type+1],
+                                   self.impact_mask[:, :, event_type:event_type+1], 1)
+        return self.partial_structures[event_type]
+
+    def array_to_parameters(self, array):
+        r"""
+        Retrieves the parameters :math:`(\nu, \alpha, \beta)` from the array of free parameters.
+
+        :type array: 1D numpy array
+        :param array: the free parameters.
+        :rtype: 1D numpy array, 3D numpy array, 3D numpy array
+        :return: the parameters :math:`(\nu, \alpha, \beta)`.
+        """
+        return HybridHawkesExp.array_to_parameters(self.free_to_full(array), self.number_of_event_types,
+                                                   self.number_of_states, self.number_of_target_event_types)
+
+    def parameters_to_array(self, base_rates, impact_coefficients, decay_coefficients):
+        r"""
+        Puts the free parameters into a single array. The masked impact coefficients are ignored and every group of
+        tied decay coefficients is represented by the average of its (free) members.
+
+        :type base_rates: 1D numpy array
+        :param base_rates: the collection :math:`(\nu_{e})`.
+        :type impact_coefficients: 3D numpy array
+        :param impact_coefficients: the collection :math:`(\alpha_{e'xe})`.
+        :type decay_coefficients: 3D numpy array
+        :param decay_coefficients: the collection :math:`(\beta_{e'xe})`.
+        :rtype: 1D numpy array
+        :return: the free parameters.
+        """
+        return self.full_to_free(HybridHawkesExp.parameters_to_array(base_rates, impact_coefficients,
+                                                                     decay_coefficients))
+
+    def free_to_full(self, array):
+        r"""
+        Converts an array of free parameters to the array of all the parameters, see
+        :py:meth:`~mpoints.hybrid_hawkes_exp.HybridHawkesExp.parameters_to_array`.
+
+        :type array: 1D numpy array
+        :param array: the free parameters.
+        :rtype: 1D numpy array
+        :return: all the parameters.
+        """
+        array = np.asarray(array, dtype=float)
+        return np.where(self.free_indices >= 0, array[np.maximum(self.free_indices, 0)], self.fixed_values)
+
+    def full_to_free(self, array):
+        r"""
+        Projects an array of all the parameters onto the structure, see
+        :py:meth:`~mpoints.parameter_structure.ParameterStructure.parameters_to_array`.
+
+        :type array: 1D numpy array
+        :param array: all the parameters.
+        :rtype: 1D numpy array
+        :return: the free parameters.
+        """
+        free = self.free_indices >= 0
+        sums = np.bincount(self.free_indices[free], weights=np.asarray(array, dtype=float)[free],
+                           minlength=self.number_of_free_parameters)
+        counts = np.bincount(self.free_indices[free], minlength=self.number_of_free_parameters)
+        return sums / counts
+
+    def gradient_to_free(self, gradient):
+        r"""
+        Converts the gradient of a function with respect to all the parameters to its gradient with respect to the
+        free parameters: the derivatives with respect to tied parameters are added up and those with respect to the
+        fixed parameters are dropped.
+
+        :type gradient: 1D numpy array
+        :param gradient: the gradient with respect to all the parameters.
+        :rtype: 1D numpy array
+        :return: the gradient with respect to the free parameters.
+        """
+        free = self.free_indices >= 0
+        return np.bincount(self.free_indices[free], weights=np.asarray(gradient, dtype=float)[free],
+                           minlength=self.number_of_free_parameters)
+
+    def hessian_to_free(self, hessian):
+        r"""
+        Converts the Hessian of a function with respect to all the parameters to its Hessian with respect to the free
+        parameters, see :py:meth:`~mpoints.parameter_structure.ParameterStructure.gradient_to_free`.
+
+        :type hessian: 2D numpy array
+        :param hessian: the Hessian with respect to all the parameters.
+        :rtype: 2D numpy array
+        :return: the Hessian with respect to the free parameters.
+        """
+        free = np.flatnonzero(self.free_indices >= 0)
+        jacobian = np.zeros((len(self.free_indices), self.number_of_free_parameters))
+        jacobian[free, self.free_indices[free]] = 1
+        return jacobian.T @ hessian @ jacobian
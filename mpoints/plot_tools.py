@@ -1,11 +1,9 @@
 import numpy as np
-import matplotlib.pyplot as plt
 import os
-import seaborn
-import statsmodels.tsa.stattools as stattools
-from matplotlib.colors import ListedColormap
 import copy
 import bisect
+from . import diagnostics
+# matplotlib and seaborn are imported inside the plotting functions so that importing mpoints stays cheap
 
 def qq_plot(residuals, shape=None, path='', fig_name='qq_plot.pdf', log=False, q_min=0.01, q_max=0.99,
             number_of_quantiles=100, title=None, labels=None, model_labels=None, palette=None, figsize=(12, 6),
@@ -16,6 +14,9 @@ def qq_plot(residuals, shape=None, path='', fig_name='qq_plot.pdf', log=False, q
 
     :type residuals: list
     :param residuals: list of lists (one list of residuals per event type) or list of lists of lists when multiple models are compared (one list of lists per model).
+                      The residuals of a model can also be given in the compact format `(values, offsets)` or
+                      summarised by a :py:class:`~mpoints.diagnostics.QuantileSketch`, see
+                      :py:func:`~mpoints.diagnostics.sketch_residuals`.
     :type shape: (int, int)
     :param shape: 2D-tuple (number of rows, number of columns), shape of the array of figures.
     :type path: string
@@ -61,18 +62,20 @@ def qq_plot(residuals, shape=None, path='', fig_name='qq_plot.pdf', log=False, q
     :rtype: Figure, array of Axes
     :return: the figure and array of figures (see matplotlib).
     """
+    import matplotlib.pyplot as plt
+    import seaborn
     quantile_levels = np.linspace(q_min, q_max, number_of_quantiles)
-    quantiles_theoretical = np.zeros(number_of_quantiles)
-    for i in range(number_of_quantiles):
-        q = quantile_levels[i]
-        x = - np.log(1 - q)  # standard exponential distribution
-        quantiles_theoretical[i] = x
-    # find number of models given and number of event types (dim)
-    n_models = 1
-    dim = len(residuals)
-    if type(residuals[0][0]) in [list, np.ndarray]:  # case when there is more than one model
-        n_models = len(residuals)
-        dim = len(residuals[0])
+    quantiles_theoretical = - np.log(1 - quantile_levels)  # standard exponential distribution
+    # find number of models given, a model is a list of arrays, a tuple (values, offsets) or a quantile sketch
+    models = [residuals]
+    if not isinstance(residuals, (tuple, diagnostics.QuantileSketch)):
+        first = residuals[0]
+        if isinstance(first, (tuple, diagnostics.QuantileSketch)) or (len(first) > 0 and np.ndim(first[0]) > 0):
+            models = residuals  # case when there is more than one model
+    n_models = len(models)
+    # empirical quantiles of all the event types, one array (dim, number_of_quantiles) per model
+    quantiles_empirical_all = [diagnostics.empirical_quantiles(model, quantile_levels) for model in models]
+    dim = quantiles_empirical_all[0].shape[0]
     # set empty model labels if no labels provided
     if model_labels==None:
         model_labels = [None]*n_models
@@ -100,20 +103,12 @@ def qq_plot(residuals, shape=None, path='', fig_name='qq_plot.pdf', log=False, q
                     axes = fig_array[i, j]
                 axes.tick_params(axis='both', which='major', labelsize=size_ticks)  # font size for tick labels
                 if n_models == 1:
-                    quantiles_empirical = np.zeros(number_of_quantiles)
-                    for k in range(number_of_quantiles):
-                        q = quantile_levels[k]
-                        x = np.percentile(residuals[n], q * 100)
-                        quantiles_empirical[k] = x
+                    quantiles_empirical = quantiles_empirical_all[0][n]
                     axes.plot(quantiles_theoretical, quantiles_empirical, color=palette[0])
                     axes.plot(quantiles_theoretical, quantiles_theoretical, color='k', linewidth=0.8, ls='--')
                 else:
                     for m in range(n_models):
-                        quantiles_empirical = np.zeros(number_of_quantiles)
-                        for k in range(number_of_quantiles):
-                            q = quantile_levels[k]
-                            x = np.percentile(residuals[m][n], q * 100)
-                            quantiles_empirical[k] = x
+                        quantiles_empirical = quantiles_empirical_all[m][n]
                         axes.plot(quantiles_theoretical, quantiles_empirical, color=palette[m],
                                      label=model_labels[m])
                         if m == 0:
@@ -180,6 +175,8 @@ def correlogram(residuals, path='', fig_name='correlogram.pdf', title=None, labe
     :rtype: Figure, array of Axes
     :return: the figure and array of figures (see matplotlib).
     """
+    import matplotlib.pyplot as plt
+    import seaborn
     # find number of models given and number of event types (dim)
     n_models = 1
     dim = len(residuals)
@@ -193,6 +190,11 @@ def correlogram(residuals, path='', fig_name='correlogram.pdf', title=None, labe
     h_size = dim
     if palette is None:
         palette = seaborn.color_palette('husl', n_models)
+    # compute all the cross-correlations of each model at once, see diagnostics.cross_correlations
+    if n_models == 1:
+        ccfs = [diagnostics.cross_correlations(residuals, n_lags)]
+    else:
+        ccfs = [diagnostics.cross_correlations(residuals[m], n_lags) for m in range(n_models)]
     f, fig_array = plt.subplots(v_size, h_size, figsize=figsize, sharex='col', sharey='row')
     if title is not None:
         f.suptitle(title)
@@ -209,19 +211,11 @@ def correlogram(residuals, path='', fig_name='correlogram.pdf', title=None, labe
                 axes = fig_array[i, j]
             axes.tick_params(axis='both', which='major', labelsize=size_ticks)  # font size for tick labels
             if n_models == 1:
-                max_length = min(len(residuals[i]), len(residuals[j]))
-                ccf = stattools.ccf(np.array(residuals[i][0:max_length]),
-                                    np.array(residuals[j][0:max_length]),
-                                    unbiased=True)
-                axes.plot(ccf[0:n_lags+1], color=palette[0])
+                axes.plot(ccfs[0][i, j], color=palette[0])
                 axes.set_xlim(xmin=0, xmax=n_lags)
             else:
                 for m in range(n_models):
-                    max_length = min(len(residuals[m][i]), len(residuals[m][j]))
-                    ccf = stattools.ccf(np.array(residuals[m][i][0:max_length]),
-                                        np.array(residuals[m][j][0:max_length]),
-                                        unbiased=True)
-                    axes.plot(ccf[0:n_lags + 1], color=palette[m], label=model_labels[m])
+                    axes.plot(ccfs[m][i, j], color=palette[m], label=model_labels[m])
                     axes.set_xlim(xmin=0, xmax=n_lags)
                 if i+j==0:  # only add legend in the first subplot
                     legend = axes.legend(frameon=1, fontsize=size_legend)
@@ -286,6 +280,8 @@ def transition_probabilities(probabilities, shape=None, path='', fig_name='trans
     :rtype: Figure, array of Axes
     :return: the figure and array of figures (see matplotlib).
     """
+    import matplotlib.pyplot as plt
+    import seaborn
     if color_map is None:
         color_map = seaborn.cubehelix_palette(as_cmap=True, reverse=False, start=0.5, rot=-.75)
     number_of_states = np.shape(probabilities)[0]
@@ -391,6 +387,8 @@ def discrete_distribution(probabilities, path='', fig_name='distribution_events_
     :rtype: Figure
     :return: the figure (see matplotlib).
     """
+    import matplotlib.pyplot as plt
+    import seaborn
     if color_map is None:
         color_map = seaborn.cubehelix_palette(as_cmap=True, reverse=False, start=0.5, rot=-.75)
     v_size = np.shape(probabilities)[0]
@@ -508,6 +506,8 @@ def kernels_exp(impact_coefficients, decay_coefficients, events_labels=None, sta
     :rtype: Figure, array of Axes
     :return: the figure and array of figures (see matplotlib).
     """
+    import matplotlib.pyplot as plt
+    import seaborn
     s = np.shape(impact_coefficients)
     number_of_event_types = s[0]
     number_of_states = s[1]
@@ -570,10 +570,52 @@ def kernels_exp(impact_coefficients, decay_coefficients, events_labels=None, sta
         plt.savefig(entire_path)
     return fig, fig_array
 
+def envelope_decimation(times, values, time_start, time_end, number_of_pixels):
+    r"""
+    Selects the points of a path that are needed to draw it at a given horizontal resolution.
+    The interval [`time_start`, `time_end`] is divided into `number_of_pixels` columns and, in each column,
+    only the first point, the last point and the points where the minimum and the maximum are attained are kept.
+    The visible extremes of the path are therefore preserved while at most 4 points per column are drawn.
+
+    :type times: 1D numpy array of float
+    :param times: the sorted times of the path.
+    :type values: 1D numpy array of float
+    :param values: the values of the path at `times`.
+    :type time_start: float
+    :param time_start: the time of the left edge of the plot.
+    :type time_end: float
+    :param time_end: the time of the right edge of the plot.
+    :type number_of_pixels: int
+    :param number_of_pixels: the number of columns.
+    :rtype: 1D numpy array of int
+    :return: the sorted indices of the points to keep.
+    """
+    times = np.asarray(times)
+    values = np.asarray(values)
+    if len(times) <= 4 * number_of_pixels:
+        return np.arange(len(times))
+    columns = np.floor((times - time_start) / (time_end - time_start) * number_of_pixels).astype(int)
+    columns = np.clip(columns, 0, number_of_pixels - 1)
+    starts = np.flatnonzero(np.diff(columns, prepend=-1))  # first index of each non-empty column
+    ends = np.append(starts[1:], len(times)) - 1
+    segments = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(times))))
+    minima = np.minimum.reduceat(values, starts)
+    maxima = np.maximum.reduceat(values, starts)
+    # first index where the extreme is attained in each column
+    _, index_min = np.unique(segments[values == minima[segments]], return_index=True)
+    _, index_max = np.unique(segments[values == maxima[segments]], return_index=True)
+    index_min = np.flatnonzero(values == minima[segments])[index_min]
+    index_max = np.flatnonzero(values == maxima[segments])[index_max]
+    return np.unique(np.concatenate((starts, ends, index_min, index_max)))
+
 def sample_path(times, events, states, model, time_start, time_end, color_palette=None, labelsize=16, ticksize=14,
-                legendsize=16, num=1000, s=12, savefig=False, path='', fig_name='sample_path.pdf'):
+                legendsize=16, num=1000, s=12, savefig=False, path='', fig_name='sample_path.pdf',
+                number_of_pixels=None):
     r"""
     Plots a sample path along with the intensities.
+    For long histories, set `number_of_pixels` to decimate the intensities and the state process with
+    :py:func:`~mpoints.plot_tools.envelope_decimation` and to draw at most one dot per pixel for each
+    event type and state.
 
     :type times: array of floats
     :param times: times when the events occur.
@@ -605,14 +647,20 @@ def sample_path(times, events, states, model, time_start, time_end, color_palett
     :param path:  where the figure is saved.
     :type fig_name: string
     :param fig_name: name of the file.
+    :type number_of_pixels: int
+    :param number_of_pixels: horizontal resolution used to decimate the paths, if None all the points are plotted.
     :rtype: Figure, array of Axes
     :return: the figure and array of figures (see matplotlib).
     """
+    import matplotlib.pyplot as plt
+    import seaborn
+    from matplotlib.colors import ListedColormap
     if color_palette is None:
         color_palette = seaborn.color_palette('husl', n_colors=model.number_of_event_types)
     'Compute the intensities - this may require all the event times prior to start_time'
     compute_times = np.linspace(time_start, time_end, num=num)
     aggregated_times, intensities = model.intensities_of_events_at_times(compute_times, times, events, states)
+    aggregated_times = np.array(aggregated_times)
     'We can now discard the times outside the desired time period'
     index_start = bisect.bisect_left(times, time_start)
     index_end = bisect.bisect_right(times, time_end)
@@ -628,7 +676,11 @@ def sample_path(times, events, states, model, time_start, time_end, color_palett
     ax.tick_params(axis='both', which='major', labelsize=ticksize)
     # intensity_max = intensities.max() * 1.01
     for n in range(model.number_of_event_types):
-        ax.plot(aggregated_times, intensities[n], linewidth=1, color=color_palette[n], label=model.events_labels[n])
+        indices = np.arange(len(aggregated_times))
+        if number_of_pixels is not None:
+            indices = envelope_decimation(aggregated_times, intensities[n], time_start, time_end, number_of_pixels)
+        ax.plot(aggregated_times[indices], intensities[n][indices], linewidth=1, color=color_palette[n],
+                label=model.events_labels[n])
     ax.set_ylim(ymin=0)
     ax.set_ylabel('Intensity', fontsize=labelsize)
     ax.set_xlabel('Time', fontsize=labelsize)
@@ -639,8 +691,15 @@ def sample_path(times, events, states, model, time_start, time_end, color_palett
     ax.tick_params(axis='both', which='major', labelsize=ticksize)
     # Plot the event times and types, one color per event type, y-coordinate corresponds to new state of the system
     color_map = ListedColormap(color_palette)
-    ax.scatter(times, states, c=events, cmap=color_map, s=s, alpha=1, edgecolors='face',
-               zorder=10)
+    indices = np.arange(len(times))
+    if number_of_pixels is not None and len(times) > 0:
+        # keep one dot per pixel, event type and state since the others would be drawn on top of it
+        pixels = np.clip(np.floor((np.array(times) - time_start) / (time_end - time_start) * number_of_pixels),
+                         0, number_of_pixels - 1).astype(int)
+        keys = (pixels * model.number_of_states + np.array(states)) * model.number_of_event_types + np.array(events)
+        indices = np.sort(np.unique(keys, return_index=True)[1])
+    ax.scatter(np.array(times)[indices], np.array(states)[indices], c=np.array(events)[indices], cmap=color_map,
+               vmin=0, vmax=model.number_of_event_types - 1, s=s, alpha=1, edgecolors='face', zorder=10)
     ax.set_xlim(xmin=time_start, xmax=time_end)
     ax.set_ylim(ymin=-0.1, ymax=model.number_of_states - 0.9)
     ax.set_yticks(range(model.number_of_states))
@@ -651,6 +710,10 @@ def sample_path(times, events, states, model, time_start, time_end, color_palett
     states.insert(0, initial_state)
     times.append(time_end)
     states.append(states[-1])  # these two appends are required to plot until `time_end'
+    if number_of_pixels is not None:
+        indices = envelope_decimation(times, states, time_start, time_end, number_of_pixels)
+        times = np.array(times)[indices]
+        states = np.array(states)[indices]
     ax.step(times, states, where='post', linewidth=1, color='grey', zorder=1)
     # Save the figure
     plt.tight_layout()